@@ -1,3 +1,5 @@
+import sys
+
 try:
     import pickle as pickle
     from itertools import izip 
@@ -7,3 +9,14 @@ except ImportError:
     from io import StringIO, BytesIO
     import pickle
     izip = zip
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+if sys.version_info[0] >= 3:
+    def reraise(tp, value, tb=None):
+        raise value.with_traceback(tb)
+else:
+    exec("def reraise(tp, value, tb=None):\n    raise tp, value, tb\n")
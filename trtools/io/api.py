@@ -2,6 +2,8 @@ from .caching_dict import CachingDict
 from .filecache import FileCache, LeveledFileCache, MetaFileCache
 from .cacher import cacher
 from .hdf5_filecache import HDF5FileCache, HDF5LeveledFileCache, OBTFileCache
-from .pytables import HDF5Handle, convert_frame, MismatchColumnsError
+from .pytables import HDF5Handle, convert_frame, append_frame, MismatchColumnsError
+from .handle_pool import HandlePool, handle_pool
 from .hdf5_store import HDFFile, OBTFile
+from .dataset import HDF5Dataset
 from .bundle import *
@@ -16,6 +16,7 @@ import os.path
 import functools
 
 import pandas as pd
+import numpy as np
 
 from .hdf5_store import HDFFile, OBTFile
 from trtools.compat import izip, pickle
@@ -91,15 +92,27 @@ def save_panel(panel, path, frame_key='frame_key'):
         store[i] = frame
     store.close()
 
-def load_panel(path):
+def load_panel(path, chunksize=None):
     """
     This portion is straight forward. Loads the data from save_panel and then sends it to 
     _panel which does the heavy lifting
+
+    The OBT is read chunksize rows at a time straight into the values array, so we never
+    hold the full table as both records and a DataFrame.
     """
     filepath = bundle_filepath(path)
     store = OBTFile(filepath)
-    #df = store.obt.table.read()
-    df = store.obt.ix[:]
+    table = store.obt.table
+    value_columns = [col for col in table.columns if col != store.frame_key]
+
+    vals = None
+    pos = 0
+    for chunk in table.iter_frames(chunksize=chunksize):
+        chunk_vals = chunk[value_columns].values
+        if vals is None:
+            vals = np.empty((table.nrows, len(value_columns)), dtype=chunk_vals.dtype)
+        vals[pos:pos+len(chunk_vals)] = chunk_vals
+        pos += len(chunk_vals)
     store.close()
 
     load_meta = functools.partial(_load_meta, path=path)
@@ -107,7 +120,7 @@ def load_panel(path):
     index = load_meta('index')
     columns = load_meta('columns')
 
-    panel = _panel(items, index, columns, df)
+    panel = _panel(items, index, columns, vals)
     return panel
 
 def _panel(items, index, columns, df):
@@ -116,14 +129,14 @@ def _panel(items, index, columns, df):
         items : Panel.items
         index : Panel.major_axis
         columns : Panel.columns
-        df : pd.DataFrame
+        df : pd.DataFrame or np.ndarray
             data retrieved from OBTFile which are the Panel's item.values stakcked on top of each other 
 
     Note: 
         This only works if the data was stored in the HDF in order. The data is expected to be 
         np.ndarrays stacked up on top of each in order of the items list
     """
-    vals = df.values
+    vals = getattr(df, 'values', df)
     # AH, I need to map out exactly why this works... I just know that it does
     vals = vals.reshape(len(items), len(columns) * len(index)) # (items) x (index x columns)
     df = pd.DataFrame(vals).T # (index x columns) * items
@@ -0,0 +1,159 @@
+"""
+    Dictionary encoded (categorical) columns.
+
+    The table stores int32 codes and the values live in a VLArray of objects, one
+    row per code, in a group named _pd_vocab_<table name> next to the table.
+    Codes are assigned in order of first appearance and never change, so appends
+    only ever add to the vocabulary. -1 is NaN.
+
+    Tables of a group with a pd_vocab attribute share the vocabulary group it 
+    names instead, so their codes agree. Used by partitioned tables.
+"""
+import weakref
+
+import numpy as np
+import pandas as pd
+import tables as tb
+
+# code for values not in the vocabulary. Matches no rows
+MISSING_CODE = -2
+
+def _vocab_group_name(table):
+    shared = _shared_vocab(table)
+    if shared is not None:
+        return shared
+    return '_pd_vocab_' + table._v_name
+
+def _shared_vocab(table):
+    try:
+        return table._v_parent._v_attrs.pd_vocab
+    except AttributeError:
+        return None
+
+def vocab_group(table):
+    parent = table._v_parent
+    name = _vocab_group_name(table)
+    if name in parent._v_children:
+        return parent._v_children[name]
+    return None
+
+def categorical_from_codes(codes, categories):
+    """
+        pandas Categorical from codes. Older pandas can't hold a Categorical in
+        a DataFrame, so they get the decoded object array.
+    """
+    categories = np.asarray(categories, dtype=object)
+    if hasattr(pd.Categorical, 'from_codes'):
+        return pd.Categorical.from_codes(codes, categories)
+    # -1 takes the trailing NaN
+    return np.append(categories, np.nan).take(codes)
+
+# tables.File -> {node path: (nrows, values, lookup)}
+_vocab_cache = weakref.WeakKeyDictionary()
+
+class Vocabulary(object):
+    """
+        Vocabulary of one category column
+    """
+    def __init__(self, table, column):
+        self.table = table
+        self.column = str(column)
+
+    @property
+    def node(self):
+        group = vocab_group(self.table)
+        if group is None or self.column not in group._v_children:
+            return None
+        return group._v_children[self.column]
+
+    def create(self):
+        handle = self.table._v_file
+        group = vocab_group(self.table)
+        if group is None:
+            group = handle.createGroup(self.table._v_parent, _vocab_group_name(self.table))
+        if self.column in group._v_children:
+            if _shared_vocab(self.table) is not None:
+                # another table already started it
+                return
+            group._v_children[self.column]._f_remove()
+        handle.createVLArray(group, self.column, tb.ObjectAtom())
+
+    def _load(self):
+        node = self.node
+        if node is None:
+            raise KeyError("{0} has no vocabulary for {1}".format(self.table._v_pathname,
+                                                                  self.column))
+        cache = _vocab_cache.setdefault(node._v_file, {})
+        entry = cache.get(node._v_pathname)
+        if entry is None or entry[0] != node.nrows:
+            values = node.read()
+            lookup = dict((value, code) for code, value in enumerate(values))
+            entry = (node.nrows, values, lookup)
+            cache[node._v_pathname] = entry
+        return entry
+
+    @property
+    def values(self):
+        return self._load()[1]
+
+    def encode(self, values):
+        """
+            int32 codes for values. Values not seen before are added.
+        """
+        labels, uniques = pd.factorize(np.asarray(values, dtype=object))
+        _, _, lookup = self._load()
+        new = [value for value in uniques if value not in lookup]
+        if new:
+            node = self.node
+            for value in new:
+                node.append(value)
+            node.flush()
+            _, _, lookup = self._load()
+        mapping = np.array([lookup[value] for value in uniques] + [-1], dtype=np.int32)
+        return mapping[labels] # -1 labels pick up the trailing -1
+
+    def code(self, value):
+        """
+            code of a single value, for queries
+        """
+        return self._load()[2].get(value, MISSING_CODE)
+
+    def lookup(self, values):
+        """
+            codes of values without adding to the vocabulary
+        """
+        lookup = self._load()[2]
+        return np.array([lookup.get(value, MISSING_CODE) for value in values], dtype=np.int32)
+
+    def decode(self, codes):
+        return categorical_from_codes(np.asarray(codes), self.values)
+
+    def decode_values(self, codes):
+        """
+            list of values for codes
+        """
+        values = self.values
+        return [values[code] if code >= 0 else np.nan for code in codes]
+
+def column_vocabulary(table, column):
+    """
+        Vocabulary of column or None if it isn't a category column
+    """
+    vocab = Vocabulary(table, column)
+    if vocab.node is None:
+        return None
+    return vocab
+
+def copy_vocabularies(orig, table):
+    """
+        Give table the same vocabularies as orig. Used when copying codes over.
+    """
+    group = vocab_group(orig)
+    if group is None:
+        return
+    existing = vocab_group(table)
+    if existing is not None and existing._v_pathname == group._v_pathname:
+        return
+    if existing is not None:
+        existing._f_remove(recursive=True)
+    group._f_copy(table._v_parent, _vocab_group_name(table), recursive=True)
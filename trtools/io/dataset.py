@@ -0,0 +1,228 @@
+"""
+    A directory of per key HDF5 files read as one logical table.
+
+    HDF5FileCache and HDF5LeveledFileCache keep one file per key, e.g. one per
+    symbol or per symbol/year. HDF5Dataset keeps a manifest of every file's row
+    count and index range, so a read only opens the files that can hold the
+    keys and dates asked for. Surviving files are read in parallel processes.
+"""
+import os.path
+import multiprocessing as mp
+
+import pandas as pd
+from tables import openFile
+
+from trtools.compat import pickle
+from trtools.io.pytables import _meta, _index_name, _convert_param, HDF5Table
+
+MANIFEST_NAME = 'manifest.pkl'
+
+def _data_table(handle):
+    """
+        The table SingleHDF.put writes
+    """
+    return handle.root.data.data
+
+def file_stamp(filename):
+    """
+        (mtime in ns, size) of filename. Changes when the file is rewritten, 
+        even within one tick of a coarse mtime
+    """
+    st = os.stat(filename)
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None: # python 2
+        mtime = int(st.st_mtime * 1e9)
+    return (mtime, st.st_size)
+
+def partition_stats(filename):
+    """
+        Manifest entry for one file
+    """
+    entry = {}
+    entry['stamp'] = file_stamp(filename)
+    entry['start'] = entry['end'] = None
+    handle = openFile(filename, 'r')
+    try:
+        table = _data_table(handle)
+        meta = _meta(table)
+        index_name = _index_name(table)
+        entry['nrows'] = int(table.nrows)
+        entry['columns'] = list(meta['columns'])
+        if table.nrows and meta['value_types'].get(index_name) == 'datetime64':
+            index = table.col(index_name)
+            entry['start'] = int(index.min())
+            entry['end'] = int(index.max())
+    finally:
+        handle.close()
+    return entry
+
+def _read_partition(task):
+    """
+        Read one file. Module level so it can be sent to worker processes, which
+        open their own handles.
+    """
+    filename, start, end, columns = task
+    handle = openFile(filename, 'r')
+    try:
+        table = HDF5Table(_data_table(handle))
+        rows = slice(None)
+        if start is not None or end is not None:
+            index = table.sql.index
+            rows = None
+            if start is not None:
+                rows = index >= start
+            if end is not None:
+                rows = index <= end if rows is None else rows & (index <= end)
+        if columns is None:
+            return table[rows]
+        return table.select(rows, columns)
+    finally:
+        handle.close()
+
+class HDF5Dataset(object):
+    """
+        cache : HDF5FileCache or HDF5LeveledFileCache
+
+        The manifest is stored in the cache_dir and refreshed for files whose
+        file_stamp changed, so it stays current as the cache is written.
+    """
+    def __init__(self, cache, processes=None):
+        """
+            processes : worker processes for reads. Defaults to the cpu count.
+                1 reads in this process.
+        """
+        self.cache = cache
+        self.processes = processes
+        self._manifest = None
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.cache.cache_dir, MANIFEST_NAME)
+
+    def _release(self, filename):
+        """
+            Close pooled handles so files can be opened read only, here and in
+            worker processes
+        """
+        pool = getattr(self.cache, 'pool', None)
+        if pool is not None:
+            pool.discard(filename)
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError):
+            return {}
+
+    def _save_manifest(self, manifest):
+        with open(self.manifest_path, 'wb') as f:
+            pickle.dump(manifest, f)
+
+    def manifest(self, refresh=True):
+        """
+            dict of key -> {filename, nrows, start, end, columns, stamp}.
+            start/end are int64 ns, None if the index isn't datetime64.
+        """
+        if self._manifest is not None and not refresh:
+            return self._manifest
+
+        old = self._load_manifest() if self._manifest is None else self._manifest
+        manifest = {}
+        changed = False
+        for key in self.cache.keys():
+            filename = self.cache.get_filename(key)
+            entry = old.get(key)
+            if entry is None or entry.get('stamp') != file_stamp(filename):
+                self._release(filename)
+                entry = partition_stats(filename)
+                changed = True
+            entry['filename'] = filename
+            manifest[key] = entry
+        if changed or set(old) != set(manifest):
+            self._save_manifest(manifest)
+        self._manifest = manifest
+        return manifest
+
+    def keys(self):
+        return sorted(self.manifest())
+
+    @property
+    def nrows(self):
+        return sum(entry['nrows'] for entry in self.manifest().values())
+
+    def prune(self, keys=None, start=None, end=None):
+        """
+            Sorted keys of the partitions that can hold rows for keys and
+            start <= index <= end
+        """
+        lo = None if start is None else _convert_param(start, 'datetime64')
+        hi = None if end is None else _convert_param(end, 'datetime64')
+        manifest = self.manifest()
+        if keys is None:
+            keys = list(manifest.keys())
+        selected = []
+        for key in keys:
+            entry = manifest.get(key)
+            if entry is None or entry['nrows'] == 0:
+                continue
+            if lo is not None and entry['end'] is not None and entry['end'] < lo:
+                continue
+            if hi is not None and entry['start'] is not None and entry['start'] > hi:
+                continue
+            selected.append(key)
+        return sorted(selected)
+
+    def read_frames(self, keys=None, start=None, end=None, columns=None, processes=None):
+        """
+            dict of key -> DataFrame for the partitions that survive pruning
+        """
+        keys = self.prune(keys, start, end)
+        manifest = self.manifest(refresh=False)
+        tasks = [(manifest[key]['filename'], start, end, columns) for key in keys]
+        for task in tasks:
+            self._release(task[0])
+
+        processes = processes or self.processes or mp.cpu_count()
+        processes = min(processes, len(tasks))
+        if processes > 1:
+            pool = mp.Pool(processes)
+            try:
+                frames = pool.map(_read_partition, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            frames = [_read_partition(task) for task in tasks]
+        return dict(zip(keys, frames))
+
+    def read(self, keys=None, start=None, end=None, columns=None, processes=None,
+             panel=False):
+        """
+            Concatenated frame indexed by (key, index). panel=True returns a
+            ColumnPanel of key -> frame instead.
+        """
+        frames = self.read_frames(keys, start, end, columns, processes)
+        if panel:
+            # column_panel imports trtools.io.api
+            from trtools.core.column_panel import ColumnPanel
+            return ColumnPanel(frames)
+        if not frames:
+            return self._empty(columns)
+        keys = sorted(frames)
+        return pd.concat([frames[key] for key in keys], keys=keys)
+
+    def _empty(self, columns=None):
+        """
+            Empty frame with the same (key, index) MultiIndex as a read
+        """
+        if columns is None:
+            entries = list(self.manifest(refresh=False).values())
+            columns = entries[0]['columns'] if entries else []
+        index = pd.MultiIndex(levels=[[], []], labels=[[], []])
+        return pd.DataFrame(columns=columns, index=index)
+
+    def __repr__(self):
+        manifest = self.manifest()
+        return "HDF5Dataset {0}: {1} partitions, {2} rows".format(
+            self.cache.cache_dir, len(manifest), sum(e['nrows'] for e in manifest.values()))
@@ -0,0 +1,126 @@
+"""
+    LRU pool of open pytables File handles.
+
+    Opening an HDF5 file and parsing its metadata costs more than reading a small
+    table from it. The pool keeps recently used handles open so that caches like
+    HDF5FileCache don't pay an open per key.
+"""
+import os.path
+import threading
+from collections import OrderedDict
+
+from tables import openFile
+
+class HandlePool(object):
+    """
+        Bounded LRU pool of open tables.File handles keyed by (path, mode).
+
+        Read requests are served by any open handle for the path. An append
+        request replaces a read only handle. A 'w' request closes whatever is open
+        for the path, truncates the file and keeps the new handle as an append handle.
+        Evicted handles are flushed and closed.
+
+        Handles belong to the pool. Don't close them and don't hold on to them, an
+        eviction will close them under you. Don't share a pool across forked
+        processes.
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._handles = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, filepath, mode='r'):
+        path = os.path.abspath(filepath)
+        if mode == 'r+':
+            mode = 'a'
+
+        with self._lock:
+            if mode == 'w':
+                self._discard_path(path)
+                self.misses += 1
+                return self._add((path, 'a'), openFile(path, 'w'))
+
+            keys = [(path, mode)]
+            if mode == 'r':
+                keys.append((path, 'a'))
+            for key in keys:
+                handle = self._handles.pop(key, None)
+                if handle is None:
+                    continue
+                if not handle.isopen:
+                    continue
+                self.hits += 1
+                self._handles[key] = handle # most recently used
+                return handle
+
+            # an open read only handle would conflict with the append handle
+            self._discard_path(path)
+            self.misses += 1
+            return self._add((path, mode), openFile(path, mode))
+
+    def _add(self, key, handle):
+        self._handles[key] = handle
+        while len(self._handles) > self.maxsize:
+            _, old = self._handles.popitem(last=False)
+            self._close(old)
+            self.evictions += 1
+        return handle
+
+    def _close(self, handle):
+        if not handle.isopen:
+            return
+        if handle.mode != 'r':
+            handle.flush()
+        handle.close()
+
+    def _discard_path(self, path):
+        for key in list(self._handles.keys()):
+            if key[0] == path:
+                self._close(self._handles.pop(key))
+
+    def discard(self, filepath):
+        """
+            Close any handles for filepath. Call before touching the file outside
+            the pool, e.g. deleting it.
+        """
+        with self._lock:
+            self._discard_path(os.path.abspath(filepath))
+
+    def close_all(self):
+        with self._lock:
+            while self._handles:
+                _, handle = self._handles.popitem()
+                self._close(handle)
+
+    def stats(self):
+        total = self.hits + self.misses
+        stats = {}
+        stats['hits'] = self.hits
+        stats['misses'] = self.misses
+        stats['evictions'] = self.evictions
+        stats['size'] = len(self._handles)
+        stats['hit_rate'] = self.hits / float(total) if total else 0.0
+        return stats
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __repr__(self):
+        return "HandlePool(maxsize={0}, {1})".format(self.maxsize, self.stats())
+
+# shared by default across caches
+handle_pool = HandlePool()
+
+def get_pool(pool):
+    """
+        pool param helper. True means the shared handle_pool
+    """
+    if pool is True:
+        return handle_pool
+    # an empty HandlePool is falsy
+    if pool is None or pool is False:
+        return None
+    return pool
@@ -3,29 +3,41 @@ import glob
 
 from trtools.io.filecache import FileCache, _filename, leveled_filename
 from trtools.io.hdf5_grouping import HDFPanel
+from trtools.io.handle_pool import get_pool
+from trtools.io.dataset import HDF5Dataset
 
 class SingleHDF(object):
     """
     Methods for writing each result as it's own hdf
     """
     @staticmethod
-    def put(filename, obj, filters=None):
-        panel = HDFPanel(filename, 'w')
-        with panel.handle:
+    def put(filename, obj, filters=None, pool=None):
+        panel = HDFPanel(filename, 'w', pool=pool)
+        try:
             gr = panel.create_group('data', filters=filters)
             gr['data'] = obj
+            panel.handle.flush()
+        finally:
+            panel.close()
 
     @staticmethod
-    def get(filename):
-        panel = HDFPanel(filename, 'r')
-        with panel.handle:
+    def get(filename, pool=None):
+        panel = HDFPanel(filename, 'r', pool=pool)
+        try:
             gr = panel['data']
             df = gr['data'] 
+        finally:
+            panel.close()
         return df
 
 class HDF5FileCache(FileCache):
-    def __init__(self, cache_dir, filename_func=None, filters=None, *args, **kwargs):
+    def __init__(self, cache_dir, filename_func=None, filters=None, pool=None, *args, **kwargs):
+        """
+            pool : HandlePool or True for the shared handle_pool. Keeps files open
+                between gets/puts.
+        """
         self.filters = filters
+        self.pool = get_pool(pool)
         super(HDF5FileCache, self).__init__(cache_dir, filename_func, *args, **kwargs)
 
     def get_filename(self, name):
@@ -35,15 +47,26 @@ class HDF5FileCache(FileCache):
 
     def put(self, name, obj):
         filename = self.get_filename(name)
-        SingleHDF.put(filename, obj, filters=self.filters)
+        SingleHDF.put(filename, obj, filters=self.filters, pool=self.pool)
 
     def get(self, name):
         filename = self.get_filename(name)
-        return SingleHDF.get(filename)
+        return SingleHDF.get(filename, pool=self.pool)
+
+    def remove(self, name):
+        if self.pool is not None:
+            self.pool.discard(self.get_filename(name))
+        super(HDF5FileCache, self).remove(name)
 
     def keys(self):
         keys = list(super(HDF5FileCache, self).keys())
-        return [filename[:-3] for filename in keys]
+        return [filename[:-3] for filename in keys if filename.endswith('.h5')]
+
+    def dataset(self, processes=None):
+        """
+            HDF5Dataset that reads the cache as one table
+        """
+        return HDF5Dataset(self, processes=processes)
 
 class HDF5LeveledFileCache(HDF5FileCache):
     def __init__(self, cache_dir, length=1, *args, **kwargs):
@@ -65,12 +88,20 @@ class OBTContext(object):
         The idea originally was to have a context that closed handle on exit.
         To minimize possible data corruption. 
     """
-    def __init__(self, filename, frame_key=None, filters=None, expectedrows=None):
+    def __init__(self, filename, frame_key=None, filters=None, expectedrows=None,
+                 buffer_rows=None, buffer_bytes=None):
         self.filename = filename
         self.frame_key = frame_key
         self.filters = filters
         self.hdf = None
         self.expectedrows = expectedrows
+        self.buffer_rows = buffer_rows
+        self.buffer_bytes = buffer_bytes
+        self.obt = None
+
+    @property
+    def buffered(self):
+        return bool(self.buffer_rows or self.buffer_bytes)
 
     def open(self):
         if not (self.hdf and self.hdf.handle.isopen):
@@ -80,24 +111,48 @@ class OBTContext(object):
 
     def __enter__(self):
         hdf = self.open()
+        # keep the same OBTGroup while the file is open so buffered appends survive
+        if self.obt is not None and self.obt.panel is hdf:
+            return self.obt
+
         if not hasattr(hdf.handle.root, 'obt'):
             hdf.create_obt('obt', frame_key=self.frame_key, filters=self.filters, 
                           expectedrows=self.expectedrows)
         obt = hdf['obt']
+        if self.buffered:
+            obt.buffered(max_rows=self.buffer_rows, max_bytes=self.buffer_bytes)
+        self.obt = obt
         return obt
 
+    def flush(self):
+        if self.obt is not None:
+            self.obt.flush()
+
+    def close(self):
+        self.flush()
+        self.obt = None
+        if self.hdf is not None:
+            self.hdf.close()
+
     def __exit__(self, exc_type, exc_value, traceback):
         #self.hdf.handle.close()
         pass
 
 class OBTFileCache(object):
     def __init__(self, cache_file, frame_key=None, filters=None, expectedrows=None, 
-                 append_only=False, *args, **kwargs):
+                 append_only=False, buffer_rows=None, buffer_bytes=None, *args, **kwargs):
+        """
+            buffer_rows, buffer_bytes : opt-in write-behind buffering. Appends are 
+                grouped until either threshold and written in one batch. Call 
+                flush() for a durability point. close() or leaving a with block 
+                also flushes.
+        """
         self.filters = filters
         self.cache_file = cache_file
         self.check_dir()
         self.frame_key = frame_key
-        self.obt_context = OBTContext(self.cache_file, self.frame_key, expectedrows=expectedrows)
+        self.obt_context = OBTContext(self.cache_file, self.frame_key, expectedrows=expectedrows,
+                                      buffer_rows=buffer_rows, buffer_bytes=buffer_bytes)
         self.append_only = append_only
 
     def check_dir(self):
@@ -130,6 +185,22 @@ class OBTFileCache(object):
     def delete_all(self):
         with self.obt_context as obt:
             obt.group._f_remove(recursive=True)
+        self.obt_context.obt = None
+
+    def flush(self):
+        """
+            Write out buffered appends
+        """
+        self.obt_context.flush()
+
+    def close(self):
+        self.obt_context.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     @property
     def sql(self):
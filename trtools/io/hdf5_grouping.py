@@ -1,3 +1,5 @@
+import copy
+
 import numpy as np
 
 import pandas as pd
@@ -5,17 +7,86 @@ import pandas as pd
 from tables import openFile
 
 from trtools.io.pytables import _meta, HDFSql, table_to_frame, frame_to_table, \
-                                _convert_param, HDFQuery, convert_frame
+                                HDFQuery, append_frame, _private_node, \
+                                table_slices_to_frame, frame_keys_to_frames
+from trtools.io.table_indexing import CoordinateCache, FrameKeyDirectory, IndexPolicy, \
+                                      add_index, update_index
+from trtools.io.handle_pool import get_pool
+
+# AppendBuffer defaults
+BUFFER_ROWS = 500000
+BUFFER_BYTES = 128 * 1024 ** 2
+
+def _frame_nbytes(df):
+    """
+        Rough size of a DataFrame. Object columns count as pointers
+    """
+    itemsize = sum(dtype.itemsize for dtype in df.dtypes) + df.index.dtype.itemsize
+    return len(df) * itemsize
+
+class AppendBuffer(object):
+    """
+        Write-behind buffer of DataFrames. Appends are held until max_rows or 
+        max_bytes is reached and then concatenated and handed to write_func in 
+        one call.
+
+        flush() is the durability point. Once it returns everything appended so 
+        far has been written. Used as a context manager it flushes on exit. 
+        Column mismatches are only caught when the buffer is written.
+    """
+    def __init__(self, write_func, max_rows=None, max_bytes=None):
+        self.write_func = write_func
+        self.max_rows = max_rows or BUFFER_ROWS
+        self.max_bytes = max_bytes or BUFFER_BYTES
+        self.frames = []
+        self.rows = 0
+        self.nbytes = 0
+
+    def append(self, df):
+        if len(df) == 0:
+            return
+        self.frames.append(df)
+        self.rows += len(df)
+        self.nbytes += _frame_nbytes(df)
+        if self.rows >= self.max_rows or self.nbytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.frames:
+            return
+        if len(self.frames) == 1:
+            df = self.frames[0]
+        else:
+            df = pd.concat(self.frames)
+        self.write_func(df)
+        self.frames = []
+        self.rows = 0
+        self.nbytes = 0
+
+    def __len__(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
 
 class HDFPanel(object):
     """
         Kind of like HDFStore but restricts it to a group of 
         similar DataFrames. Like panel except not sharing index
     """
-    def __init__(self, filepath, mode='a'):
+    def __init__(self, filepath, mode='a', pool=None):
+        """
+            pool : HandlePool or True for the shared handle_pool. Handles then
+                come from and are returned to the pool instead of being opened
+                and closed here.
+        """
         self.handle = None
         self.filepath = filepath
         self.mode = mode
+        self.pool = get_pool(pool)
         self.handle = self.open(self.mode)
 
     def __getattr__(self, key):
@@ -27,10 +98,14 @@ class HDFPanel(object):
         self.handle = self.open(self.mode)
 
     def open(self, mode="a", warn=True):
+        if self.pool is not None:
+            return self.pool.get(self.filepath, mode)
         self.close()
         return openFile(self.filepath, mode)
 
     def close(self):
+        if self.pool is not None: # pool owns the handle
+            return
         if self.handle is not None and self.handle.isopen:
             self.handle.close()
 
@@ -46,8 +121,8 @@ class HDFPanel(object):
         handle = self.handle
         group = handle.root._f_getChild(group)
 
-        meta = _meta(group)
-        old_meta = meta.copy()
+        old_meta = _meta(group)
+        meta = old_meta.copy()
         meta.update(kwargs)
 
         group_type = meta.setdefault('group_type', 'panel')
@@ -113,7 +188,7 @@ class HDFPanelGroup(object):
         raise AttributeError()
 
     def meta(self):
-        return _meta(self.group)
+        return copy.deepcopy(_meta(self.group))
 
     def get_table(self, name):
         group = self.group
@@ -130,12 +205,14 @@ class HDFPanelGroup(object):
     def get_all(self, start=None, end=None):
         ret = {}
         for node in self.group._f_iterNodes():
+            if _private_node(node._v_name):
+                continue
             df = self._get_data(node, start, end)
             ret[node._v_name] = df
         return ret
 
     def keys(self):
-        return list(self.group._v_children.keys())
+        return [key for key in self.group._v_children.keys() if not _private_node(key)]
 
     def create_table(self, df, name=None, *args, **kwargs):
         filters = self.filters
@@ -148,8 +225,7 @@ class HDFPanelGroup(object):
 
     def _append(self, df, name=None):
         table = self.get_table(name)
-        desc, recs, types = convert_frame(df)
-        table.append(recs)
+        append_frame(table, df)
         table.flush()
 
     def __setitem__(self, key, value):
@@ -170,6 +246,9 @@ class OBTGroup(HDFPanelGroup):
         self.frame_key = frame_key
         self.table_name = table_name
         self._table = None
+        self._coords = None
+        self._directory = None
+        self._buffer = None
         self.copy = copy
         # having this kind of hacky expectedrows pass through is because
         # there isn't an explicit tabel creation step. It does it
@@ -185,53 +264,107 @@ class OBTGroup(HDFPanelGroup):
             value = {'vals': value}
         df = pd.DataFrame(value, index=ind, copy=self.copy) # not liking having to copy
         df[self.frame_key] = key # we copy cuz of this
-        table_name = self.table_name
-        if hasattr(self.group, table_name):
-            self.append(df)
-        else:
-            # to create table we need some data to infer type
-            if len(df) == 0:
-                return
-            table = self.create_table(df, name=table_name, expectedrows=self.expectedrows)
-            self._table = table
+        self.append(df)
 
     def append(self, df):
+        if self._buffer is not None:
+            self._buffer.append(df)
+            return
+        self._write(df)
+
+    def buffered(self, max_rows=None, max_bytes=None):
+        """
+            Turn on write-behind buffering for __setitem__/append. Returns the 
+            AppendBuffer, which flushes on context exit:
+
+                with obt.buffered(max_rows=1000000):
+                    for key, df in results:
+                        obt[key] = df
+        """
+        if self._buffer is None:
+            self._buffer = AppendBuffer(self._write, max_rows=max_rows, max_bytes=max_bytes)
+        return self._buffer
+
+    def flush(self):
+        """
+            Write out anything buffered
+        """
+        if self._buffer is not None:
+            self._buffer.flush()
+
+    def _write(self, df):
         # to create table we need some data to infer type
         if len(df) == 0:
             return
 
         table_name = self.table_name
         if hasattr(self.group, table_name):
+            start = self.table.nrows
             self._append(df, name=table_name)
         else:
+            start = 0
             table = self.create_table(df, name=table_name, expectedrows=self.expectedrows)
             self._table = table
+            self.directory.create()
+        directory = self.directory
+        directory.update(directory.stored_keys(df[self.frame_key].values), start)
 
-    def __getitem__(self, key):
-        # TODO This can be faster if we cache the getWhereList somewhere on disk
+    @property
+    def directory(self):
+        """
+            FrameKeyDirectory of frame_key -> row ranges
+        """
+        if self._directory is None or self._directory.table is not self.table:
+            self._directory = FrameKeyDirectory(self.table, self.frame_key)
+        return self._directory
 
-        key = _convert_param(key)
+    def __getitem__(self, key):
+        self.flush()
         if isinstance(key, HDFQuery):
             return self._getitem_query(key)
         if isinstance(key, slice):
             raise NotImplementedError('TODO work on slicing')
+        if isinstance(key, list):
+            return self.get_many(key)
         return self._getitem_framekey(key)
 
+    def get_many(self, keys):
+        """
+            dict of frame_key -> DataFrame for keys, read in one pass
+        """
+        self.flush()
+        return frame_keys_to_frames(self.table, self.frame_key, keys, 
+                                    directory=self.directory)
+
+    @property
+    def coords(self):
+        if self._coords is None or self._coords.table is not self.table:
+            self._coords = CoordinateCache(self.table)
+        return self._coords
+
     def _getitem_framekey(self, key):
-        where = "{0} == {1}".format(self.frame_key, key)
-        df = table_to_frame(self.table, where=where)
+        rows = self.directory.get(key)
+        if rows is not None:
+            slices = [rows]
+        else:
+            query = getattr(self.sql, self.frame_key) == key
+            slices = self.coords.slices(str(query), terms=query.terms)
+        df = table_slices_to_frame(self.table, slices)
         del df[self.frame_key]
         return df
 
     def _getitem_query(self, query):
-        where = str(query)
-        df = table_to_frame(self.table, where=where)
+        df = table_to_frame(self.table, where=query)
         return df
         # return in a form that's more useful. considering outputting panel
         return df.pivot(df.index, self.frame_key).stack().to_panel()
 
-    def get_all(self):
-        all_df = table_to_frame(self.table)
+    def get_all(self, chunksize=None):
+        """
+            Passing chunksize returns an iterator of DataFrames
+        """
+        self.flush()
+        all_df = table_to_frame(self.table, chunksize=chunksize)
         return all_df
 
     @property
@@ -243,12 +376,16 @@ class OBTGroup(HDFPanelGroup):
 
     @property
     def sql(self):
+        self.flush()
         mappings = {'items' : self.frame_key}
         return HDFSql(self.table, mappings)
 
     def keys(self):
+        self.flush()
+        if self.directory.ranges is not None:
+            return sorted(self.directory.keys())
         data = self.table.col(self.frame_key)
-        return list(np.unique(data))
+        return sorted(self.directory.decode(np.unique(data)))
 
     def __repr__(self):
         return repr(self.table)
@@ -258,27 +395,36 @@ class OBTGroup(HDFPanelGroup):
         return column
 
 
-    def add_index(self, col):
-        column = self.col(col)
-        if not column.is_indexed:
-            print(("Creating Index on {0}".format(col)))
-            num = column.createCSIndex()
-            print(("Index created with {0} vals".format(num)))
-        else:
-            print(("Index already exists {0}. Reindex?".format(col)))
+    def add_index(self, col, kind='full', optlevel=9, verbose=False):
+        return add_index(self.table, col, kind=kind, optlevel=optlevel, verbose=verbose)
 
-    def reindex(self, col):
-        column = self.col(col)
-        if column.is_indexed:
-            print(("Re-indexing on {0}".format(col)))
-            column.reIndex()
-        else:
-            print(("{0} is not indexed".format(col)))
+    def reindex(self, col, force=False, verbose=False):
+        """
+            Update the index of col. Only dirty indexes are rebuilt unless force
+        """
+        return update_index(self.table, col, force=force, verbose=verbose)
 
-    def reindex_all(self):
-        cols = self.table.colnames
+    def reindex_all(self, force=False, verbose=False):
+        table = self.table
+        cols = [col for col in table.colnames if table.colindexed[col]]
         for col in cols:
-            self.reindex(col)
+            self.reindex(col, force=force, verbose=verbose)
+
+    def set_index_policy(self, columns, kind='medium', optlevel=6, mode='lazy', 
+                         threshold=None):
+        """
+            Declare the indexed columns. Indexes are created now and kept up to 
+            date on append (mode='incremental') or before the next query once 
+            threshold rows are unindexed (mode='lazy'). See IndexPolicy
+        """
+        IndexPolicy(self.table).set(columns, kind=kind, optlevel=optlevel, mode=mode, 
+                                    threshold=threshold)
+
+    def index_state(self):
+        """
+            dict of column -> indexed, kind, optlevel, dirty and row coverage
+        """
+        return IndexPolicy(self.table).state()
 
     def index_default(self):
         table_meta = _meta(self.table)
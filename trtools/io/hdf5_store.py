@@ -1,8 +1,11 @@
 import os
 import shutil
 
-from trtools.io.pytables import HDF5Handle, convert_frame, frame_to_table
+from trtools.io.pytables import HDF5Handle, HDF5Table, frame_to_table, MAX_TABLE_COLUMNS
+from trtools.io.result_cache import get_result_cache
 from trtools.io.panda_hdf import OneBigTable, create_obt
+from trtools.io.partitions import PartitionedTable, create_partitioned
+from trtools.io.rollups import Rollup
 
 def hdf_save(obj, filename):
     try:
@@ -22,7 +25,16 @@ class HDFFile(object):
     """
     HDF that stored a single DataFrame
     """
-    def __init__(self, filename, mode='a', expectedrows=None, type=None):
+    def __init__(self, filename, mode='a', expectedrows=None, type=None, categories=None,
+                 max_columns=None, layout=None, partition=None, result_cache=None):
+        """
+            layout : 'rows' for a pytables Table, 'columns' for an array per 
+                column. Only used on create.
+            partition : 'D', 'M' or 'A'. Store the table as per day/month/year
+                partitions. See partitions.PartitionedTable
+            result_cache : cache query and slice results. True for the shared
+                result_cache.ResultCache
+        """
         self.dir = filename
         if os.path.isdir(self.dir) and mode == 'w':
             shutil.rmtree(self.dir)
@@ -32,6 +44,13 @@ class HDFFile(object):
         self.filename = os.path.join(filename, fn)
         self.handle = HDF5Handle(self.filename, mode, type=type)
         self.expectedrows = expectedrows
+        # columns to dictionary encode on create
+        self.categories = categories
+        # wider frames are split into column group tables
+        self.max_columns = max_columns or MAX_TABLE_COLUMNS
+        self.layout = layout
+        self.partition = partition
+        self.result_cache = get_result_cache(result_cache)
 
     _table = None
     @property
@@ -39,20 +58,32 @@ class HDFFile(object):
         if self._table is None and hasattr(self.handle, 'data'):
             if hasattr(self.handle.data, 'data_table'):
                 self._table = self.handle.data.data_table
+                if self._table.meta().get('layout') == 'partitioned':
+                    self._table = PartitionedTable(self._table.group, 
+                                                   expectedrows=self.expectedrows)
+                if isinstance(self._table, HDF5Table) and self.result_cache is not None:
+                    self._table.result_cache = self.result_cache
         return self._table
 
     def create_table(self, df, expectedrows=None, create_only=False):
         expectedrows = expectedrows or self.expectedrows
         group = self.handle.create_group('data')
+        if self.partition:
+            create_partitioned(group.group, 'data_table', df, self.partition,
+                               categories=self.categories)
+            if not create_only:
+                self.table.append(df)
+            return
         group.frame_to_table('data_table', df, expectedrows=expectedrows, 
-                             create_only=create_only)
+                             create_only=create_only, categories=self.categories,
+                             max_columns=self.max_columns, layout=self.layout)
 
     def save(self, obj):
         expectedrows = len(obj)
         self.create_table(obj, expectedrows=expectedrows)
 
     def load(self):
-        return self.handle.data['data_table'][:]
+        return self.table[:]
 
     def __repr__(self):
         return repr(self.handle)
@@ -65,11 +96,33 @@ class HDFFile(object):
             self.create_table(value, create_only=True)
         self.table.append(value, flush=flush)
 
+    def add_rollup(self, freq, spec='ohlc'):
+        """
+            Store bars of the table at freq. They are kept up to date on append.
+            See rollups.Rollup
+        """
+        if not isinstance(self.table, HDF5Table):
+            raise Exception("Rollups need a single table")
+        rollup = Rollup(self.table.table, freq, spec=spec)
+        rollup.create()
+        return rollup
+
+    def rollup(self, freq, start=None, end=None):
+        """
+            Stored bars at freq with start <= bar label <= end
+        """
+        return Rollup(self.table.table, freq).read(start, end)
+
     def close(self):
         self.handle.close()
 
 class OBTFile(object):
-    def __init__(self, filename, mode='a', frame_key=None, expectedrows=None, type=None):
+    def __init__(self, filename, mode='a', frame_key=None, expectedrows=None, type=None,
+                 categories=None):
+        """
+            categories : columns to dictionary encode on create. Pass the 
+                frame_key to make frame_key lookups integer compares.
+        """
         self.filename = filename
         dir = os.path.dirname(filename)
         if not os.path.isdir(dir):
@@ -80,6 +133,7 @@ class OBTFile(object):
         self.frame_key = self.get_frame_key(frame_key)
 
         self.expectedrows = expectedrows
+        self.categories = categories
 
         if self.obt is None and mode == 'r':
             raise Exception("Opening Empty File in mode r")
@@ -103,7 +157,8 @@ class OBTFile(object):
 
     def create_table(self, df, key=None):
         OBT = create_obt(self.handle.root, 'obt', df, self.frame_key,
-                         frame_key_sample=key, expectedrows=self.expectedrows)
+                         frame_key_sample=key, expectedrows=self.expectedrows,
+                         categories=self.categories)
         self._obt = OBT
 
     def close(self):
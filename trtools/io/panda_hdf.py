@@ -1,7 +1,10 @@
 import pandas as pd
 import numpy as np
 
-from trtools.io.pytables import convert_frame, _meta, copy_table_def, SimpleIndexer
+from trtools.io.pytables import _meta, copy_table_def, SimpleIndexer, frame_keys_to_frames
+from trtools.io.table_indexing import FrameKeyDirectory
+from trtools.io.table_sort import external_sort, print_progress
+from trtools.io.rollups import Rollup
 
 class OneBigTable(object):
     """
@@ -12,6 +15,7 @@ class OneBigTable(object):
         meta = self.group.meta()
         self.frame_key = frame_key or meta['frame_key']
         self._table = None
+        self._directory = None
 
     @property
     def table(self):
@@ -41,11 +45,26 @@ class OneBigTable(object):
         if len(df) == 0:
             return
 
+        start = self.table.table.nrows
         self.table.append(df)
+        directory = self.directory
+        directory.update(directory.stored_keys(df[self.frame_key].values), start)
+
+    @property
+    def directory(self):
+        """
+            FrameKeyDirectory of the current table
+        """
+        table = self.table.table
+        if self._directory is None or self._directory.table is not table:
+            self._directory = FrameKeyDirectory(table, self.frame_key)
+        return self._directory
 
     def keys(self):
+        if self.directory.ranges is not None:
+            return sorted(self.directory.keys())
         data = self.table.col(self.frame_key)
-        return list(np.unique(data))
+        return sorted(self.directory.decode(np.unique(data)))
 
     @property
     def index(self):
@@ -68,31 +87,103 @@ class OneBigTable(object):
             return self._getitem_framekey(key)
         if isinstance(key, int):
             return self._getitem_framekey(key)
+        if isinstance(key, list):
+            return self.get_many(key)
         df = self.table[key]
         df.set_index(self.frame_key, append=True, inplace=True)
         return df
 
     def _getitem_framekey(self, key):
-        query = getattr(self.table.sql, self.frame_key) == key
-        df = self.table[query]
+        rows = self.directory.get(key)
+        if rows is not None:
+            df = self.table[rows]
+        else:
+            query = getattr(self.table.sql, self.frame_key) == key
+            df = self.table[query]
         del df[self.frame_key]
         return df
 
+    def get_many(self, keys):
+        """
+            dict of frame_key -> DataFrame for keys, read in one pass
+        """
+        return frame_keys_to_frames(self.table.table, self.frame_key, keys, 
+                                    directory=self.directory)
+
+    def aggregate(self, spec, freq=None, by=None, query=None, chunksize=None):
+        """
+            Grouped aggregate by frame_key, plus by columns and freq buckets.
+            Streams the table so it doesn't need to fit in memory.
+            See HDF5Table.aggregate
+        """
+        if isinstance(by, str):
+            by = [by]
+        by = [self.frame_key] + list(by or [])
+        return self.table.aggregate(spec, by=by, freq=freq, query=query, chunksize=chunksize)
+
+    def ohlc(self, freq='D', query=None, chunksize=None):
+        """
+            open/high/low/close/vol bars per frame_key
+        """
+        return self.aggregate('ohlc', freq=freq, query=query, chunksize=chunksize)
+
+    def add_rollup(self, freq, spec='ohlc'):
+        """
+            Store bars per frame_key at freq. They are kept up to date on append.
+            See rollups.Rollup
+        """
+        rollup = Rollup(self.table.table, freq, by=self.frame_key, spec=spec)
+        rollup.create()
+        return rollup
+
+    def rollup(self, freq, start=None, end=None):
+        """
+            Stored bars at freq indexed by (bar label, frame_key)
+        """
+        df = Rollup(self.table.table, freq).read(start, end)
+        df.set_index(self.frame_key, append=True, inplace=True)
+        return df
+
     def index_default(self):
         table_meta = _meta(self.table)
         index_name = table_meta['index_name']
         self.table.add_index(index_name)
         self.table.add_index(self.frame_key)
 
-    def sort_index(self):
-        df = self.table[:] # getitem returns MultiIndex
-        df = df.sort_index()
+    def sort_index(self, by=None, memory=None, progress=None, verbose=False):
+        """
+            Write a sorted copy of the table to indexed_table. Tables larger than 
+            memory are sorted with an external merge sort. See table_sort.ExternalSort
+
+            by : list of columns to sort by. Defaults to [index, frame_key]. Sorting
+                by frame_key first keeps each frame_key in one block, which lets 
+                lookups use the FrameKeyDirectory. Other orders don't build one.
+            memory : memory budget in bytes
+            progress : callable(phase, done, total, elapsed)
+            verbose : print progress and throughput
+        """
+        if by is None:
+            by = [_meta(self.table)['index_name'], self.frame_key]
+        if verbose and progress is None:
+            progress = print_progress
+
         table = copy_table_def(self.group, 'indexed_table', self.table)
-        table.append(df)
+        directory = FrameKeyDirectory(table.table, self.frame_key)
+        directory.drop()
+        on_write = None
+        if by[0] == self.frame_key:
+            directory.create()
+            def on_write(block, start):
+                directory.update(block[self.frame_key], start)
+
+        stats = external_sort(self.table.table, table.table, by, memory=memory, 
+                              progress=progress, on_write=on_write)
 
         self._table = None
+        return stats
 
-def create_obt(parent, name, df, frame_key, frame_key_sample=None, expectedrows=None):
+def create_obt(parent, name, df, frame_key, frame_key_sample=None, expectedrows=None,
+               categories=None):
     template = df.ix[0:1].copy()
     # default to string frame_eky
     if frame_key_sample is None:
@@ -104,7 +195,9 @@ def create_obt(parent, name, df, frame_key, frame_key_sample=None, expectedrows=
     group = parent.create_group(name, meta=meta) 
     columns=list(template.columns)
 
-    table = group.frame_to_table('obt', template, expectedrows=expectedrows, create_only=True)
+    table = group.frame_to_table('obt', template, expectedrows=expectedrows, create_only=True,
+                                 categories=categories)
+    FrameKeyDirectory(table.table, frame_key).create()
 
     OBT = OneBigTable(group, frame_key)
     return OBT
@@ -0,0 +1,378 @@
+"""
+    Time partitioned tables.
+
+    One logical table stored as a Group of child tables, one per period (day,
+    month or year) of the index. Reads only open the partitions that can hold
+    the rows asked for and old history is dropped by removing whole partitions.
+"""
+import copy
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from trtools.io.pytables import _meta, _terms, _convert_param, frame_to_table, \
+                                HDF5Table, HDFQuery, IndexSlice, SimpleIndexer, \
+                                MismatchColumnsError, READ_CHUNKSIZE
+
+# freq -> number of digits in the partition code
+PARTITION_FREQS = {'D': 8, 'M': 6, 'A': 4}
+
+def period_codes(index, freq):
+    """
+        yyyymmdd, yyyymm or yyyy int code of each index value
+    """
+    if freq == 'D':
+        return index.year * 10000 + index.month * 100 + index.day
+    if freq == 'M':
+        return index.year * 100 + index.month
+    if freq == 'A':
+        return np.asarray(index.year)
+    raise ValueError("Unsupported partition freq {0}".format(freq))
+
+def _partition_name(code):
+    return 'p{0}'.format(code)
+
+def _is_partition(name):
+    return name.startswith('p') and name[1:].isdigit()
+
+def _period_range(code, freq):
+    """
+        [start, end) datetimes of a partition code
+    """
+    if freq == 'D':
+        start = datetime(code // 10000, code // 100 % 100, code % 100)
+        return start, start + pd.DateOffset(days=1)
+    if freq == 'M':
+        year, month = code // 100, code % 100
+        end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+        return datetime(year, month, 1), end
+    return datetime(code, 1, 1), datetime(code + 1, 1, 1)
+
+def _tighter(a, b, pick):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return pick(a, b)
+
+def _index_bounds(terms, index_name):
+    """
+        (lo, hi) inclusive bounds on the index implied by terms. None if open
+    """
+    lo, hi = None, None
+    if terms is None:
+        return lo, hi
+    kind = terms[0]
+    if kind == '&':
+        lo1, hi1 = _index_bounds(terms[1], index_name)
+        lo2, hi2 = _index_bounds(terms[2], index_name)
+        return _tighter(lo1, lo2, max), _tighter(hi1, hi2, min)
+    if kind != 'cmp' or terms[1] != index_name:
+        return lo, hi
+    _, _, op, value = terms
+    if op in ('>', '>=', '=='):
+        lo = value
+    if op in ('<', '<=', '=='):
+        hi = value
+    return lo, hi
+
+def create_partitioned(group, name, df, freq, categories=None):
+    """
+        Create an empty partitioned table for frames like df
+    """
+    if freq not in PARTITION_FREQS:
+        raise ValueError("Unsupported partition freq {0}".format(freq))
+    node = group._v_file.createGroup(group, name)
+    meta = {}
+    meta['layout'] = 'partitioned'
+    meta['freq'] = freq
+    meta['columns'] = list(df.columns)
+    meta['index_name'] = df.index.name or 'pd_index'
+    meta['tz'] = getattr(df.index, 'tz', None) and str(df.index.tz)
+    meta['categories'] = categories
+    _meta(node, meta)
+    # one vocabulary for every partition so category queries can use any
+    # partition's codes
+    node._v_attrs.pd_vocab = '_pd_vocab_' + name
+    return PartitionedTable(node)
+
+class PartitionedTable(object):
+    """
+        Group of per period child tables that reads like a single table. Rows
+        are routed to partitions by their index on append.
+
+        Partitions are kept in time order, so row positions run across them in
+        that order. Within a partition rows are in append order.
+    """
+    def __init__(self, group, filters=None, expectedrows=None):
+        self.group = group
+        self.filters = filters
+        self.expectedrows = expectedrows
+        self._ix = None
+
+    def meta(self):
+        return copy.deepcopy(_meta(self.group))
+
+    @property
+    def freq(self):
+        return _meta(self.group)['freq']
+
+    @property
+    def columns(self):
+        return list(_meta(self.group)['columns'])
+
+    @property
+    def index_name(self):
+        return _meta(self.group)['index_name']
+
+    def keys(self):
+        """
+            partition names in time order
+        """
+        names = [name for name in self.group._v_children if _is_partition(name)]
+        return sorted(names, key=lambda name: int(name[1:]))
+
+    def partition(self, name):
+        return HDF5Table(self.group._v_children[name])
+
+    def _period(self, name):
+        """
+            [start, end) Timestamps of a partition
+        """
+        start, end = _period_range(int(name[1:]), self.freq)
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        tz = _meta(self.group).get('tz')
+        if tz:
+            start, end = start.tz_localize(tz), end.tz_localize(tz)
+        return start, end
+
+    def _bounds(self, name):
+        """
+            [lo, hi) of a partition as int64 ns, the way the index is stored
+        """
+        start, end = self._period(name)
+        return start.value, end.value
+
+    def _parts(self, lo=None, hi=None):
+        """
+            [(name, offset, nrows)] of every partition. Partitions that can't hold
+            index values in [lo, hi] (ns) are left out
+        """
+        parts = []
+        offset = 0
+        for name in self.keys():
+            nrows = self.group._v_children[name].nrows
+            start, end = self._bounds(name)
+            if (lo is None or end > lo) and (hi is None or start <= hi):
+                parts.append((name, offset, nrows))
+            offset += nrows
+        return parts
+
+    @property
+    def nrows(self):
+        return sum(self.group._v_children[name].nrows for name in self.keys())
+
+    def __len__(self):
+        return self.nrows
+
+    def append(self, df, flush=False, chunksize=None):
+        """
+            Route rows to their partitions, creating partitions as needed
+        """
+        if list(df.columns) != self.columns:
+            raise MismatchColumnsError("PartitionedTable and DataFrame columns are not the same {0} vs {1}".format(
+                list(df.columns), self.columns))
+        if len(df) == 0:
+            return
+        codes = np.asarray(period_codes(df.index, self.freq))
+        unique = pd.unique(codes)
+        for code in unique:
+            part = df
+            if len(unique) > 1:
+                part = df[codes == code]
+            name = _partition_name(code)
+            if name in self.group._v_children:
+                self.partition(name).append(part, flush=flush, chunksize=chunksize)
+            else:
+                frame_to_table(name, part, self.group, filters=self.filters,
+                               expectedrows=self.expectedrows, chunksize=chunksize,
+                               categories=_meta(self.group).get('categories'))
+
+    def drop_partition(self, name):
+        """
+            Remove a partition and its bookkeeping nodes
+        """
+        children = self.group._v_children
+        for child in list(children.keys()):
+            if child == name or (child.startswith('_pd_') and child.endswith('_' + name)):
+                children[child]._f_remove(recursive=True)
+
+    def drop_before(self, date):
+        """
+            Retention. Drop every partition that ends on or before date.
+            Returns the dropped partition names
+        """
+        date = _convert_param(date, 'datetime64')
+        dropped = []
+        for name in self.keys():
+            if self._bounds(name)[1] <= date:
+                self.drop_partition(name)
+                dropped.append(name)
+        return dropped
+
+    def _concat(self, frames, columns=None):
+        if not frames:
+            columns = self.columns if columns is None else list(columns)
+            return pd.DataFrame(columns=columns)
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames)
+
+    def read(self, start=None, end=None, columns=None):
+        """
+            Rows with start <= index <= end from the partitions that can hold them
+        """
+        lo = start if start is None else _convert_param(start, 'datetime64')
+        hi = end if end is None else _convert_param(end, 'datetime64')
+        frames = []
+        for name, _, nrows in self._parts(lo, hi):
+            table = self.partition(name)
+            p_lo, p_hi = self._bounds(name)
+            if (lo is None or lo <= p_lo) and (hi is None or hi >= p_hi):
+                rows = slice(0, nrows)
+            else:
+                p_start, p_end = self._period(name)
+                rows = table.index.between(p_start if start is None else start, 
+                                           p_end if end is None else end)
+                rows = slice(rows.start, rows.end)
+            frames.append(self._read_rows(table, rows, columns))
+        return self._concat(frames, columns)
+
+    def _read_rows(self, table, rows, columns=None):
+        if columns is None:
+            return table[rows]
+        return table.ix[rows, list(columns)]
+
+    def _slice(self, key, columns=None):
+        """
+            Positional slice across partitions. Only overlapping partitions are read
+        """
+        start, stop, step = key.indices(self.nrows)
+        if step != 1:
+            return self.select(np.arange(start, stop, step), columns)
+        frames = []
+        for name, offset, nrows in self._parts():
+            lo, hi = max(start - offset, 0), min(stop - offset, nrows)
+            if lo >= hi:
+                continue
+            frames.append(self._read_rows(self.partition(name), slice(lo, hi), columns))
+        return self._concat(frames, columns)
+
+    def query(self, query, columns=None):
+        """
+            Run query on the partitions its index bounds allow
+        """
+        lo, hi = _index_bounds(_terms(query), self.index_name)
+        frames = []
+        for name, _, _ in self._parts(lo, hi):
+            df = self.partition(name).query(query, columns=columns)
+            if len(df):
+                frames.append(df)
+        return self._concat(frames, columns)
+
+    def select(self, rows, columns=None):
+        if isinstance(rows, HDFQuery):
+            return self.query(rows, columns=columns)
+        if isinstance(rows, np.ndarray):
+            if rows.dtype != 'bool':
+                mask = np.zeros(self.nrows, dtype=bool)
+                mask[rows] = True
+                rows = mask
+            frames = []
+            for name, offset, nrows in self._parts():
+                part = rows[offset:offset + nrows]
+                if part.any():
+                    table = self.partition(name)
+                    if columns is None:
+                        frames.append(table[part])
+                    else:
+                        frames.append(table.ix[part, list(columns)])
+            return self._concat(frames, columns)
+        return self._slice(rows, columns)
+
+    def __getitem__(self, key):
+        if isinstance(key, IndexSlice):
+            key = slice(key.start, key.end, key.step)
+        return self.select(key)
+
+    @property
+    def ix(self):
+        if self._ix is None:
+            self._ix = SimpleIndexer(self)
+        return self._ix
+
+    @property
+    def index(self):
+        return PartitionIndex(self)
+
+    @property
+    def sql(self):
+        names = self.keys()
+        if not names:
+            raise Exception("PartitionedTable has no partitions")
+        return self.partition(names[0]).sql
+
+    def iter_frames(self, chunksize=None):
+        """
+            Iterate over partitions in time order, chunksize rows at a time
+        """
+        if chunksize is None:
+            chunksize = READ_CHUNKSIZE
+        for name in self.keys():
+            for df in self.partition(name).iter_frames(chunksize=chunksize):
+                yield df
+
+    def __repr__(self):
+        names = self.keys()
+        return "PartitionedTable {0}: {1} partitions ({2}) {3} rows".format(
+            self.group._v_pathname, len(names), self.freq, self.nrows)
+
+class PartitionIndex(object):
+    """
+        Index of a PartitionedTable. between only looks into the partitions
+        that can hold the dates.
+    """
+    def __init__(self, obj):
+        self.obj = obj
+
+    def between(self, start, end):
+        """
+            Between dates, inclusive. Returns an IndexSlice of row positions
+        """
+        lo = _convert_param(start, 'datetime64')
+        hi = _convert_param(end, 'datetime64')
+        first = last = None
+        for name, offset, nrows in self.obj._parts(lo, hi):
+            rows = self.obj.partition(name).index.between(start, end)
+            if first is None:
+                first = offset + rows.start
+            last = offset + rows.end
+        if first is None:
+            # nothing in range. Every partition starting before lo ends before it
+            before = sum(nrows for _, _, nrows in self.obj._parts(hi=lo))
+            return IndexSlice(before, before)
+        return IndexSlice(first, last)
+
+    @property
+    def _index(self):
+        frames = [self.obj.partition(name).index._index for name in self.obj.keys()]
+        if not frames:
+            return pd.Index([])
+        return frames[0].append(frames[1:])
+
+    def __getattr__(self, key):
+        return getattr(self._index, key)
+
+    def __repr__(self):
+        return repr(self._index)
@@ -0,0 +1,114 @@
+"""
+    Prefetching reader for sequential scans.
+
+    A background thread reads and decodes the next chunks while the consumer
+    works on the current one. PyTables releases the GIL while HDF5 reads and
+    decompresses, so the read time mostly hides behind the consumer's compute.
+"""
+import sys
+import threading
+
+from trtools.compat import queue, reraise
+
+# chunks decoded ahead of the consumer
+PREFETCH_DEPTH = 2
+# how often a blocked reader thread checks for close, in seconds
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+class _Error(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+class PrefetchReader(object):
+    """
+        Iterate over frames with up to depth items read ahead on a thread.
+
+        Errors in the reader are raised in the consumer. Stopping early, via 
+        close(), the with statement, or a break, stops the thread and closes
+        frames. A reader can only be iterated once. The consumer must not use 
+        the same file while iterating, pytables handles are not thread safe.
+    """
+    def __init__(self, frames, depth=None):
+        self.frames = frames
+        self.depth = depth or PREFETCH_DEPTH
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._closed = threading.Event()
+        self._thread = None
+        self._iterated = False
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        # the consumer blocks until _DONE or an _Error, so always post one
+        last = _DONE
+        try:
+            for item in self.frames:
+                if not self._put(item):
+                    return
+        except BaseException:
+            last = _Error(sys.exc_info())
+        finally:
+            self._put(last)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='PrefetchReader')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __iter__(self):
+        if self._iterated or self._closed.is_set():
+            raise ValueError("PrefetchReader is closed or was already iterated")
+        self._iterated = True
+        self.start()
+        return self._iter()
+
+    def _iter(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, _Error):
+                    reraise(*item.exc_info)
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """
+            Stop the reader thread and close frames. Safe to call twice
+        """
+        self._closed.set()
+        if self._thread is not None:
+            # unblock a put and wait for the thread to leave frames
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    pass
+            self._thread.join()
+        close = getattr(self.frames, 'close', None)
+        if close is not None:
+            close()
+        # drop anything read ahead
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,6 +1,8 @@
+import copy
+import time
 import warnings
+import weakref
 from collections import OrderedDict
-from datetime import time
 
 import tables as tb
 import pandas as pd
@@ -10,9 +12,25 @@ import pandas.io.pytables as pdtables
 
 from trtools.compat import izip, pickle
 from trtools.io.common import _filename
-from trtools.io.table_indexing import create_slices
+from trtools.io.table_indexing import create_slices, CoordinateCache, bump_version, \
+                                      invalidate_coords, ZoneMap, compilable, compile_terms, \
+                                      runnable, query_coords, where_coords, isin_coords, \
+                                      plan_reads, eval_terms, term_columns, IndexPolicy, \
+                                      add_index, update_index
+from trtools.io.categories import Vocabulary, column_vocabulary, copy_vocabularies
+from trtools.io.table_agg import TableAggregator
+from trtools.io.prefetch import PrefetchReader
+from trtools.io.result_cache import get_result_cache, invalidate_results
 
 MIN_ITEMSIZE = 10
+# rows converted and appended at a time by append_frame
+WRITE_CHUNKSIZE = 50000
+# rows read at a time by iter_table_frames
+READ_CHUNKSIZE = 100000
+# HDFFile splits wider frames into column group tables. See split_frame_to_table
+MAX_TABLE_COLUMNS = 500
+# default filters for the column layout. See frame_to_columns
+COLUMN_FILTERS = tb.Filters(complevel=5, complib='blosc')
 
 class MismatchColumnsError(Exception):
     pass
@@ -41,12 +59,7 @@ def convert_frame(df):
         sdict[col] = converted
         types[col] = inferred_type
 
-    # create table desc
-    desc = OrderedDict() 
-    for pos, data in enumerate(atoms.items()):
-        k, atom = data
-        col = tb.Col.from_atom(atom, pos=pos) 
-        desc[str(k)] = col
+    desc = _atoms_to_desc(atoms)
 
     # create recarray
     dtypes = [(str(k), v.dtype) for k, v in list(sdict.items())]
@@ -55,12 +68,238 @@ def convert_frame(df):
         recs[str(k)] = v
     return desc, recs, types
 
+def _atoms_to_desc(atoms):
+    """
+        Create a pytable table description from an OrderedDict of Atoms
+    """
+    desc = OrderedDict() 
+    for pos, data in enumerate(atoms.items()):
+        k, atom = data
+        col = tb.Col.from_atom(atom, pos=pos) 
+        desc[str(k)] = col
+    return desc
+
+# inferred types that are always dictionary encoded
+CATEGORY_TYPES = ['unicode', 'categorical']
+
+def frame_description(df, categories=None, dtypes=None):
+    """
+        Input: DataFrame
+        Output: pytable table description and value types
+
+        Unlike convert_frame, values are converted one column at a time and 
+        thrown away, so we never hold a converted copy of the whole frame.
+
+        Columns in categories, and unicode columns, are stored as int32 codes. 
+        See categories.Vocabulary
+
+        dtypes : dict of column -> stored dtype instead of the inferred one, 
+            e.g. to size a string column for values not in df yet
+    """
+    atoms = OrderedDict()
+    types = OrderedDict()
+    categories = categories or []
+    dtypes = dtypes or {}
+
+    index_name = df.index.name or 'pd_index'
+    _, types[index_name], atoms[index_name] = _convert_obj(df.index)
+
+    for col in df.columns:
+        if col in dtypes:
+            _, types[col], _ = _convert_obj(df[col])
+            atoms[col] = tb.Atom.from_dtype(np.dtype(dtypes[col]))
+            continue
+        if col in categories or lib.infer_dtype(df[col]) in CATEGORY_TYPES:
+            types[col], atoms[col] = 'category', tb.Int32Atom()
+            continue
+        _, types[col], atoms[col] = _convert_obj(df[col])
+
+    desc = _atoms_to_desc(atoms)
+    return desc, types
+
+def iter_frame_records(df, dtype, index_name=None, chunksize=None, encoders=None):
+    """
+        Yield pytable compatible record chunks of df with at most chunksize rows.
+
+        The same buffer is reused for every chunk so the records must be consumed
+        (appended) before asking for the next chunk.
+
+        encoders : dict of column -> function(values) returning the stored values.
+            Used for columns that depend on the table, see _encoders.
+    """
+    encoders = encoders or {}
+    if chunksize is None:
+        chunksize = WRITE_CHUNKSIZE
+    index_name = index_name or df.index.name or 'pd_index'
+
+    nrows = len(df)
+    buf = np.empty(min(chunksize, nrows), dtype=dtype)
+    for start in range(0, nrows, chunksize):
+        stop = min(start + chunksize, nrows)
+        recs = buf[:stop - start]
+        recs[str(index_name)] = _convert_obj(df.index[start:stop])[0]
+        for col in df.columns:
+            values = df[col].iloc[start:stop]
+            if col in encoders:
+                recs[str(col)] = encoders[col](values)
+                continue
+            recs[str(col)] = _convert_obj(values)[0]
+        yield recs
+
+def append_frame(table, df, chunksize=None):
+    """
+        Stream a DataFrame into a pytable Table column by column in chunks of
+        rows. Peak memory is about one chunk instead of a full recarray copy.
+        If a chunk fails to convert, the table is truncated back so the append
+        is all or nothing.
+    """
+    _write_frame(table, df, chunksize)
+    _after_append(table)
+
+def _write_frame(table, df, chunksize=None):
+    """
+        The rows part of append_frame, without the bookkeeping of _after_append
+    """
+    index_name = _index_name(table)
+    fields = [str(col) for col in df.columns]
+    fields.insert(0, str(index_name))
+    if sorted(fields) != sorted(table.colnames):
+        raise MismatchColumnsError("Table and DataFrame columns are not the same {0} vs {1}".format(
+            fields, table.colnames))
+
+    encoders = _encoders(table)
+    check_frame_dtypes(df, table.coldtypes, skip=encoders)
+    nrows = table.nrows
+    try:
+        for recs in iter_frame_records(df, table.dtype, index_name, chunksize, encoders):
+            table.append(recs)
+    except:
+        table.flush()
+        table.truncate(nrows)
+        raise
+
+def _after_append(table):
+    """
+        Keep versions, caches, zone maps, indexes and rollups current after rows
+        were appended to table
+    """
+    bump_version(table)
+    invalidate_coords(table)
+    invalidate_results(table)
+    ZoneMap(table).update()
+    IndexPolicy(table).after_append()
+    if not table._v_name.startswith('_pd_'):
+        # rollups import this module
+        from trtools.io.rollups import update_rollups
+        update_rollups(table)
+
+def check_frame_dtypes(df, dtypes, skip=None):
+    """
+        Raise ValueError if a numeric column of df can't be stored in the 
+        column dtypes of an existing table without changing its values, e.g.
+        int64 values over 127 into an int8 column. Wider ints are fine as long
+        as the values fit. Floats can't go into int or bool columns.
+
+        dtypes : dict of column -> stored dtype
+        skip : columns converted by an encoder
+    """
+    skip = skip or {}
+    for col in df.columns:
+        target = dtypes.get(str(col))
+        if target is None or col in skip:
+            continue
+        source = df[col].dtype
+        if source.kind not in 'biuf' or target.kind not in 'biu' \
+           or np.can_cast(source, target):
+            continue
+        if source.kind == 'f' or target.kind == 'b':
+            raise ValueError("Can't store {0} column {1} as {2}".format(source, col, target))
+        values = df[col].values
+        if len(values) == 0:
+            continue
+        info = np.iinfo(target)
+        if values.min() < info.min or values.max() > info.max:
+            raise ValueError("Values of column {0} don't fit its {1} column. Range {2} to {3}".format(
+                col, target, values.min(), values.max()))
+
+def _encoders(table):
+    """
+        Converters for columns whose stored values depend on the table. Category
+        columns encode through their Vocabulary. Legacy 'datetime' columns are 
+        Time64 seconds.
+    """
+    types = _meta(table).get('value_types', {})
+    encoders = {}
+    for col, type in types.items():
+        if type == 'category':
+            encoders[col] = Vocabulary(table, col).encode
+        if type == 'datetime':
+            encoders[col] = _legacy_datetime
+    return encoders
+
+def _legacy_datetime(values):
+    """
+        Old tables stored datetimes as local time seconds in Time64 columns,
+        time.mktime(v.timetuple()) + v.microsecond / 1E6. The local offset 
+        can't change within a minute, so mktime is only called once per 
+        distinct minute and the result is the same to the bit.
+    """
+    ns = pd.DatetimeIndex(np.asarray(values)).asi8
+    minutes = ns - ns % (60 * 10**9)
+    uniq, inverse = np.unique(minutes, return_inverse=True)
+    local = np.array([time.mktime(d.timetuple()) 
+                      for d in pd.DatetimeIndex(uniq).to_pydatetime()], dtype=np.float64)
+    seconds = (ns - minutes) // 10**9
+    micros = (ns % 10**9) // 1000
+    return (local[inverse] + seconds) + micros / 1E6
+
+def _datetime_values(values):
+    """
+        int64 UTC nanoseconds of datetime like values. tz-aware values are 
+        converted to UTC, naive ones are taken as is.
+    """
+    if isinstance(values, pd.DatetimeIndex):
+        return values.asi8
+    values = np.asarray(values)
+    if values.dtype.kind == 'M':
+        return values.astype('M8[ns]').view('i8')
+    return pd.DatetimeIndex(pd.to_datetime(values, utc=True)).asi8
+
+def _tz_name(obj):
+    """
+        Name of the timezone of a datetime like column or index. None if naive
+    """
+    tz = getattr(obj, 'tz', None)
+    if tz is None:
+        try:
+            tz = obj.dt.tz
+        except AttributeError:
+            pass
+    if tz is None and getattr(obj, 'dtype', None) == object and len(obj):
+        tz = getattr(np.asarray(obj)[0], 'tzinfo', None)
+    if tz is None:
+        return None
+    return getattr(tz, 'zone', None) or str(tz)
+
+def frame_tz(df, types):
+    """
+        dict of column -> timezone name for tz-aware datetime columns and index
+    """
+    tz = {}
+    index_name = df.index.name or 'pd_index'
+    if types[index_name] == 'datetime64' and _tz_name(df.index):
+        tz[index_name] = _tz_name(df.index)
+    for col in df.columns:
+        if types[col] == 'datetime64' and _tz_name(df[col]):
+            tz[col] = _tz_name(df[col])
+    return tz
+
 def _convert_obj(obj):
     """
         Convert a series to pytables values and Atom
     """
     if isinstance(obj, pd.DatetimeIndex):
-        converted = obj.asi8
+        converted = _datetime_values(obj)
         return converted, 'datetime64', tb.Int64Atom()
     elif isinstance(obj, pd.PeriodIndex):
         converted = obj.values
@@ -72,9 +311,10 @@ def _convert_obj(obj):
     inferred_type = lib.infer_dtype(obj)
     values = np.asarray(obj)
 
-    if inferred_type == 'datetime64':
-        converted = values.view('i8')
-        return converted, inferred_type, tb.Int64Atom()
+    if inferred_type in ('datetime64', 'datetime'):
+        # python datetimes go through DatetimeIndex too. Stored as UTC ns
+        converted = _datetime_values(obj)
+        return converted, 'datetime64', tb.Int64Atom()
     if inferred_type == 'string':
         # TODO, am I doing this right?
         converted = np.array(list(values), dtype=np.bytes_)
@@ -92,17 +332,19 @@ def _convert_obj(obj):
 
         converted = np.asarray(values, dtype='O')
         return converted, inferred_type, tb.ObjectAtom()
-    elif inferred_type == 'datetime':
-        converted = np.array([(time.mktime(v.timetuple()) +
-                            v.microsecond / 1E6) for v in values],
-                            dtype=np.float64)
-        return converted, inferred_type, tb.Time64Atom()
     elif inferred_type == 'integer':
+        if values.dtype.kind in 'iu': # keep int8/16/32 and uints native
+            return values, inferred_type, tb.Atom.from_dtype(values.dtype)
         converted = np.asarray(values, dtype=np.int64)
         return converted, inferred_type, tb.Int64Atom()
     elif inferred_type == 'floating':
+        if values.dtype == np.float32:
+            return values, inferred_type, tb.Float32Atom()
         converted = np.asarray(values, dtype=np.float64)
         return converted, inferred_type, tb.Float64Atom()
+    elif inferred_type == 'boolean':
+        converted = np.asarray(values, dtype=np.bool_)
+        return converted, inferred_type, tb.BoolAtom()
     raise Exception("Unsupported inferred_type {0} {1}".format(inferred_type, str(values[-5:])))
 
 def _handle(obj):
@@ -114,19 +356,56 @@ def _handle(obj):
     return _wrap(handle)
 
     
+# tables.File -> {(node path, store): meta}. Entries go away with the handle
+_meta_cache = weakref.WeakKeyDictionary()
+
+def _handle_meta_cache(handle):
+    try:
+        return _meta_cache[handle]
+    except KeyError:
+        return _meta_cache.setdefault(handle, {})
+
+def clear_meta_cache(handle=None):
+    """
+        Drop cached meta for handle, or for every handle. Only needed if the meta
+        was changed behind our back, writes through _meta keep the cache current.
+    """
+    if handle is None:
+        _meta_cache.clear()
+        return
+    _meta_cache.pop(_unwrap(handle), None)
+
 def _meta(obj, meta=None):
+    """
+        Get or set the pandas meta of a node. Reads are cached on the open handle
+        so the pickled meta is only decoded once. Returns the cached dict, 
+        callers that change it must copy it first.
+    """
     obj = _unwrap(obj)
 
     if isinstance(obj, tb.file.File):
         obj = obj.root
-        return _meta_file(obj, meta)
+        return _cached_meta(obj, meta, _meta_file)
+
+    if _handle_type(obj._v_file) == 'directory':
+        return _cached_meta(obj, meta, _meta_dir)
 
-    handle = _handle(obj)
-    type = handle.type
-    if type == 'directory':
-        return _meta_dir(obj, meta)
+    return _cached_meta(obj, meta, _meta_file)
 
-    return _meta_file(obj, meta)
+def _handle_type(handle):
+    return _cached_meta(handle.root, None, _meta_file).get('type', 'file')
+
+def _cached_meta(obj, meta, store):
+    cache = _handle_meta_cache(obj._v_file)
+    key = (obj._v_pathname, store)
+    if meta:
+        store(obj, meta)
+        cache[key] = copy.deepcopy(meta)
+        return
+
+    if key not in cache:
+        cache[key] = store(obj, None)
+    return cache[key]
 
 def _meta_file(obj, meta):
     if meta:
@@ -174,9 +453,11 @@ def _name(table):
         name = table._v_name
     return name
 
-def _columns(table):
+def _columns(table, meta=None):
+    if meta is None:
+        meta = _meta(table)
     try:
-        columns = list(_meta(table)['columns'])
+        columns = list(meta['columns'])
     except:
         # assume first is index
         columns = table.colnames[1:]
@@ -187,9 +468,11 @@ def _index_name(obj):
         return _index_name_frame(obj)
     return _index_name_table(obj)
 
-def _index_name_table(table):
+def _index_name_table(table, meta=None):
+    if meta is None:
+        meta = _meta(table)
     try:
-        index_name = _meta(table)['index_name']
+        index_name = meta['index_name']
     except:
         # assume first is index
         index_name = table.colnames[0]
@@ -200,16 +483,30 @@ def _index_name_frame(df):
     index = df.index
 
 
-def unconvert_obj(values, type):
+def _localize(values, tz):
+    return pd.DatetimeIndex(values).tz_localize('UTC').tz_convert(tz)
+
+def unconvert_obj(values, type, tz=None):
     if type == 'datetime64':
-        return values.astype("M8[ns]")
+        values = values.astype("M8[ns]")
+        if tz:
+            return _localize(values, tz)
+        return values
+    if type == 'datetime': # legacy Time64 seconds
+        return np.asarray(pdtables._unconvert_index(values, type))
     if type == 'string':
         return values.astype(np.unicode_)
+    if type == 'boolean':
+        return values.astype(np.bool_)
 
+    # numeric columns come back in their stored dtype
     return values
 
-def unconvert_index(index_values, type):
-    return pdtables._unconvert_index(index_values, type)
+def unconvert_index(index_values, type, tz=None):
+    index = pdtables._unconvert_index(index_values, type)
+    if tz and type == 'datetime64':
+        index = _localize(index, tz)
+    return index
 
 def create_table(group, name, desc, types, filters=None, expectedrows=None, title=None, columns=None, index_name=None, extra_meta=None):
     if title is None:
@@ -231,14 +528,23 @@ def create_table(group, name, desc, types, filters=None, expectedrows=None, titl
 
     return table
 
-def frame_to_table(name, df, group, filters=None, expectedrows=None, create_only=False, *args, **kwargs):
+def frame_to_table(name, df, group, filters=None, expectedrows=None, create_only=False, 
+                   chunksize=None, categories=None, max_columns=None, layout=None, 
+                   *args, **kwargs):
     """
         create_only will create the table but not appending the DF.
         Since the machinery for figuring out a table definition and converting values for
         appending are the same.
+
+        The values are streamed into the table chunksize rows at a time.
+
+        categories : columns to dictionary encode. Unicode columns always are.
+        max_columns : frames wider than this are stored as a group of column 
+            group tables. None never splits. See split_frame_to_table
+        layout : 'rows' (default) for a Table, 'columns' for an array per 
+            column. See frame_to_columns
+        dtypes : column -> stored dtype overrides. See frame_description
     """
-    # TODO: potentially could change this to subset the DF so we don't convert and iterate over all
-    # the values
     hfile = group._v_file
 
     # kind of a kludge to get series to work
@@ -246,20 +552,171 @@ def frame_to_table(name, df, group, filters=None, expectedrows=None, create_only
         series_name = 'vals'
         df = pd.DataFrame({series_name:df}, index=df.index)
 
-    desc, recs, types = convert_frame(df)
+    if layout == 'columns':
+        return frame_to_columns(name, df, group, filters=filters, expectedrows=expectedrows,
+                                create_only=create_only, chunksize=chunksize, 
+                                categories=categories)
+
+    if max_columns and len(df.columns) > max_columns:
+        return split_frame_to_table(name, df, group, max_columns, filters=filters, 
+                                    expectedrows=expectedrows, create_only=create_only,
+                                    chunksize=chunksize, categories=categories)
+
+    dtypes = kwargs.pop('dtypes', None)
+    desc, types = frame_description(df, categories=categories, dtypes=dtypes)
     columns = list(df.columns)
     index_name = df.index.name or 'pd_index'
+    extra_meta = kwargs.pop('extra_meta', None) or {}
+    tz = frame_tz(df, types)
+    if tz:
+        extra_meta['tz'] = tz
     table = create_table(group, name, desc, types, filters=filters, columns=columns,
-                         expectedrows=expectedrows, index_name=index_name,*args, **kwargs)
+                         expectedrows=expectedrows, index_name=index_name, 
+                         extra_meta=extra_meta, *args, **kwargs)
+    for col, type in types.items():
+        if type == 'category':
+            Vocabulary(table, col).create()
     if not create_only:
-        table.append(recs)
+        append_frame(table, df, chunksize=chunksize)
 
     hfile.flush()
+    return table
+
+def split_frame_to_table(name, df, group, max_columns, filters=None, expectedrows=None,
+                         create_only=False, chunksize=None, categories=None):
+    """
+        HDF5 chokes on tables with too many columns. Store df as a Group of 
+        tables cg0, cg1... each holding the index and up to max_columns columns.
+        The layout is kept in the group's pd_meta['column_groups']. 
+
+        Returns the Group. _wrap turns it into a SplitTable
+    """
+    hfile = group._v_file
+    split = hfile.createGroup(group, name)
+    columns = list(df.columns)
+    column_groups = [columns[i:i + max_columns] for i in range(0, len(columns), max_columns)]
+
+    meta = {}
+    meta['columns'] = columns
+    meta['index_name'] = df.index.name or 'pd_index'
+    meta['name'] = name
+    meta['column_groups'] = column_groups
+    _meta(split, meta)
+
+    for i, cols in enumerate(column_groups):
+        frame_to_table(_column_group_name(i), df[cols], split, filters=filters, 
+                       expectedrows=expectedrows, create_only=create_only, 
+                       chunksize=chunksize, categories=categories, max_columns=max_columns)
+    return split
+
+def _column_group_name(i):
+    return 'cg{0}'.format(i)
 
-def table_to_frame(table, where=None):
+def frame_to_columns(name, df, group, filters=None, expectedrows=None, create_only=False,
+                     chunksize=None, categories=None):
+    """
+        Column layout. Store df as a Group with one chunked, compressed EArray 
+        per column plus one for the index, so reading a column only reads its
+        bytes. Values are converted like frame_to_table. 
+
+        Returns the Group. _wrap turns it into a ColumnTable
+    """
+    hfile = group._v_file
+    filters = filters or COLUMN_FILTERS
+    node = hfile.createGroup(group, name)
+
+    desc, types = frame_description(df, categories=categories)
+    index_name = df.index.name or 'pd_index'
+    columns = list(df.columns)
+
+    meta = {}
+    meta['columns'] = columns
+    meta['index_name'] = index_name
+    meta['name'] = name
+    meta['value_types'] = types
+    meta['layout'] = 'columns'
+    tz = frame_tz(df, types)
+    if tz:
+        meta['tz'] = tz
+    _meta(node, meta)
+
+    keys = [index_name] + columns
+    for i, key in enumerate(keys):
+        atom = tb.Atom.from_dtype(np.dtype(desc[str(key)].dtype))
+        hfile.createEArray(node, _column_node_name(i), atom, shape=(0,), filters=filters,
+                           expectedrows=expectedrows or 10000)
+        if types[key] == 'category':
+            Vocabulary(node, key).create()
+
+    if not create_only:
+        append_columns(node, df, chunksize=chunksize)
+    hfile.flush()
+    return node
+
+def _column_node_name(i):
+    """
+        0 is the index, columns follow in order
+    """
+    if i == 0:
+        return 'index'
+    return 'c{0}'.format(i - 1)
+
+def append_columns(node, df, chunksize=None):
+    """
+        Append df to a column layout Group chunksize rows at a time. Every
+        column of a chunk is converted before any is appended, and a failed
+        append truncates the arrays back, so they never end up with 
+        different lengths.
+    """
+    meta = _meta(node)
+    if list(df.columns) != list(meta['columns']):
+        raise MismatchColumnsError("Columns and DataFrame columns are not the same {0} vs {1}".format(
+            list(df.columns), meta['columns']))
+    if chunksize is None:
+        chunksize = WRITE_CHUNKSIZE
+
+    encoders = _encoders(node)
+    keys = [meta['index_name']] + list(df.columns)
+    arrays = [node._v_children[_column_node_name(i)] for i in range(len(keys))]
+    dtypes = dict((str(key), array.atom.dtype) for key, array in zip(keys[1:], arrays[1:]))
+    check_frame_dtypes(df, dtypes, skip=encoders)
+
+    lengths = [array.nrows for array in arrays]
+    try:
+        for start in range(0, len(df), chunksize):
+            stop = min(start + chunksize, len(df))
+            chunk = []
+            for i, key in enumerate(keys):
+                if i == 0:
+                    values = df.index[start:stop]
+                else:
+                    values = df[key].iloc[start:stop]
+                if key in encoders:
+                    chunk.append(encoders[key](values))
+                else:
+                    chunk.append(_convert_obj(values)[0])
+            for array, values in zip(arrays, chunk):
+                array.append(values)
+    except:
+        for array, nrows in zip(arrays, lengths):
+            array.truncate(nrows)
+        raise
+
+def table_to_frame(table, where=None, chunksize=None, columns=None):
     """
         Simple converison of table to DataFrame
+
+        Passing chunksize returns an iterator of DataFrames instead. See 
+        iter_table_frames.
+
+        Passing columns only reads and decodes those columns plus the index.
     """
+    if chunksize is not None:
+        return iter_table_frames(table, where=where, chunksize=chunksize, columns=columns)
+
+    if columns is not None:
+        return _project_frame(table, columns, where=where)
+
     if where:
         try:
             data = table_where(table, where)
@@ -272,6 +729,182 @@ def table_to_frame(table, where=None):
     df = table_data_to_frame(data, table)
     return df
 
+def iter_table_frames(table, where=None, chunksize=None, columns=None):
+    """
+        Yield DataFrames of at most chunksize rows.
+
+        With a where clause the table is scanned chunksize rows at a time, so 
+        chunks can come back smaller and ranges without matches are skipped.
+    """
+    if chunksize is None:
+        chunksize = READ_CHUNKSIZE
+    if where:
+        IndexPolicy(table).refresh()
+
+    nrows = table.nrows
+    for start in range(0, nrows, chunksize):
+        stop = min(start + chunksize, nrows)
+        if columns is not None:
+            df = _project_frame(table, columns, where=where, start=start, stop=stop,
+                                refresh=False)
+            if where and len(df) == 0:
+                continue
+            yield df
+            continue
+
+        if where:
+            try:
+                data = _read_where(table, where, start=start, stop=stop)
+            except Exception as err:
+                raise Exception("readWhere error: {0} {1}".format(where, str(err)))
+            if len(data) == 0:
+                continue
+        else:
+            data = table.read(start, stop)
+
+        yield table_data_to_frame(data, table)
+
+def _project_frame(table, columns, where=None, start=None, stop=None, step=None, coords=None,
+                   refresh=True):
+    columns = list(columns)
+    fields = [_index_name(table)] + columns
+    data = read_table_fields(table, fields, where=where, start=start, stop=stop, 
+                             step=step, coords=coords, refresh=refresh)
+    return table_data_to_frame(data, table, columns=columns)
+
+def read_table_fields(table, fields, where=None, start=None, stop=None, step=None, coords=None,
+                      refresh=True):
+    """
+        Read only fields from table. Returns a dict of field -> values.
+
+        Rows are selected by coords, a where clause, or start/stop/step in that order.
+        When most of the fields are wanted, reading whole records once is cheaper than 
+        a read per field.
+
+        refresh : bring policy indexes up to date before a where. Chunked readers
+            do it once up front and pass False.
+    """
+    fields = [str(field) for field in fields if field is not None]
+    fields = list(OrderedDict.fromkeys(fields)) # dedupe, keep order
+
+    if coords is None and where:
+        if refresh:
+            IndexPolicy(table).refresh()
+        try:
+            if step is None:
+                coords = where_coords(table, str(where), terms=_terms(where), start=start, stop=stop)
+            else:
+                coords = table.getWhereList(str(where), start=start, stop=stop, step=step)
+        except Exception as err:
+            raise Exception("getWhereList error: {0} {1}".format(where, str(err)))
+
+    whole_records = len(fields) * 2 > len(table.colnames)
+
+    if coords is not None:
+        if whole_records:
+            data = table.readCoordinates(coords)
+            return dict((field, data[field]) for field in fields)
+        return dict((field, table.readCoordinates(coords, field=field)) for field in fields)
+
+    if whole_records:
+        data = table.read(start, stop, step)
+        return dict((field, data[field]) for field in fields)
+    return dict((field, table.read(start, stop, step, field=field)) for field in fields)
+
+def read_table_slices(table, slices, fields=None, gap=None):
+    """
+        Read a list of slices from table into one preallocated recarray, or a 
+        dict of field -> values when fields are passed.
+
+        Nearby slices are merged into a single read and the rows between them
+        dropped in memory. See table_indexing.plan_reads for gap.
+    """
+    plan = plan_reads(slices, table.rowsize, gap=gap)
+    total = sum(s.stop - s.start for s in slices if s.stop > s.start)
+
+    if fields is None:
+        out = np.empty(total, dtype=table.dtype)
+    else:
+        fields = [str(field) for field in fields if field is not None]
+        fields = list(OrderedDict.fromkeys(fields))
+        out = dict((field, np.empty(total, dtype=table.coldtypes[field])) for field in fields)
+
+    pos = 0
+    for read, keep in plan:
+        if fields is None:
+            data = table.read(read.start, read.stop)
+        else:
+            data = read_table_fields(table, fields, start=read.start, stop=read.stop)
+        for part in keep:
+            n = part.stop - part.start
+            if fields is None:
+                out[pos:pos + n] = data[part]
+            else:
+                for field in fields:
+                    out[field][pos:pos + n] = data[field][part]
+            pos += n
+    return out
+
+def table_slices_to_frame(table, slices, columns=None, gap=None):
+    """
+        Read a list of slices from table into one DataFrame
+    """
+    if columns is not None:
+        fields = [_index_name(table)] + list(columns)
+        data = read_table_slices(table, slices, fields=fields, gap=gap)
+        return table_data_to_frame(data, table, columns=list(columns))
+
+    data = read_table_slices(table, slices, gap=gap)
+    return table_data_to_frame(data, table)
+
+def frame_keys_to_frames(table, frame_key, keys, directory=None):
+    """
+        Read many frame_keys at once. Returns a dict of key -> DataFrame 
+        without the frame_key column. Missing keys get empty frames.
+
+        With a FrameKeyDirectory the key ranges are read directly. Without one 
+        the frame_key column is scanned once for all keys. Either way the rows 
+        are read with coalesced slices, so a basket costs about the rows it 
+        returns instead of keys * table size.
+    """
+    keys = list(OrderedDict.fromkeys(keys))
+    frames = OrderedDict()
+
+    if directory is not None and directory.ranges is not None:
+        found = []
+        for key in keys:
+            rows = directory.get(key)
+            if rows.stop > rows.start:
+                found.append((rows.start, rows.stop, key))
+        found.sort(key=lambda item: item[0])
+
+        slices = [slice(start, stop) for start, stop, _ in found]
+        df = table_slices_to_frame(table, slices)
+        del df[frame_key]
+
+        offset = 0
+        for start, stop, key in found:
+            frames[key] = df.iloc[offset:offset + stop - start]
+            offset += stop - start
+    else:
+        vocab = column_vocabulary(table, frame_key)
+        if vocab is not None:
+            values = vocab.lookup(keys)
+        else:
+            values = [_bind_param(key) for key in keys]
+        coords = isin_coords(table, frame_key, values)
+        df = table_slices_to_frame(table, create_slices(coords))
+        indices = df.groupby(frame_key).indices
+        del df[frame_key]
+        for key in keys:
+            if key in indices:
+                frames[key] = df.take(indices[key])
+
+    empty = df.iloc[0:0]
+    for key in keys:
+        frames.setdefault(key, empty)
+    return dict(frames)
+
 def copy_table_def(group, name, orig):
     table_meta = _meta(orig)
     desc = orig.description
@@ -280,14 +913,32 @@ def copy_table_def(group, name, orig):
     columns = table_meta['columns']
     expectedrows = orig.nrows
     table = group.create_table(name, desc, types, columns=columns, index_name=index_name, expectedrows=expectedrows)
+    copy_vocabularies(orig, table.table)
+    if 'tz' in table_meta:
+        table.meta('tz', table_meta['tz'])
     return table
 
 
-def table_where(table, where):
+def table_where(table, where, start=None, stop=None):
+    """
+        Optimized Where. where can be a string or an HDFQuery. HDFQuery values
+        are passed as condvars so the compiled condition is reused across values.
+    """
+    IndexPolicy(table).refresh()
+    return _read_where(table, where, start=start, stop=stop)
+
+def _read_where(table, where, start=None, stop=None):
     """
-        Optimized Where
+        table_where without the index refresh, for chunked loops
     """
-    return table.readWhere(where)
+    terms = _terms(where)
+    if compilable(terms):
+        condition, condvars = compile_terms(terms)
+        return table.readWhere(condition, condvars=condvars, start=start, stop=stop)
+    if runnable(terms): # isin
+        coords = query_coords(table, terms, start=start, stop=stop)
+        return table.readCoordinates(coords)
+    return table.readWhere(str(where), start=start, stop=stop)
 
 def get_table_index(table, index_name=None, types=None):
     """
@@ -299,12 +950,13 @@ def get_table_index(table, index_name=None, types=None):
     if index_name is None: #neither passed in or set in meta
         return None
 
+    meta = _meta(table)
     if types is None:
-        meta = _meta(table)
-        types = meta.setdefault('value_types', {})
+        types = meta.get('value_types', {})
+    tz = meta.get('tz', {})
 
     index_values = table.col(index_name)
-    index = unconvert_index(index_values, types[index_name])
+    index = unconvert_index(index_values, types[index_name], tz.get(index_name))
     return index
 
 def _data_names(data):
@@ -319,12 +971,13 @@ def table_data_to_frame(data, table, columns=None):
         Given the pytables.recarray data and the metadata taken from table, 
         create a DataFrame
     """
-    columns = columns or _columns(table)
-    index_name = _index_name(table)
+    meta = _meta(table)
+    columns = columns or _columns(table, meta)
+    index_name = _index_name_table(table, meta)
     name = _name(table)
 
-    meta = _meta(table)
-    types = meta.setdefault('value_types', {})
+    types = meta.get('value_types', {})
+    tz = meta.get('tz', {})
 
     index = None
     if index_name:
@@ -332,7 +985,7 @@ def table_data_to_frame(data, table, columns=None):
             index_values = table.col(index_name)
         else:
             index_values = data[index_name]
-        index = unconvert_index(index_values, types[index_name])
+        index = unconvert_index(index_values, types[index_name], tz.get(index_name))
 
     try:
         columns.remove(index_name)
@@ -343,7 +996,10 @@ def table_data_to_frame(data, table, columns=None):
     for col in columns:
         # recarrays have only str columns
         temp = data[str(col)]
-        temp = unconvert_obj(temp, types[col])
+        if types[col] == 'category':
+            temp = Vocabulary(table, col).decode(temp)
+        else:
+            temp = unconvert_obj(temp, types[col], tz.get(col))
         sdict[col] = temp
 
     df = pd.DataFrame(sdict, columns=columns, index=index)
@@ -354,7 +1010,7 @@ def _convert_param(param, base_type=None):
     """
         A well not thought out function to convert params to the proper base type. 
     """
-    if base_type == 'datetime64' and isinstance(param, str):
+    if base_type == 'datetime64' and not isinstance(param, (int, np.integer, HDFQuery)):
         return pd.Timestamp(param).value
 
     if isinstance(param, str): # quote the string params
@@ -365,6 +1021,22 @@ def _convert_param(param, base_type=None):
 
     return param
 
+def _bind_param(param, base_type=None):
+    """
+        Like _convert_param but returns the value itself instead of its literal.
+        Used for condvars.
+    """
+    if base_type == 'datetime64' and not isinstance(param, (int, np.integer)):
+        return pd.Timestamp(param).value
+
+    if isinstance(param, str):
+        return param.encode('UTF8')
+
+    if isinstance(param, pd.Timestamp):
+        return param.value
+
+    return param
+
 class HDFSql(object):
     """
         HDFSql object. Kept in separate obj so we don't polute __getattr__ on table
@@ -385,7 +1057,10 @@ class HDFSql(object):
         except:
             type = None
 
-        return HDFQuery(key, type)
+        encoder = None
+        if type == 'category':
+            encoder = Vocabulary(_unwrap(self.table), key).code
+        return HDFQuery(key, type, encoder=encoder)
         raise AttributeError("No column")
 
     def get_valid_key(self, key):
@@ -399,17 +1074,62 @@ class HDFSql(object):
         raise AttributeError("No column")
 
 class HDFQuery(object):
+    """
+        terms keeps the structure of the expression for things like zone maps
+        that need more than the string:
+            ('cmp', column, op, value)
+            ('isin', column, values)
+            ('&', left, right) / ('|', left, right)
+            None when unknown
+
+        Values are bound values, not literals. See table_indexing.compile_terms
+    """
 
-    def __init__(self, base, base_type=None):
+    def __init__(self, base, base_type=None, terms=None, encoder=None):
         self.base = base
         self.base_type = base_type
+        self.terms = terms
+        # category columns compare codes
+        self.encoder = encoder
+
+    def _encode(self, other, op):
+        if self.encoder is None or isinstance(other, HDFQuery):
+            return other
+        if op not in ('==', '!='):
+            raise ValueError("Category column {0} only supports == and !=".format(self.base))
+        return self.encoder(other)
 
     def base_op(self, other, op):
         """ quick convert to pytable expression """
-        base = "{0} {1} {2}".format(self.base, op, _convert_param(other, self.base_type))
-        return HDFQuery(base, 'statement')
+        other = self._encode(other, op)
+        param = _convert_param(other, self.base_type)
+        base = "{0} {1} {2}".format(self.base, op, param)
+        terms = None
+        if self.base_type != 'statement' and not isinstance(other, HDFQuery):
+            terms = ('cmp', self.base, op, _bind_param(other, self.base_type))
+        return HDFQuery(base, 'statement', terms=terms)
+
+    def isin(self, values):
+        """
+            Rows where the column is one of values. Indexed columns do an
+            index lookup per value instead of a scan.
+        """
+        values = [self._encode(value, '==') for value in values]
+        params = [_convert_param(value, self.base_type) for value in values]
+        base = " | ".join("({0} == {1})".format(self.base, param) for param in params)
+        if not values:
+            base = "{0} in ()".format(self.base)
+        values = [_bind_param(value, self.base_type) for value in values]
+        return HDFQuery(base, 'statement', terms=('isin', self.base, values))
+
+    def between(self, lo, hi):
+        """
+            lo <= column <= hi
+        """
+        return (self >= lo) & (self <= hi)
 
     __eq__  = lambda self, other: self.base_op(other, "==")
+    __ne__  = lambda self, other: self.base_op(other, "!=")
     __gt__  = lambda self, other: self.base_op(other, ">")
     __ge__  = lambda self, other: self.base_op(other, ">=")
     __lt__  = lambda self, other: self.base_op(other, "<")
@@ -417,15 +1137,24 @@ class HDFQuery(object):
 
     def __and__(self, other):
         base = "({0}) & ({1})".format(self.base, other)
-        return HDFQuery(base)
+        return HDFQuery(base, 'statement', terms=('&', self.terms, _terms(other)))
 
     def __or__(self, other):
         base = "({0}) | ({1})".format(self.base, other)
-        return HDFQuery(base)
+        return HDFQuery(base, 'statement', terms=('|', self.terms, _terms(other)))
 
     def __repr__(self):
         return str(self.base)
 
+def _terms(query):
+    return getattr(query, 'terms', None)
+
+def _private_node(name):
+    """
+        Nodes we keep next to tables for bookkeeping. e.g. coordinate caches
+    """
+    return name.startswith('_pd_')
+
 def hdf5_obj_repr(self, obj):
     cls = self.__class__.__name__
     return "{0}\n\n{1}".format(cls, repr(obj))
@@ -435,10 +1164,10 @@ class HDF5Wrapper(object):
         return hdf5_obj_repr(self, self.obj)
 
     def keys(self):
-        return list(self.obj._v_children.keys())
+        return [key for key in self.obj._v_children.keys() if not _private_node(key)]
 
     def meta(self, key=None, value=None):
-        meta = _meta(self)
+        meta = copy.deepcopy(_meta(self))
         if key and value:
             meta[key] = value
             # store meta
@@ -450,6 +1179,14 @@ class HDF5Wrapper(object):
         return meta
 
 
+def _get_table(obj):
+    """
+        Get the pytables Table from the wrapping objects (HDF5Table, OneBigTable)
+    """
+    while not isinstance(obj, tb.Table):
+        obj = obj.table
+    return obj
+
 def _unwrap(obj):
     if isinstance(obj, HDF5Wrapper):
         return obj.obj
@@ -464,6 +1201,11 @@ def _wrap(obj, parent=None):
     if isinstance(obj, tb.group.RootGroup):
         return HDF5Group(obj, parent)
     if isinstance(obj, tb.Group):
+        meta = _meta(obj)
+        if 'column_groups' in meta:
+            return SplitTable(obj)
+        if meta.get('layout') == 'columns':
+            return ColumnTable(obj)
         return HDF5Group(obj, parent)
     if isinstance(obj, tb.Table):
         return HDF5Table(obj)
@@ -484,7 +1226,7 @@ class HDF5Handle(HDF5Wrapper):
         self.obj = None
         self.obj = self.open(self.mode)
 
-        meta = _meta(self.obj)
+        meta = dict(_meta(self.obj))
         if 'type' in meta:
             assert type is None or meta['type'] == type # these should never mismatch
             type = meta['type']
@@ -501,11 +1243,11 @@ class HDF5Handle(HDF5Wrapper):
         self.filepath = handle.filename
         self.mode = handle.mode
         self.obj = handle
-        meta = _meta(handle)
-        type = meta.setdefault('type', 'file')
-        if self.mode != 'r':
+        meta = dict(_meta(handle))
+        if 'type' not in meta and self.mode != 'r':
+            meta['type'] = 'file'
             _meta(handle, meta)
-        self.type = type
+        self.type = meta.get('type', 'file')
 
     @property
     def handle(self):
@@ -577,7 +1319,8 @@ class HDF5Group(HDF5Wrapper):
 
     def frame_to_table(self, name, df, *args, **kwargs):
         group = self.group
-        frame_to_table(name, df, group, *args, **kwargs)
+        table = frame_to_table(name, df, group, *args, **kwargs)
+        return _wrap(table)
 
     def create_group(self, *args, **kwargs):
         return self.handle.create_group(*args, root=self.obj, **kwargs)
@@ -595,19 +1338,65 @@ class HDF5Group(HDF5Wrapper):
         raise AttributeError()
 
 
+def _row_coords(rows):
+    """
+        int and list row keys as a coordinate array
+    """
+    if isinstance(rows, (int, np.integer, list)):
+        return np.atleast_1d(rows)
+    return rows
+
+def _select_frame(table, rows, columns):
+    """
+        rows of table, reading only the index and columns.
+        rows : HDFQuery, bool/int array, int, list or slice
+    """
+    rows = _row_coords(rows)
+    if isinstance(rows, HDFQuery):
+        return _project_frame(table, columns, where=rows)
+    if isinstance(rows, np.ndarray):
+        if rows.dtype == 'bool':
+            rows = np.nonzero(rows)[0]
+        return _project_frame(table, columns, coords=rows)
+    return _project_frame(table, columns, start=rows.start, stop=rows.stop, step=rows.step)
+
+def _selection_key(rows, columns=None):
+    """
+        Hashable result cache key for a selection. None for selections that 
+        aren't worth hashing, e.g. masks
+    """
+    if isinstance(rows, HDFQuery):
+        key = ('query', str(rows))
+    elif isinstance(rows, slice):
+        key = ('slice', rows.start, rows.stop, rows.step)
+    else:
+        return None
+    if columns is not None:
+        key += (tuple(columns),)
+    return key
+
 class HDF5Table(HDF5Wrapper):
-    def __init__(self, table, mapping=None, cache_index=True):
+    def __init__(self, table, mapping=None, cache_index=True, cache_coords=True,
+                 result_cache=None):
+        """
+            result_cache : ResultCache for query/slice results. True for the 
+                shared result_cache.
+        """
         self.obj = table
         self.mapping = mapping or {}
         self.cache_index = cache_index
+        self.cache_coords = cache_coords
+        self.result_cache = get_result_cache(result_cache)
         self._index = None
         self._ix = None
+        self._coords = None
+        self._zonemap = None
 
     _columns = None
     @property
     def columns(self):
         if self._columns is None:
-            self._columns = _meta(self.table)['columns']
+            self._columns = list(_meta(self.table)['columns'])
         return self._columns
 
     @property
@@ -621,17 +1410,15 @@ class HDF5Table(HDF5Wrapper):
 
         return self._index
 
-    def append(self, data, flush=False):
+    def append(self, data, flush=False, chunksize=None):
         if isinstance(data, pd.DataFrame):
-            self._append_frame(data, flush)
-
-    def _append_frame(self, df, flush=False):
-        desc, recs, types = convert_frame(df)
+            self._append_frame(data, flush, chunksize)
 
+    def _append_frame(self, df, flush=False, chunksize=None):
         if not np.all(df.columns == self.columns):
             raise MismatchColumnsError("HDFTable and DataFrame columns are not the same {0} vs {1}".format(
                 df.columns, self.columns))
-        self.table.append(recs)
+        append_frame(self.table, df, chunksize=chunksize)
         if flush:
             self.table.flush()
 
@@ -642,12 +1429,50 @@ class HDF5Table(HDF5Wrapper):
     def sql(self):
         return HDFSql(self.table, self.mapping)
 
+    @property
+    def coords(self):
+        """
+            CoordinateCache of where -> slices
+        """
+        if self._coords is None:
+            self._coords = CoordinateCache(self.table, zonemap=self.zonemap)
+        return self._coords
+
+    @property
+    def zonemap(self):
+        """
+            ZoneMap of per block min/max stats. None if the table doesn't have one
+        """
+        if self._zonemap is None:
+            zonemap = ZoneMap(self.table)
+            if zonemap.node is None:
+                return None
+            self._zonemap = zonemap
+        return self._zonemap
+
+    def add_zonemap(self, columns, blocksize=None):
+        """
+            Keep per block min/max stats for columns so queries and index.between 
+            can skip blocks. Kept up to date on append.
+        """
+        ZoneMap(self.table).create(columns, blocksize=blocksize)
+        self._zonemap = None
+        self._coords = None
+
+    def _cached(self, selection, compute):
+        if self.result_cache is None:
+            return compute()
+        return self.result_cache.get(self.table, selection, compute)
+
     def __getitem__(self, key):
-        # TODO This can be faster if we cache the getWhereList somewhere on disk
         key = _convert_param(key)
         if isinstance(key, HDFQuery):
             return self.query(key)
+        if isinstance(key, slice):
+            return self._cached(_selection_key(key), lambda: self._getitem(key))
+        return self._getitem(key)
 
+    def _getitem(self, key):
         if isinstance(key, slice):
             data = self.table[key]
             df = table_data_to_frame(data, self.table)
@@ -666,15 +1491,8 @@ class HDF5Table(HDF5Wrapper):
         except:
             pass
 
-    def _getitem_slices(self, key):
-        parts = []
-        for slice in key:
-            part = self.table[slice]
-            parts.append(part)
-
-        data = np.concatenate(parts)
-        df = table_data_to_frame(data, self.table)
-        return df
+    def _getitem_slices(self, key, columns=None):
+        return table_slices_to_frame(self.table, key, columns=columns)
 
     def _getitem_ints(self, key):
         slices = create_slices(key)
@@ -684,10 +1502,68 @@ class HDF5Table(HDF5Wrapper):
         slices = create_slices(key)
         return self._getitem_slices(slices)
 
-    def query(self, query):
-        where = str(query)
-        df = table_to_frame(self.table, where=where)
-        return df
+    def query(self, query, chunksize=None, columns=None):
+        """
+            Matching coordinates are cached on disk as slices unless cache_coords
+            is False. Repeated queries become slice reads.
+        """
+        if chunksize is None:
+            return self._cached(_selection_key(query, columns), 
+                                lambda: self._query(query, columns=columns))
+        return table_to_frame(self.table, where=query, chunksize=chunksize, columns=columns)
+
+    def _query(self, query, columns=None):
+        if self.cache_coords:
+            slices = self.coords.slices(str(query), terms=_terms(query))
+            return self._getitem_slices(slices, columns=columns)
+        return table_to_frame(self.table, where=query, columns=columns)
+
+    def select(self, rows, columns=None):
+        """
+            rows and only the index plus columns. Used by ix[rows, columns]
+        """
+        if columns is None:
+            return self[rows]
+        rows = _row_coords(rows)
+        return self._cached(_selection_key(rows, columns), 
+                            lambda: _select_frame(self.table, rows, columns))
+
+    def iter_frames(self, chunksize=None):
+        """
+            Iterate over the whole table chunksize rows at a time
+        """
+        return iter_table_frames(self.table, chunksize=chunksize)
+
+    def prefetch(self, chunksize=None, depth=None, query=None, columns=None):
+        """
+            iter_frames that reads up to depth chunks ahead on a background
+            thread. Use as a with block or iterate to the end to stop the thread.
+
+            with table.prefetch(chunksize=100000) as reader:
+                for df in reader:
+                    ...
+        """
+        frames = iter_table_frames(self.table, where=query, chunksize=chunksize, 
+                                   columns=columns)
+        return PrefetchReader(frames, depth=depth)
+
+    def aggregate(self, spec, by=None, freq=None, query=None, chunksize=None, 
+                  closed=None, label=None):
+        """
+            Grouped aggregate that streams the table chunksize rows at a time.
+            Only the columns the aggregate uses are read.
+
+            spec : 'ohlc' or dict of column -> func(s). 
+                sum, count, mean, min, max, first, last
+            by : column(s) to group by
+            freq : bucket the index by a fixed freq, e.g. '5min', 'D'
+        """
+        agg = TableAggregator(spec, by=by, freq=freq, closed=closed, label=label)
+        frames = iter_table_frames(self.table, where=query, chunksize=chunksize, 
+                                   columns=agg.columns)
+        for df in frames:
+            agg.update(df)
+        return agg.result()
 
     def __getattr__(self, key):
         if hasattr(self.obj, key):
@@ -702,32 +1578,387 @@ class HDF5Table(HDF5Wrapper):
             self._ix = SimpleIndexer(self)
         return self._ix     
 
-    def add_index(self, col):
-        column = self.col(col)
-        if not column.is_indexed:
-            print(("Creating Index on {0}".format(col)))
-            num = column.createCSIndex()
-            print(("Index created with {0} vals".format(num)))
-        else:
-            print(("Index already exists {0}. Reindex?".format(col)))
+    def add_index(self, col, kind='full', optlevel=9, verbose=False):
+        return add_index(self.table, col, kind=kind, optlevel=optlevel, verbose=verbose)
 
-    def reindex(self, col):
-        column = self.col(col)
-        if column.is_indexed:
-            print(("Re-indexing on {0}".format(col)))
-            column.reIndex()
-        else:
-            print(("{0} is not indexed".format(col)))
+    def reindex(self, col, force=False, verbose=False):
+        """
+            Update the index of col. Only dirty indexes are rebuilt unless force
+        """
+        return update_index(self.table, col, force=force, verbose=verbose)
 
-    def reindex_all(self):
-        cols = self.table.colnames
+    def reindex_all(self, force=False, verbose=False):
+        table = self.table
+        cols = [col for col in table.colnames if table.colindexed[col]]
         for col in cols:
-            self.reindex(col)
+            self.reindex(col, force=force, verbose=verbose)
+
+    def set_index_policy(self, columns, kind='medium', optlevel=6, mode='lazy', 
+                         threshold=None):
+        """
+            Declare the indexed columns. Indexes are created now and kept up to 
+            date on append (mode='incremental') or before the next query once 
+            threshold rows are unindexed (mode='lazy'). See IndexPolicy
+        """
+        IndexPolicy(self.table).set(columns, kind=kind, optlevel=optlevel, mode=mode, 
+                                    threshold=threshold)
+
+    def index_state(self):
+        """
+            dict of column -> indexed, kind, optlevel, dirty and row coverage
+        """
+        return IndexPolicy(self.table).state()
+
+class SplitTable(HDF5Wrapper):
+    """
+        A wide frame stored as column group tables by split_frame_to_table. 
+        Looks like an HDF5Table. Reads only touch the tables holding the 
+        columns asked for.
+    """
+    zonemap = None
+
+    def __init__(self, group):
+        self.obj = group
+        self._ix = None
+        self._index = None
+
+    @property
+    def group(self):
+        return self.obj
+
+    @property
+    def columns(self):
+        return list(_meta(self.obj)['columns'])
+
+    @property
+    def column_groups(self):
+        return _meta(self.obj)['column_groups']
+
+    @property
+    def tables(self):
+        children = self.obj._v_children
+        return [children[_column_group_name(i)] for i in range(len(self.column_groups))]
+
+    @property
+    def table(self):
+        """
+            First column group. Every table has the index
+        """
+        return self.tables[0]
+
+    @property
+    def nrows(self):
+        return self.table.nrows
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = CachingIndex(self)
+        return self._index
+
+    @property
+    def sql(self):
+        return SplitSql(self)
+
+    @property
+    def ix(self):
+        if self._ix is None:
+            self._ix = SimpleIndexer(self)
+        return self._ix
+
+    def keys(self):
+        return self.columns
+
+    def _tables_for(self, columns=None):
+        """
+            [(table, columns)] of the column groups holding columns
+        """
+        wanted = None
+        if columns is not None:
+            wanted = set(columns)
+        parts = []
+        for table, cols in zip(self.tables, self.column_groups):
+            if wanted is not None:
+                cols = [col for col in cols if col in wanted]
+            if cols:
+                parts.append((table, cols))
+        return parts
+
+    def read(self, columns=None, start=None, stop=None, step=None, coords=None, slices=None):
+        """
+            Read rows by start/stop/step, coords or slices into one DataFrame
+        """
+        columns = self.columns if columns is None else list(columns)
+        groups = self._tables_for(columns)
+        if not groups: # index only
+            groups = [(self.table, self.column_groups[0][:1])]
+        parts = []
+        for table, cols in groups:
+            if slices is not None:
+                part = table_slices_to_frame(table, slices, columns=cols)
+            else:
+                part = _project_frame(table, cols, start=start, stop=stop, step=step, 
+                                      coords=coords)
+            parts.append(part)
+
+        index = parts[0].index
+        for part in parts[1:]:
+            part.index = index
+        df = pd.concat(parts, axis=1)
+        if list(df.columns) != columns:
+            df = df.reindex(columns=columns)
+        df.name = _meta(self.obj).get('name')
+        return df
+
+    def where_list(self, query):
+        """
+            Coordinates matching query, evaluated on the column group holding 
+            its columns
+        """
+        wanted = term_columns(_terms(query))
+        for table, cols in zip(self.tables, self.column_groups):
+            if wanted is not None:
+                if wanted.issubset(set(cols) | set(table.colnames)):
+                    IndexPolicy(table).refresh()
+                    return where_coords(table, str(query), terms=_terms(query))
+                continue
+            try:
+                return table.getWhereList(str(query), sort=True)
+            except NameError: # column lives in another group
+                continue
+        raise ValueError("Query {0} spans column groups".format(query))
+
+    def select(self, rows, columns=None):
+        """
+            rows : HDFQuery, bool/int array or slice
+        """
+        if isinstance(rows, HDFQuery):
+            return self.query(rows, columns=columns)
+        if isinstance(rows, np.ndarray):
+            return self.read(columns, slices=create_slices(rows))
+        return self.read(columns, start=rows.start, stop=rows.stop, step=rows.step)
+
+    def query(self, query, columns=None):
+        coords = self.where_list(query)
+        return self.read(columns, slices=create_slices(coords))
+
+    def __getitem__(self, key):
+        key = _convert_param(key)
+        if isinstance(key, (HDFQuery, slice, np.ndarray)):
+            return self.select(key)
+        # list of slices
+        return self.read(slices=key)
+
+    def append(self, data, flush=False, chunksize=None):
+        df = data
+        if list(df.columns) != self.columns:
+            raise MismatchColumnsError("SplitTable and DataFrame columns are not the same {0} vs {1}".format(
+                df.columns, self.columns))
+        # every group is written before any bookkeeping, a failure truncates
+        # them all back so they keep the same rows
+        parts = self._tables_for()
+        starts = [table.nrows for table, cols in parts]
+        try:
+            for table, cols in parts:
+                _write_frame(table, df[cols], chunksize=chunksize)
+        except:
+            for (table, cols), nrows in zip(parts, starts):
+                table.flush()
+                table.truncate(nrows)
+            raise
+
+        for table, cols in parts:
+            _after_append(table)
+            if flush:
+                table.flush()
+
+    def iter_frames(self, chunksize=None, columns=None):
+        if chunksize is None:
+            chunksize = READ_CHUNKSIZE
+        nrows = self.nrows
+        for start in range(0, nrows, chunksize):
+            yield self.read(columns, start=start, stop=min(start + chunksize, nrows))
+
+    def __repr__(self):
+        return "SplitTable {0}: {1} columns in {2} tables, {3} rows".format(
+            self.obj._v_pathname, len(self.columns), len(self.column_groups), self.nrows)
+
+class ColumnTable(HDF5Wrapper):
+    """
+        Column layout written by frame_to_columns. Looks like an HDF5Table but 
+        every column is its own EArray, so reads only touch the columns asked 
+        for. Queries read the columns they reference a chunk at a time.
+    """
+    zonemap = None
+
+    def __init__(self, group):
+        self.obj = group
+        self._ix = None
+        self._index = None
+
+    @property
+    def group(self):
+        return self.obj
+
+    @property
+    def table(self):
+        # CachingIndex and HDFSql only need meta, col and colnames
+        return self
+
+    @property
+    def columns(self):
+        return list(_meta(self.obj)['columns'])
+
+    @property
+    def index_name(self):
+        return _meta(self.obj)['index_name']
+
+    @property
+    def colnames(self):
+        return [self.index_name] + self.columns
+
+    @property
+    def nrows(self):
+        return self.obj._v_children['index'].nrows
+
+    def _array(self, key):
+        return self.obj._v_children[_column_node_name(self.colnames.index(key))]
+
+    def col(self, key):
+        """
+            stored values of a column
+        """
+        return self._array(key).read()
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = CachingIndex(self)
+        return self._index
+
+    @property
+    def sql(self):
+        return HDFSql(self)
+
+    @property
+    def ix(self):
+        if self._ix is None:
+            self._ix = SimpleIndexer(self)
+        return self._ix
+
+    def keys(self):
+        return self.columns
+
+    def _read_array(self, array, start=None, stop=None, step=None, slices=None):
+        if slices is None:
+            return array[slice(start, stop, step)]
+        out = np.empty(sum(s.stop - s.start for s in slices), dtype=array.atom.dtype)
+        pos = 0
+        for read, keep in plan_reads(slices, array.atom.itemsize):
+            data = array[read.start:read.stop]
+            for part in keep:
+                n = part.stop - part.start
+                out[pos:pos + n] = data[part]
+                pos += n
+        return out
+
+    def read(self, columns=None, start=None, stop=None, step=None, slices=None):
+        """
+            Read rows by start/stop/step or slices. Only the index and columns
+            are read.
+        """
+        columns = self.columns if columns is None else list(columns)
+        data = {}
+        for key in [self.index_name] + columns:
+            data[str(key)] = self._read_array(self._array(key), start, stop, step, slices)
+        df = table_data_to_frame(data, self.obj, columns=list(columns))
+        df.name = _meta(self.obj).get('name')
+        return df
+
+    def where_list(self, query, chunksize=None):
+        """
+            Coordinates matching query. Only the columns it references are read
+        """
+        if chunksize is None:
+            chunksize = READ_CHUNKSIZE
+        terms = _terms(query)
+        keys = term_columns(terms)
+        if keys is None:
+            raise ValueError("ColumnTable can only run HDFQuery queries")
+
+        nrows = self.nrows
+        parts = []
+        for start in range(0, nrows, chunksize):
+            stop = min(start + chunksize, nrows)
+            data = dict((key, self._array(key)[start:stop]) for key in keys)
+            parts.append(np.nonzero(eval_terms(terms, data))[0] + start)
+        if not parts:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(parts)
+
+    def select(self, rows, columns=None):
+        """
+            rows : HDFQuery, bool/int array or slice
+        """
+        if isinstance(rows, HDFQuery):
+            return self.query(rows, columns=columns)
+        if isinstance(rows, np.ndarray):
+            return self.read(columns, slices=create_slices(rows))
+        return self.read(columns, start=rows.start, stop=rows.stop, step=rows.step)
+
+    def query(self, query, columns=None):
+        coords = self.where_list(query)
+        return self.read(columns, slices=create_slices(coords))
+
+    def __getitem__(self, key):
+        key = _convert_param(key)
+        if isinstance(key, (HDFQuery, slice, np.ndarray)):
+            return self.select(key)
+        # list of slices
+        return self.read(slices=key)
+
+    def append(self, data, flush=False, chunksize=None):
+        append_columns(self.obj, data, chunksize=chunksize)
+        if flush:
+            self.obj._v_file.flush()
+
+    def iter_frames(self, chunksize=None, columns=None):
+        if chunksize is None:
+            chunksize = READ_CHUNKSIZE
+        nrows = self.nrows
+        for start in range(0, nrows, chunksize):
+            yield self.read(columns, start=start, stop=min(start + chunksize, nrows))
+
+    def __repr__(self):
+        return "ColumnTable {0}: {1} columns, {2} rows".format(
+            self.obj._v_pathname, len(self.columns), self.nrows)
+
+class SplitSql(object):
+    """
+        HDFSql over the column groups of a SplitTable
+    """
+    def __init__(self, split):
+        self.split = split
+
+    def __getattr__(self, key):
+        for table in self.split.tables:
+            try:
+                return getattr(HDFSql(table), key)
+            except AttributeError:
+                continue
+        raise AttributeError("No column")
 
 class CachingIndex(object):
     def __init__(self, obj):
         self.obj = obj
-        self._index = get_table_index(obj.table)
+        self._values = None
+
+    @property
+    def _index(self):
+        # loaded on first use so between can get by with the zone map
+        if self._values is None:
+            self._values = get_table_index(self.obj.table)
+        return self._values
 
     def __getattr__(self, key):
         if hasattr(self._index, key):
@@ -757,12 +1988,24 @@ class CachingIndex(object):
         return repr(self._index)
 
     def refresh(self):
-        self._index = get_table_index(self.obj.table)
+        self._values = None
 
     def between(self, start, end):
         """
             Between dates, inclusive
+
+            If the index is in the table's zone map and not loaded yet, only the
+            blocks that can hold start..end are read.
         """
+        table = self.obj.table
+        index_name = _index_name(table)
+        zonemap = self.obj.zonemap
+        if self._values is None and zonemap is not None and index_name in zonemap.columns:
+            start = _convert_param(start, _meta(table)['value_types'][index_name])
+            end = _convert_param(end, _meta(table)['value_types'][index_name])
+            first, last = zonemap.index_range(index_name, start, end)
+            return IndexSlice(first, last)
+
         if isinstance(self._index, pd.DatetimeIndex):
             start = pd.Timestamp(start)
             end = pd.Timestamp(end)
@@ -783,25 +2026,22 @@ class SimpleIndexer(object):
         return self.obj[key]
 
     def _getitem_tuple(self, key):
-        # TODO check if this is faster than just grabbing the whole
+        """
+            Only the requested columns and the index are read from the table
+        """
         rows = key[0]
         if isinstance(rows, IndexSlice):
             rows = slice(rows.start, rows.end, rows.step)
 
+        rows = _row_coords(rows)
+
         cols = key[1]
         if isinstance(cols, str):
             cols = [cols]
 
-        # grabbing the straight data. obj is an HDF5Table. obj.obj is table.Table
-        if len(cols) > 1:
-            data = self.obj.obj[rows]
-        else:
-            # this doesn't seem to be all that much faster, keeping in anyways
-            data = {}
-            col = cols[0]
-            data[col] = self.obj.obj.col(col)
-
-        return table_data_to_frame(data, self.obj, columns=cols)
+        if hasattr(self.obj, 'select'): # HDF5Table, SplitTable, ColumnTable, PartitionedTable
+            return self.obj.select(rows, cols)
+        return _select_frame(_get_table(self.obj), rows, cols)
 
 class IndexSlice(object):
     def __init__(self, start=None, end=None, step=None):
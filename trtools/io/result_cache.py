@@ -0,0 +1,148 @@
+"""
+    In-process LRU cache of query results.
+
+    Entries are keyed by (file, node path, selection, table_stamp), so a table
+    changed behind our back simply misses. Appends through append_frame also
+    drop the table's entries so they don't hold on to memory.
+"""
+import os.path
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+from trtools.io.table_indexing import table_stamp
+
+# default byte budget of the shared cache
+RESULT_CACHE_BYTES = 256 * 1024 ** 2
+
+# every live ResultCache, so appends can invalidate them all
+_caches = weakref.WeakSet()
+
+def frame_nbytes(df):
+    """
+        Approximate memory held by a DataFrame. Object columns only count
+        their pointers on pandas without memory_usage(deep=True)
+    """
+    try:
+        return int(df.memory_usage(index=True, deep=True).sum())
+    except (AttributeError, TypeError):
+        nbytes = np.asarray(df.index).nbytes
+        for col in df.columns:
+            nbytes += np.asarray(df[col]).nbytes
+        return int(nbytes)
+
+def _node_key(table):
+    return (os.path.abspath(table._v_file.filename), table._v_pathname)
+
+class ResultCache(object):
+    """
+        Byte bounded LRU cache of DataFrames. Callers always get copies.
+
+        Results bigger than maxbytes are never cached.
+    """
+    def __init__(self, maxbytes=None):
+        self.maxbytes = RESULT_CACHE_BYTES if maxbytes is None else maxbytes
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved = 0.0 # seconds of reads skipped by hits
+        _caches.add(self)
+
+    def get(self, table, selection, compute):
+        """
+            Cached result of compute() for selection on table. selection must
+            be hashable. None means don't cache.
+        """
+        if selection is None or self.maxbytes <= 0:
+            return compute()
+
+        key = _node_key(table) + (selection, table_stamp(table))
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry # most recently used
+                self.hits += 1
+                self.saved += entry[2]
+                return entry[0].copy()
+            self.misses += 1
+
+        start = time.time()
+        df = compute()
+        elapsed = time.time() - start
+
+        nbytes = frame_nbytes(df)
+        if nbytes <= self.maxbytes:
+            with self._lock:
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self.nbytes -= old[1]
+                self._entries[key] = (df.copy(), nbytes, elapsed)
+                self.nbytes += nbytes
+                self._evict()
+        return df
+
+    def _evict(self):
+        while self.nbytes > self.maxbytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self.nbytes -= entry[1]
+            self.evictions += 1
+
+    def invalidate(self, table):
+        """
+            Drop every entry for table
+        """
+        node = _node_key(table)
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if key[:2] == node:
+                    self.nbytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        stats = {}
+        stats['hits'] = self.hits
+        stats['misses'] = self.misses
+        stats['evictions'] = self.evictions
+        stats['size'] = len(self._entries)
+        stats['nbytes'] = self.nbytes
+        stats['saved_seconds'] = self.saved
+        stats['hit_rate'] = self.hits / float(total) if total else 0.0
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "ResultCache(maxbytes={0}, {1})".format(self.maxbytes, self.stats())
+
+# shared by tables that ask for result_cache=True
+result_cache = ResultCache()
+
+def get_result_cache(cache):
+    """
+        result_cache param helper. True means the shared result_cache
+    """
+    if cache is True:
+        return result_cache
+    # an empty ResultCache is falsy
+    if cache is None or cache is False:
+        return None
+    return cache
+
+def invalidate_results(table):
+    """
+        Drop table's entries from every ResultCache
+    """
+    for cache in list(_caches):
+        cache.invalidate(table)
@@ -0,0 +1,320 @@
+"""
+    Materialized downsampled rollups of a table.
+
+    A rollup is a table of bars stored next to the base table as
+    _pd_rollup_<freq>_<table name>. Bars use the cython_ohlc semantics: open
+    first, high max, low min, close last, vol sum. On update only the base rows
+    appended since the last update are aggregated. Their first bar per key is
+    merged into the trailing (still open) bar already stored and the rest are
+    appended, so existing bars are never recomputed.
+
+    Every rollup is computed from the base rows. Chaining 5min -> 1h -> D would
+    mix the right closed intraday bins with left closed daily bins.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import tables as tb
+
+from pandas.tseries.frequencies import to_offset
+
+from trtools.io.pytables import _index_name, _encoders, _project_frame, _convert_obj, \
+                                frame_to_table, append_frame, iter_frame_records, HDF5Table, \
+                                READ_CHUNKSIZE
+from trtools.io.table_agg import TableAggregator, MERGE_FUNCS, _parse_spec
+from trtools.io.table_indexing import bump_version, invalidate_coords
+from trtools.io.categories import column_vocabulary
+from trtools.io.result_cache import invalidate_results
+
+ROLLUP_PREFIX = '_pd_rollup_'
+TRAILING_PREFIX = '_pd_trailing_'
+
+def _freq_code(freq):
+    return ''.join(c for c in to_offset(freq).freqstr if c.isalnum())
+
+def rollup_name(table, freq):
+    return '{0}{1}_{2}'.format(ROLLUP_PREFIX, _freq_code(freq), table._v_name)
+
+def table_rollups(table):
+    """
+        Rollup tables of table
+    """
+    rollups = []
+    for name, node in table._v_parent._v_children.items():
+        if not name.startswith(ROLLUP_PREFIX):
+            continue
+        freq = node._v_attrs.pd_rollup['freq']
+        # the suffix alone can't tell table from data_table
+        if name == rollup_name(table, freq):
+            rollups.append(Rollup(table, freq))
+    return rollups
+
+def update_rollups(table):
+    """
+        Bring every rollup of table up to date. append_frame calls this, so 
+        every append through HDF5Table, OBTs or buffers keeps them current.
+    """
+    for rollup in table_rollups(table):
+        rollup.update()
+
+def _merge_bar(stored, bar, outputs):
+    """
+        Fold bar into the stored bar. stored came first
+    """
+    merged = stored.copy()
+    for out, _, func in outputs:
+        old, new = stored[out], bar[out]
+        kind = MERGE_FUNCS[func]
+        if kind == 'first':
+            value = new if pd.isnull(old) else old
+        elif kind == 'last':
+            value = old if pd.isnull(new) else new
+        elif kind == 'max':
+            value = np.fmax(old, new)
+        elif kind == 'min':
+            value = np.fmin(old, new)
+        else: # sum
+            value = np.nansum([old, new])
+        merged[out] = value
+    return merged
+
+class Rollup(object):
+    """
+        Downsampled bars of table at freq. Bars are grouped by the by columns
+        too, e.g. the frame_key of an OBT.
+
+        The row and bucket of every key's trailing bar are kept in the 
+        _pd_trailing_<rollup name> Table, one row per key, like the 
+        FrameKeyDirectory. Keys are stored the way the rollup stores its by 
+        columns.
+    """
+    def __init__(self, table, freq, by=None, spec='ohlc'):
+        self.table = table
+        self.freq = freq
+        self.name = rollup_name(table, freq)
+        if self.node is not None:
+            settings = self.settings
+            by, spec = settings['by'], settings['spec']
+        if isinstance(by, str):
+            by = [by]
+        self.by = list(by or [])
+        self.spec = spec
+        self.outputs = _parse_spec(spec)
+        for _, _, func in self.outputs:
+            if func not in MERGE_FUNCS:
+                raise ValueError("{0} can't be maintained incrementally".format(func))
+
+    @property
+    def node(self):
+        children = self.table._v_parent._v_children
+        return children.get(self.name)
+
+    @property
+    def settings(self):
+        return dict(self.node._v_attrs.pd_rollup)
+
+    def _save_settings(self, settings):
+        self.node._v_attrs.pd_rollup = settings
+
+    @property
+    def trailing_node(self):
+        children = self.table._v_parent._v_children
+        return children.get(TRAILING_PREFIX + self.name)
+
+    def _create_trailing(self):
+        node = self.node
+        desc = OrderedDict()
+        for pos, col in enumerate(self.by):
+            desc[col] = tb.Col.from_atom(tb.Atom.from_dtype(node.coldtypes[col]), pos=pos)
+        desc['row'] = tb.Int64Col(pos=len(self.by))
+        desc['bucket'] = tb.Int64Col(pos=len(self.by) + 1)
+        self.table._v_file.createTable(node._v_parent, TRAILING_PREFIX + self.name, desc)
+
+    def _read_trailing(self):
+        """
+            OrderedDict of stored key -> (row, bucket ns), in stored order
+        """
+        data = self.trailing_node.read()
+        keys = list(zip(*[data[col] for col in self.by])) if self.by else [()] * len(data)
+        return OrderedDict((key, (int(row), int(bucket))) 
+                           for key, row, bucket in zip(keys, data['row'], data['bucket']))
+
+    def _save_trailing(self, trailing):
+        """
+            Rewrite the stored keys in place and append the new ones. New keys
+            come last in trailing, so stored positions don't move.
+        """
+        node = self.trailing_node
+        recs = np.empty(len(trailing), dtype=node.dtype)
+        keys = list(trailing.keys())
+        for i, col in enumerate(self.by):
+            recs[col] = [key[i] for key in keys]
+        recs['row'] = [row for row, _ in trailing.values()]
+        recs['bucket'] = [bucket for _, bucket in trailing.values()]
+        stored = node.nrows
+        if stored:
+            node.modifyRows(start=0, stop=stored, rows=recs[:stored])
+        if len(recs) > stored:
+            node.append(recs[stored:])
+        node.flush()
+
+    def _aggregate(self, start=0, chunksize=None):
+        """
+            Bars of base rows [start:] as a frame with the by columns first
+        """
+        chunksize = chunksize or READ_CHUNKSIZE
+        agg = TableAggregator(self.spec, by=self.by, freq=self.freq)
+        nrows = self.table.nrows
+        for offset in range(start, nrows, chunksize):
+            stop = min(offset + chunksize, nrows)
+            agg.update(_project_frame(self.table, agg.columns, start=offset, stop=stop))
+        bars = agg.result()
+        if self.by:
+            bars = bars.reset_index(level=self.by)
+        return bars
+
+    def _trailing(self, bars, offset):
+        """
+            key -> (row, bucket ns) of the last bar of every key
+        """
+        keys = self._keys(bars)
+        buckets = bars.index.asi8
+        trailing = OrderedDict()
+        for row, key in enumerate(keys):
+            trailing[key] = (offset + row, int(buckets[row]))
+        return trailing
+
+    def _keys(self, bars):
+        """
+            Stored by values of every bar, as tuples. Category columns are 
+            encoded like append_frame does.
+        """
+        if not self.by:
+            return [()] * len(bars)
+        node = self.node
+        encoders = _encoders(node)
+        columns = []
+        for col in self.by:
+            if col in encoders:
+                values = encoders[col](bars[col])
+            else:
+                values = _convert_obj(bars[col])[0]
+            columns.append(np.asarray(values, dtype=node.coldtypes[col]))
+        return list(zip(*columns))
+
+    def create(self, chunksize=None):
+        """
+            Build the rollup from all of the base rows. Replaces an existing one
+        """
+        self.drop()
+        nrows = self.table.nrows
+        if nrows == 0:
+            raise ValueError("Can't roll up an empty table")
+        bars = self._aggregate(chunksize=chunksize)
+        # by columns get the base table's dtype, so string keys longer than
+        # the ones seen so far still fit. Category columns get their own codes
+        dtypes = dict((col, self.table.coldtypes[col]) for col in self.by
+                      if column_vocabulary(self.table, col) is None)
+        frame_to_table(self.name, bars, self.table._v_parent, chunksize=chunksize,
+                       categories=[col for col in self.by if col not in dtypes],
+                       dtypes=dtypes)
+        settings = {'freq': self.freq, 'by': self.by, 'spec': self.spec,
+                    'source_rows': nrows}
+        self._save_settings(settings)
+        self._create_trailing()
+        self._save_trailing(self._trailing(bars, 0))
+
+    def drop(self):
+        node = self.node
+        if node is None:
+            return
+        parent = node._v_parent
+        # the rollup's own bookkeeping nodes
+        for name in list(parent._v_children.keys()):
+            if name.startswith('_pd_') and name.endswith('_' + self.name):
+                parent._v_children[name]._f_remove(recursive=True)
+        node._f_remove()
+
+    def update(self, chunksize=None):
+        """
+            Fold base rows appended since the last update into the bars. Only
+            the trailing bar of each key is rewritten. Rows older than their
+            key's trailing bar force a rebuild.
+        """
+        node = self.node
+        settings = self.settings
+        start = settings['source_rows']
+        nrows = self.table.nrows
+        if nrows == start:
+            return
+        if nrows < start: # the base table was rewritten
+            return self.create(chunksize=chunksize)
+
+        bars = self._aggregate(start, chunksize=chunksize)
+        trailing = self._read_trailing()
+        keys = self._keys(bars)
+        buckets = bars.index.asi8
+        merge = {}
+        new = np.ones(len(bars), dtype=bool)
+        for row, key in enumerate(keys):
+            if key not in trailing or key in merge:
+                continue
+            stored_row, stored_bucket = trailing[key]
+            if buckets[row] < stored_bucket:
+                return self.create(chunksize=chunksize)
+            if buckets[row] == stored_bucket:
+                merge[key] = (stored_row, row)
+                new[row] = False
+
+        if merge:
+            self._merge(node, bars, merge)
+        if new.any():
+            appended = bars[new]
+            offset = node.nrows
+            append_frame(node, appended)
+            trailing.update(self._trailing(appended, offset))
+        self._save_trailing(trailing)
+        settings['source_rows'] = nrows
+        self._save_settings(settings)
+
+    def _merge(self, node, bars, merge):
+        index_name = _index_name(node)
+        encoders = _encoders(node)
+        stored = HDF5Table(node)
+        for key, (stored_row, row) in merge.items():
+            old = stored[stored_row:stored_row + 1].iloc[0]
+            merged = _merge_bar(old, bars.iloc[row], self.outputs)
+            frame = pd.DataFrame([merged], index=bars.index[row:row + 1])
+            frame = frame.reindex(columns=list(bars.columns))
+            recs = next(iter_frame_records(frame, node.dtype, index_name, encoders=encoders))
+            node.modifyRows(start=stored_row, stop=stored_row + 1, rows=recs)
+        node.flush()
+        bump_version(node)
+        invalidate_coords(node)
+        invalidate_results(node)
+
+    def read(self, start=None, end=None):
+        """
+            Bars with start <= bar label <= end. by columns are kept as columns.
+            Rows written behind append_frame's back are folded in first when 
+            the file is writable.
+        """
+        if self.table.nrows != self.settings['source_rows'] \
+           and self.table._v_file.mode != 'r':
+            self.update()
+        table = HDF5Table(self.node)
+        if start is None and end is None:
+            return table[:]
+        index = table.sql.index
+        query = None
+        if start is not None:
+            query = index >= start
+        if end is not None:
+            query = index <= end if query is None else query & (index <= end)
+        return table[query]
+
+    def __repr__(self):
+        node = self.node
+        nrows = node.nrows if node is not None else 0
+        return "Rollup {0} of {1}: {2} bars".format(self.freq, self.table._v_pathname, nrows)
@@ -0,0 +1,237 @@
+"""
+    Out-of-core grouped aggregation.
+
+    Frames are fed a chunk at a time. Each chunk is reduced to partial aggregates
+    per group key and partials are merged whenever they pile up, so memory is
+    bounded by the number of groups and not the number of rows.
+
+    Keys are any of the columns in by plus an optional time bucket of the index.
+"""
+import numpy as np
+import pandas as pd
+
+from pandas.tseries.frequencies import to_offset
+from pandas.tseries.offsets import Tick
+
+from trtools.core.timeseries import cython_ohlc, _offset_defaults
+
+AGG_FUNCS = ['sum', 'count', 'mean', 'min', 'max', 'first', 'last']
+
+# func -> partials it needs
+PARTIAL_FUNCS = {
+    'sum': ['sum'],
+    'count': ['count'],
+    'mean': ['sum', 'count'],
+    'min': ['min'],
+    'max': ['max'],
+    'first': ['first'],
+    'last': ['last'],
+}
+
+# how partials of each kind are merged
+MERGE_FUNCS = {
+    'sum': 'sum',
+    'count': 'sum',
+    'min': 'min',
+    'max': 'max',
+    'first': 'first',
+    'last': 'last',
+}
+
+# merge partials once they hold this many rows
+MAX_PARTIAL_ROWS = 1000000
+
+def _parse_spec(spec):
+    """
+        [(output name, column, func)]. spec is 'ohlc' or a dict of
+        column -> func or list of funcs. A list gives (column, func) outputs.
+    """
+    if spec == 'ohlc':
+        spec = cython_ohlc
+        # keep the ohlc column order
+        spec = [(col, spec[col]) for col in ['open', 'high', 'low', 'close', 'vol']]
+    elif isinstance(spec, dict):
+        spec = list(spec.items())
+
+    outputs = []
+    for col, funcs in spec:
+        single = isinstance(funcs, str)
+        if single:
+            funcs = [funcs]
+        for func in funcs:
+            if func not in AGG_FUNCS:
+                raise ValueError("Unsupported aggregate {0}".format(func))
+            out = col if single else (col, func)
+            outputs.append((out, col, func))
+    return outputs
+
+def _partial_name(col, func):
+    return '{0}|{1}'.format(col, func)
+
+def time_buckets(index, freq, closed=None, label=None):
+    """
+        int64 ns bucket label of every index value. Same bins as downsample
+        for fixed frequencies, computed per row so chunks can be bucketed
+        independently.
+    """
+    offset = to_offset(freq)
+    if not isinstance(offset, Tick):
+        raise ValueError("Only fixed frequencies can be bucketed out of core {0}".format(freq))
+    defaults = _offset_defaults(offset)
+    closed = closed or defaults['closed']
+    label = label or defaults['label']
+
+    if getattr(index, 'tz', None) is not None:
+        index = index.tz_localize(None) # bucket on wall time
+    values = index.asi8
+    step = offset.nanos
+    if closed == 'left':
+        buckets = values // step * step
+    else:
+        buckets = (values - 1) // step * step
+    if label == 'right':
+        buckets += step
+    return buckets
+
+class TableAggregator(object):
+    """
+        Running grouped aggregates.
+
+        spec : see _parse_spec
+        by : column or list of columns to group by
+        freq : fixed frequency to bucket the index by
+    """
+    def __init__(self, spec, by=None, freq=None, closed=None, label=None,
+                 max_partial_rows=None):
+        self.outputs = _parse_spec(spec)
+        if isinstance(by, str):
+            by = [by]
+        self.by = list(by or [])
+        if not self.by and freq is None:
+            raise ValueError("Need by and/or freq to group on")
+        self.freq = freq
+        self.closed = closed
+        self.label = label
+        self.max_partial_rows = max_partial_rows or MAX_PARTIAL_ROWS
+
+        partials = []
+        for _, col, func in self.outputs:
+            for kind in PARTIAL_FUNCS[func]:
+                if (col, kind) not in partials:
+                    partials.append((col, kind))
+        self.partials = partials
+
+        self.index_name = None
+        self.tz = None
+        self._frames = []
+        self._pending = 0
+
+    @property
+    def columns(self):
+        """
+            columns the aggregate reads
+        """
+        columns = list(self.by)
+        for col, _ in self.partials:
+            if col not in columns:
+                columns.append(col)
+        return columns
+
+    def _keys(self, df):
+        keys = [np.asarray(df[col]) for col in self.by]
+        if self.freq is not None:
+            keys.append(time_buckets(df.index, self.freq, self.closed, self.label))
+        return keys
+
+    def update(self, df):
+        """
+            Fold a chunk into the running aggregates
+        """
+        if len(df) == 0:
+            return
+        if self.index_name is None:
+            self.index_name = df.index.name
+            self.tz = getattr(df.index, 'tz', None)
+
+        grouped = df.groupby(self._keys(df))
+        partial = {}
+        for col, kind in self.partials:
+            partial[_partial_name(col, kind)] = getattr(grouped[col], kind)()
+        partial = pd.DataFrame(partial)
+        self._frames.append(partial)
+        self._pending += len(partial)
+        if self._pending > self.max_partial_rows:
+            self._merge()
+
+    def _merge(self):
+        """
+            Merge the partials. Chunks are kept in row order so first/last hold.
+        """
+        if len(self._frames) > 1:
+            df = pd.concat(self._frames)
+            index = df.index
+            keys = [index.get_level_values(i) for i in range(index.nlevels)]
+            grouped = df.groupby(keys)
+            merged = {}
+            for col, kind in self.partials:
+                name = _partial_name(col, kind)
+                merged[name] = getattr(grouped[name], MERGE_FUNCS[kind])()
+            self._frames = [pd.DataFrame(merged)]
+        self._pending = sum(len(frame) for frame in self._frames)
+
+    def _result_index(self, index):
+        names = list(self.by)
+        if self.freq is not None:
+            names.append(self.index_name)
+        if len(names) == 1:
+            if self.freq is not None:
+                index = self._bucket_index(index)
+            index.name = names[0]
+            return index
+        levels = [index.get_level_values(i) for i in range(index.nlevels)]
+        if self.freq is not None:
+            levels[-1] = self._bucket_index(levels[-1])
+        return pd.MultiIndex.from_arrays(levels, names=names)
+
+    def _bucket_index(self, values):
+        index = pd.DatetimeIndex(np.asarray(values, dtype='M8[ns]'))
+        if self.tz is not None:
+            index = index.tz_localize(self.tz)
+        return index
+
+    def result(self):
+        """
+            DataFrame of the aggregates, one row per group
+        """
+        outs = [out for out, _, _ in self.outputs]
+        self._merge()
+        if not self._frames:
+            return pd.DataFrame(columns=outs)
+        partial = self._frames[0]
+
+        data = {}
+        for out, col, func in self.outputs:
+            if func == 'mean':
+                total = partial[_partial_name(col, 'sum')]
+                data[out] = total / partial[_partial_name(col, 'count')]
+            else:
+                data[out] = partial[_partial_name(col, func)]
+        if any(isinstance(out, tuple) for out in outs):
+            outs = pd.MultiIndex.from_tuples([out if isinstance(out, tuple) else (out, '')
+                                              for out in outs])
+            data = dict((out if isinstance(out, tuple) else (out, ''), values)
+                        for out, values in data.items())
+        result = pd.DataFrame(data, columns=outs)
+        result.index = self._result_index(result.index)
+        return result
+
+def aggregate_frames(frames, spec, by=None, freq=None, closed=None, label=None,
+                     max_partial_rows=None):
+    """
+        Grouped aggregate over an iterable of DataFrames
+    """
+    agg = TableAggregator(spec, by=by, freq=freq, closed=closed, label=label,
+                          max_partial_rows=max_partial_rows)
+    for df in frames:
+        agg.update(df)
+    return agg.result()
@@ -1,7 +1,14 @@
 """
     Stuff to make indexing/querying HDF5 faster
 """
+from collections import OrderedDict
+import hashlib
+import operator
+
 import numpy as np
+import tables as tb
+
+from trtools.io.categories import column_vocabulary
 
 def create_slices(arr):
     """
@@ -17,9 +24,1054 @@ def create_slices(arr):
     """
     if arr.dtype == 'bool': # bool index array
         arr = np.nonzero(arr)[0]
+    if len(arr) == 0:
+        return []
     edges = np.nonzero(np.diff(arr) != 1)[0] + 1
     splits = np.split(arr, edges)
     slices = []
     for split in splits:
         slices.append(slice(split[0], split[-1]+1))
     return slices
+
+# plan_reads cost model. One read call costs about as much as reading 
+# READ_CALL_BYTES more, so gaps smaller than that are cheaper to read through
+READ_CALL_BYTES = 64 * 1024
+# never merge reads past this many rows
+READ_MAX_ROWS = 1000000
+
+def plan_reads(slices, rowsize, gap=None, max_rows=None):
+    """
+        Plan the reads for a list of slices. Slices separated by at most gap 
+        rows are merged into one read and the rows in between are thrown away.
+
+        Returns a list of (read, keep) where read is the slice of the table to
+        read and keep is a list of slices into that read, in output order.
+
+        gap defaults to READ_CALL_BYTES worth of rows. gap=0 only merges 
+        touching slices.
+    """
+    if gap is None:
+        gap = READ_CALL_BYTES // max(rowsize, 1)
+    if max_rows is None:
+        max_rows = READ_MAX_ROWS
+
+    plan = []
+    for s in slices:
+        start, stop = s.start, s.stop
+        if stop <= start:
+            continue
+        if plan:
+            read, keep = plan[-1]
+            if read.stop <= start and start - read.stop <= gap \
+               and stop - read.start <= max_rows:
+                offset = start - read.start
+                if keep[-1].stop == offset:
+                    keep[-1] = slice(keep[-1].start, stop - read.start)
+                else:
+                    keep.append(slice(offset, stop - read.start))
+                plan[-1] = (slice(read.start, stop), keep)
+                continue
+        plan.append((slice(start, stop), [slice(0, stop - start)]))
+    return plan
+
+def table_stamp(table):
+    """
+        (nrows, pd_version) of a pytables Table. pd_version is bumped on every 
+        append we do, nrows catches appends done behind our back.
+    """
+    try:
+        version = table._v_attrs.pd_version
+    except AttributeError:
+        version = 0
+    return (int(table.nrows), int(version))
+
+def bump_version(table):
+    """
+        Mark table as modified. Invalidates anything keyed on table_stamp
+    """
+    version = table_stamp(table)[1]
+    table._v_attrs.pd_version = version + 1
+
+# max number of where expressions cached per table
+COORD_CACHE_ENTRIES = 128
+
+def _coord_cache_name(table):
+    return '_pd_coords_' + table._v_name
+
+def _key_shape(terms, values):
+    """
+        terms without their values, which are appended to values. Unlike 
+        _shape this handles isin terms too
+    """
+    kind = terms[0]
+    if kind in ('&', '|'):
+        return (kind, _key_shape(terms[1], values), _key_shape(terms[2], values))
+    values.append(terms[-1])
+    return terms[:-1]
+
+def coord_key(where, terms=None):
+    """
+        Cache key for a where expression. Runnable terms are keyed on their
+        shape plus a hash of their values, so isin lists don't end up in the
+        attrs and the key length doesn't grow with the query values.
+    """
+    digest = hashlib.sha1()
+    if runnable(terms):
+        values = []
+        shape = repr(_key_shape(terms, values))
+        for value in values:
+            value = np.asarray(value)
+            if value.dtype.kind == 'O':
+                digest.update(repr(value.tolist()).encode('utf-8'))
+            else:
+                digest.update(str(value.dtype).encode('utf-8'))
+                digest.update(value.tostring())
+    else:
+        shape = 'where'
+        digest.update(where.encode('utf-8'))
+    return '{0}:{1}'.format(shape, digest.hexdigest())
+
+def invalidate_coords(table):
+    """
+        Remove the persisted coordinate cache for table
+    """
+    parent = table._v_parent
+    name = _coord_cache_name(table)
+    if name in parent._v_children:
+        parent._v_children[name]._f_remove(recursive=True)
+
+class CoordinateCache(object):
+    """
+        Caches getWhereList results as run length slices from create_slices.
+
+        The slices are stored next to the table in a group named 
+        _pd_coords_<table name> so they survive across sessions. Each entry is
+        keyed by coord_key and is only used if the table_stamp matches. Both
+        the stored and in memory entries are capped at max_entries. Read only 
+        handles keep the cache in memory.
+    """
+    def __init__(self, table, max_entries=None, zonemap=None):
+        self.table = table
+        self.max_entries = max_entries or COORD_CACHE_ENTRIES
+        self.zonemap = zonemap
+        self._memory = OrderedDict()
+
+    @property
+    def writable(self):
+        return self.table._v_file.mode != 'r'
+
+    @property
+    def group(self):
+        parent = self.table._v_parent
+        name = _coord_cache_name(self.table)
+        if name in parent._v_children:
+            return parent._v_children[name]
+        return None
+
+    def _entries(self, group):
+        try:
+            return dict(group._v_attrs.entries)
+        except AttributeError:
+            return {}
+
+    def slices(self, where, terms=None):
+        """
+            Slices of the rows matching where. Computed and cached on a miss, 
+            skipping blocks ruled out by the zone map when terms are passed.
+        """
+        stamp = table_stamp(self.table)
+        key = coord_key(where, terms)
+        slices = self.get(key, stamp)
+        if slices is None:
+            IndexPolicy(self.table).refresh()
+            coords = where_coords(self.table, where, terms, self.zonemap)
+            slices = create_slices(coords)
+            self.put(key, stamp, slices)
+        return slices
+
+    def _remember(self, key, stamp, slices):
+        self._memory.pop(key, None)
+        self._memory[key] = (stamp, slices)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key, stamp):
+        entry = self._memory.get(key)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+
+        group = self.group
+        if group is None:
+            return None
+
+        entry = self._entries(group).get(key)
+        if entry is None:
+            return None
+        node_name, entry_stamp, _ = entry
+        if entry_stamp != stamp:
+            return None
+
+        slices = []
+        if node_name is not None:
+            runs = group._v_children[node_name].read()
+            slices = [slice(int(start), int(stop)) for start, stop in runs]
+
+        self._remember(key, stamp, slices)
+        return slices
+
+    def put(self, key, stamp, slices):
+        self._remember(key, stamp, slices)
+        if not self.writable:
+            return
+
+        handle = self.table._v_file
+        group = self.group
+        if group is None:
+            group = handle.createGroup(self.table._v_parent, _coord_cache_name(self.table))
+
+        entries = self._entries(group)
+        try:
+            seq = group._v_attrs.seq
+        except AttributeError:
+            seq = 0
+
+        old = entries.pop(key, None)
+        if old is not None:
+            self._remove_node(group, old[0])
+
+        # evict oldest entries
+        while len(entries) >= self.max_entries:
+            oldest = min(entries, key=lambda k: entries[k][2])
+            self._remove_node(group, entries.pop(oldest)[0])
+            self._memory.pop(oldest, None)
+
+        # pytables doesn't do zero length arrays, empty results just live in entries
+        node_name = None
+        if slices:
+            node_name = 'c{0}'.format(seq)
+            runs = np.array([(s.start, s.stop) for s in slices], dtype=np.int64)
+            handle.createArray(group, node_name, runs)
+
+        entries[key] = (node_name, stamp, seq)
+        group._v_attrs.entries = entries
+        group._v_attrs.seq = seq + 1
+
+    def _remove_node(self, group, node_name):
+        if node_name is not None and node_name in group._v_children:
+            group._v_children[node_name]._f_remove()
+
+    def clear(self):
+        self._memory.clear()
+        if self.writable:
+            invalidate_coords(self.table)
+
+def key_runs(values):
+    """
+        Contiguous runs of equal values. Returns keys, starts, stops
+    """
+    values = np.asarray(values)
+    if len(values) == 0:
+        return values, np.array([], dtype=int), np.array([], dtype=int)
+    edges = np.nonzero(values[1:] != values[:-1])[0] + 1
+    starts = np.concatenate([[0], edges])
+    stops = np.concatenate([edges, [len(values)]])
+    return values[starts], starts, stops
+
+def decode_keys(values):
+    """
+        Stored string keys come back as bytes
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'S':
+        values = values.astype(np.unicode_)
+    return values.tolist()
+
+# rows of the frame_key column scanned at a time when building a directory
+DIRECTORY_CHUNKSIZE = 1000000
+
+def _directory_name(table):
+    return '_pd_keyranges_' + table._v_name
+
+def _covered_stamp(node):
+    """
+        table_stamp the directory node was last updated for
+    """
+    try:
+        return (int(node._v_attrs.rows), int(node._v_attrs.version))
+    except AttributeError:
+        return None
+
+class FrameKeyDirectory(object):
+    """
+        Persistent frame_key -> (start, stop) row ranges for tables where every 
+        frame_key is stored as one contiguous block. True after sorting by frame_key
+        or during append-only ingestion where keys arrive in blocks.
+
+        Stored next to the table as the _pd_keyranges_<table name> Table. If a key 
+        ever shows up in a second block, the directory is dropped and lookups fall 
+        back to where queries. The node records the table_stamp it covers, so 
+        rows appended without updating the directory also drop it.
+    """
+    def __init__(self, table, frame_key):
+        self.table = table
+        self.frame_key = frame_key
+        self.dtype = table.coldtypes[frame_key]
+        self.vocab = column_vocabulary(table, frame_key)
+        self._ranges = None
+        self._rows = None
+        self._stamp = None
+
+    @property
+    def node(self):
+        parent = self.table._v_parent
+        name = _directory_name(self.table)
+        if name in parent._v_children:
+            return parent._v_children[name]
+        return None
+
+    @property
+    def writable(self):
+        return self.table._v_file.mode != 'r'
+
+    @property
+    def ranges(self):
+        """
+            OrderedDict of stored key -> (start, stop). None if no valid directory
+        """
+        ranges = self._current()
+        if ranges is not None and self._stamp != table_stamp(self.table):
+            # rows were appended behind our back
+            self.drop()
+            return None
+        return ranges
+
+    def _current(self):
+        """
+            ranges as stored, reloaded if another writer changed the node
+        """
+        node = self.node
+        if node is None:
+            if self.writable:
+                # dropped by another writer
+                self._ranges = None
+            return self._ranges
+        if self._ranges is None or self._stamp != _covered_stamp(node):
+            self._load()
+        return self._ranges
+
+    def _load(self):
+        node = self.node
+        if node is None:
+            return
+        data = node.read()
+        self._ranges = OrderedDict()
+        self._rows = {}
+        self._stamp = _covered_stamp(node)
+        for i, (key, start, stop) in enumerate(zip(data['key'], data['start'], data['stop'])):
+            self._ranges[key] = (int(start), int(stop))
+            self._rows[key] = i
+
+    def _set_stamp(self, rows):
+        self._stamp = (int(rows), table_stamp(self.table)[1])
+        node = self.node
+        if node is not None:
+            node._v_attrs.rows, node._v_attrs.version = self._stamp
+
+    def stored_key(self, key):
+        if self.vocab is not None:
+            return self.vocab.code(key)
+        return np.asarray(key, dtype=self.dtype)[()]
+
+    def stored_keys(self, values):
+        """
+            frame_key values as they are stored in the table
+        """
+        if self.vocab is not None:
+            return self.vocab.lookup(values)
+        return values
+
+    def decode(self, values):
+        """
+            list of frame_keys from stored values
+        """
+        if self.vocab is not None:
+            return self.vocab.decode_values(values)
+        return decode_keys(values)
+
+    def get(self, key):
+        """
+            slice of rows for key. None if there is no directory
+        """
+        ranges = self.ranges
+        if ranges is None:
+            return None
+        start, stop = ranges.get(self.stored_key(key), (0, 0))
+        return slice(start, stop)
+
+    def keys(self):
+        return self.decode(list(self.ranges.keys()))
+
+    def create(self):
+        """
+            Start an empty directory. Only valid for an empty table
+        """
+        self.drop()
+        desc = OrderedDict()
+        desc['key'] = tb.Col.from_atom(tb.Atom.from_dtype(self.dtype), pos=0)
+        desc['start'] = tb.Int64Col(pos=1)
+        desc['stop'] = tb.Int64Col(pos=2)
+        self._ranges = OrderedDict()
+        self._rows = {}
+        if self.writable:
+            self.table._v_file.createTable(self.table._v_parent, _directory_name(self.table), desc)
+        self._set_stamp(0)
+
+    def drop(self):
+        self._ranges = None
+        self._rows = None
+        self._stamp = None
+        node = self.node
+        if node is not None and self.writable:
+            node._f_remove()
+
+    def update(self, values, start):
+        """
+            Record frame_key values appended at row start. values are stored 
+            values, see stored_keys
+        """
+        ranges = self._current()
+        if ranges is None:
+            return
+        if self._stamp[0] != start:
+            # rows before start were never recorded
+            self.drop()
+            return
+
+        keys, starts, stops = key_runs(np.asarray(values, dtype=self.dtype))
+        new_rows = []
+        for key, run_start, run_stop in zip(keys, starts + start, stops + start):
+            if key in ranges:
+                old_start, old_stop = ranges[key]
+                if old_stop != run_start:
+                    # not contiguous anymore
+                    self.drop()
+                    return
+                ranges[key] = (old_start, int(run_stop))
+                self._modify(key, int(run_stop))
+                continue
+            ranges[key] = (int(run_start), int(run_stop))
+            new_rows.append((key, run_start, run_stop))
+
+        node = self.node
+        if new_rows and node is not None:
+            for i, row in enumerate(new_rows):
+                self._rows[row[0]] = node.nrows + i
+            node.append(new_rows)
+            node.flush()
+        self._set_stamp(start + len(values))
+
+    def _modify(self, key, stop):
+        node = self.node
+        if node is None:
+            return
+        row = self._rows[key]
+        node.modifyColumn(start=row, stop=row+1, column=np.array([stop]), colname='stop')
+
+    def build(self, chunksize=None):
+        """
+            Scan the frame_key column and build the directory. Returns False if the
+            frame_keys aren't stored in contiguous blocks.
+        """
+        if chunksize is None:
+            chunksize = DIRECTORY_CHUNKSIZE
+        self.create()
+        nrows = self.table.nrows
+        for start in range(0, nrows, chunksize):
+            stop = min(start + chunksize, nrows)
+            values = self.table.read(start, stop, field=self.frame_key)
+            self.update(values, start)
+            if self._ranges is None:
+                return False
+        return True
+
+# rows per zone map block
+ZONE_BLOCKSIZE = 65536
+# rows read at a time when computing zone map stats
+ZONE_CHUNKSIZE = ZONE_BLOCKSIZE * 16
+
+def _zonemap_name(table):
+    return '_pd_zonemap_' + table._v_name
+
+def _block_mask(stats, op, value):
+    mins, maxs = stats
+    if op == '==':
+        return (mins <= value) & (maxs >= value)
+    if op == '!=':
+        if mins.dtype.kind == 'f':
+            # NaN rows match != but fmin/fmax skip them, can't rule out a block
+            return None
+        return ~((mins == value) & (maxs == value))
+    if op == '>':
+        return maxs > value
+    if op == '>=':
+        return maxs >= value
+    if op == '<':
+        return mins < value
+    if op == '<=':
+        return mins <= value
+    return None
+
+class ZoneMap(object):
+    """
+        Per block min/max statistics for selected numeric columns of a table.
+
+        Stored next to the table as the _pd_zonemap_<table name> Table with one row
+        per block of blocksize rows and a <col>_min, <col>_max column pair per column.
+        Used to skip blocks that cannot match a query. Rows appended since the last
+        update are always treated as candidates.
+    """
+    def __init__(self, table):
+        self.table = table
+        self._stats = None
+        # (blocks, covered) the stats were read at
+        self._stats_key = None
+
+    @property
+    def node(self):
+        parent = self.table._v_parent
+        name = _zonemap_name(self.table)
+        if name in parent._v_children:
+            return parent._v_children[name]
+        return None
+
+    @property
+    def columns(self):
+        node = self.node
+        if node is None:
+            return []
+        return list(node._v_attrs.columns)
+
+    @property
+    def blocksize(self):
+        return int(self.node._v_attrs.blocksize)
+
+    @property
+    def covered(self):
+        """
+            Number of table rows the stats cover
+        """
+        return int(self.node._v_attrs.rows)
+
+    def create(self, columns, blocksize=None):
+        blocksize = blocksize or ZONE_BLOCKSIZE
+        self.drop()
+
+        desc = OrderedDict()
+        for pos, col in enumerate(columns):
+            dtype = self.table.coldtypes[col]
+            if dtype.kind not in 'iuf':
+                raise ValueError("Zone maps only support numeric columns. {0} is {1}".format(col, dtype))
+            atom = tb.Atom.from_dtype(dtype)
+            desc[col+'_min'] = tb.Col.from_atom(atom, pos=pos*2)
+            desc[col+'_max'] = tb.Col.from_atom(atom, pos=pos*2+1)
+
+        node = self.table._v_file.createTable(self.table._v_parent, _zonemap_name(self.table), desc)
+        node._v_attrs.columns = list(columns)
+        node._v_attrs.blocksize = blocksize
+        node._v_attrs.rows = 0
+        self.update()
+
+    def drop(self):
+        self._stats = None
+        node = self.node
+        if node is not None:
+            node._f_remove()
+
+    def update(self, chunksize=None):
+        """
+            Add stats for rows appended since the last update. Only the new rows are
+            read, a partial last block is merged with its stored stats.
+        """
+        node = self.node
+        if node is None:
+            return
+        nrows = self.table.nrows
+        covered = self.covered
+        if covered >= nrows:
+            return
+
+        chunksize = chunksize or ZONE_CHUNKSIZE
+        bs = self.blocksize
+        columns = self.columns
+        for start in range(covered, nrows, chunksize):
+            stop = min(start + chunksize, nrows)
+            boundaries = np.arange((start // bs + 1) * bs, stop, bs)
+            offsets = np.concatenate([[0], boundaries - start]).astype(int)
+
+            recs = np.empty(len(offsets), dtype=node.dtype)
+            for col in columns:
+                values = self.table.read(start, stop, field=col)
+                recs[col+'_min'] = np.fmin.reduceat(values, offsets)
+                recs[col+'_max'] = np.fmax.reduceat(values, offsets)
+
+            first_block = start // bs
+            if first_block < node.nrows: # partial block, merge with stored stats
+                stored = node.read(first_block, first_block+1)
+                for col in columns:
+                    recs[col+'_min'][0] = np.fmin(stored[col+'_min'][0], recs[col+'_min'][0])
+                    recs[col+'_max'][0] = np.fmax(stored[col+'_max'][0], recs[col+'_max'][0])
+                node.modifyRows(start=first_block, stop=first_block+1, rows=recs[:1])
+                recs = recs[1:]
+            if len(recs):
+                node.append(recs)
+            node._v_attrs.rows = stop
+
+        node.flush()
+        self._stats = None
+
+    @property
+    def stats(self):
+        """
+            dict of col -> (mins, maxs). Reloaded when the stored stats changed,
+            e.g. after an append updated them through another ZoneMap.
+        """
+        node = self.node
+        key = (node.nrows, self.covered)
+        if self._stats is None or self._stats_key != key:
+            data = node.read()
+            self._stats = dict((col, (data[col+'_min'], data[col+'_max'])) for col in self.columns)
+            self._stats_key = key
+        return self._stats
+
+    def _refresh(self):
+        if self.covered < self.table.nrows and self.table._v_file.mode != 'r':
+            self.update()
+
+    def candidate_blocks(self, terms):
+        """
+            Boolean array over the stored blocks. False means the block cannot 
+            hold a row matching terms. See HDFQuery.terms
+        """
+        nblocks = self.node.nrows
+        everything = np.ones(nblocks, dtype=bool)
+        if terms is None:
+            return everything
+
+        kind = terms[0]
+        if kind in ('&', '|'):
+            left = self.candidate_blocks(terms[1])
+            right = self.candidate_blocks(terms[2])
+            if kind == '&':
+                return left & right
+            return left | right
+
+        if kind == 'cmp':
+            _, col, op, value = terms
+            if col not in self.columns or isinstance(value, (str, bytes)):
+                return everything
+            mask = _block_mask(self.stats[col], op, value)
+            if mask is not None:
+                return mask
+
+        if kind == 'isin':
+            _, col, values = terms
+            if col not in self.columns or len(values) == 0:
+                return everything
+            values = np.asarray(values)
+            if values.dtype.kind not in 'iuf':
+                return everything
+            mins, maxs = self.stats[col]
+            return (maxs >= values.min()) & (mins <= values.max())
+
+        return everything
+
+    def row_ranges(self, terms):
+        """
+            List of slices of rows that may match terms. None if there is no zone map
+        """
+        if self.node is None:
+            return None
+        self._refresh()
+
+        bs = self.blocksize
+        nrows = self.table.nrows
+        covered = min(self.covered, nrows)
+        mask = self.candidate_blocks(terms)
+
+        ranges = [slice(s.start * bs, min(s.stop * bs, covered)) for s in create_slices(mask)]
+        # rows past the stats are always candidates
+        if covered < nrows:
+            ranges.append(slice(covered, nrows))
+        return ranges
+
+    def index_range(self, col, start, end):
+        """
+            Rows between start and end inclusive for a sorted column. Only the
+            candidate blocks of col are read.
+        """
+        self._refresh()
+        bs = self.blocksize
+        nrows = min(self.covered, self.table.nrows)
+        mins, maxs = self.stats[col]
+        blocks = np.nonzero((maxs >= start) & (mins <= end))[0]
+        if len(blocks) == 0:
+            after = np.nonzero(mins > end)[0]
+            pos = after[0] * bs if len(after) else nrows
+            return pos, pos
+
+        offset = blocks[0] * bs
+        stop = min((blocks[-1] + 1) * bs, nrows)
+        values = self.table.read(offset, stop, field=col)
+        first = offset + np.searchsorted(values, start, side='left')
+        last = offset + np.searchsorted(values, end, side='right')
+        return int(first), int(last)
+
+# shape of terms -> condition string
+_condition_cache = {}
+MAX_CONDITIONS = 1000
+
+def _shape(terms):
+    kind = terms[0]
+    if kind in ('&', '|'):
+        return (kind, _shape(terms[1]), _shape(terms[2]))
+    return terms[:3]
+
+def _values(terms, values):
+    kind = terms[0]
+    if kind in ('&', '|'):
+        _values(terms[1], values)
+        _values(terms[2], values)
+        return values
+    values.append(terms[3])
+    return values
+
+def _condition(shape, counter):
+    kind = shape[0]
+    if kind in ('&', '|'):
+        left = _condition(shape[1], counter)
+        right = _condition(shape[2], counter)
+        return "({0}) {1} ({2})".format(left, kind, right)
+    _, col, op = shape
+    return "{0} {1} pd_p{2}".format(col, op, next(counter))
+
+def compilable(terms):
+    """
+        Can terms be run as a single pytables condition
+    """
+    if terms is None:
+        return False
+    kind = terms[0]
+    if kind in ('&', '|'):
+        return compilable(terms[1]) and compilable(terms[2])
+    return kind == 'cmp'
+
+def compile_terms(terms):
+    """
+        Compile terms into a condition with bound condvars.
+
+        The condition only depends on the shape of terms (columns and operators), 
+        so queries that only differ in values share the same condition string and 
+        hit pytables' compiled condition cache instead of recompiling.
+    """
+    shape = _shape(terms)
+    condition = _condition_cache.get(shape)
+    if condition is None:
+        if len(_condition_cache) > MAX_CONDITIONS:
+            _condition_cache.clear()
+        condition = _condition(shape, iter(range(len(_values(terms, [])))))
+        _condition_cache[shape] = condition
+    values = _values(terms, [])
+    condvars = dict(('pd_p{0}'.format(i), value) for i, value in enumerate(values))
+    return condition, condvars
+
+def isin_coords(table, col, values, start=None, stop=None, chunksize=None):
+    """
+        Sorted coordinates of rows where col is in values. Indexed columns do one
+        index lookup per value, others are scanned chunksize rows at a time.
+    """
+    values = np.unique(np.asarray(values, dtype=table.coldtypes[col]))
+    start = start or 0
+    stop = table.nrows if stop is None else min(stop, table.nrows)
+
+    parts = []
+    if table.colindexed[col]:
+        condition = "{0} == pd_p0".format(col)
+        for value in values:
+            parts.append(table.getWhereList(condition, condvars={'pd_p0': value}, 
+                                            start=start, stop=stop))
+    else:
+        chunksize = chunksize or DIRECTORY_CHUNKSIZE
+        for offset in range(start, stop, chunksize):
+            data = table.read(offset, min(offset + chunksize, stop), field=col)
+            parts.append(np.nonzero(np.in1d(data, values))[0] + offset)
+
+    if not parts:
+        return np.array([], dtype=np.int64)
+    return np.unique(np.concatenate(parts))
+
+def query_coords(table, terms, start=None, stop=None):
+    """
+        Sorted coordinates of rows matching terms. See HDFQuery.terms
+    """
+    if compilable(terms):
+        condition, condvars = compile_terms(terms)
+        return table.getWhereList(condition, condvars=condvars, sort=True, 
+                                  start=start, stop=stop)
+
+    kind = terms[0]
+    if kind == 'isin':
+        _, col, values = terms
+        return isin_coords(table, col, values, start=start, stop=stop)
+    if kind == '&':
+        left = query_coords(table, terms[1], start, stop)
+        if len(left) == 0:
+            return left
+        return np.intersect1d(left, query_coords(table, terms[2], start, stop))
+    if kind == '|':
+        return np.union1d(query_coords(table, terms[1], start, stop), 
+                          query_coords(table, terms[2], start, stop))
+    raise ValueError("Cannot evaluate query terms {0}".format(terms))
+
+def runnable(terms):
+    """
+        Can query_coords evaluate terms
+    """
+    if terms is None:
+        return False
+    kind = terms[0]
+    if kind in ('&', '|'):
+        return runnable(terms[1]) and runnable(terms[2])
+    return kind in ('cmp', 'isin')
+
+# array operators, the ufuncs don't compare S columns
+_term_ops = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+def eval_terms(terms, columns):
+    """
+        Evaluate terms over in memory columns. Returns a bool mask
+
+        columns : dict of column -> stored values
+    """
+    if terms is None:
+        raise ValueError("Query has no terms to evaluate")
+    kind = terms[0]
+    if kind == '&':
+        return eval_terms(terms[1], columns) & eval_terms(terms[2], columns)
+    if kind == '|':
+        return eval_terms(terms[1], columns) | eval_terms(terms[2], columns)
+    if kind == 'isin':
+        _, col, values = terms
+        return np.in1d(columns[col], np.asarray(values, dtype=columns[col].dtype))
+    _, col, op, value = terms
+    values = columns[col]
+    if values.dtype.kind == 'S' and not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return _term_ops[op](values, value)
+
+def term_columns(terms):
+    """
+        set of columns referenced by terms. None if unknown
+    """
+    if terms is None:
+        return None
+    kind = terms[0]
+    if kind in ('&', '|'):
+        left = term_columns(terms[1])
+        right = term_columns(terms[2])
+        if left is None or right is None:
+            return None
+        return left | right
+    return set([terms[1]])
+
+def where_coords(table, where, terms=None, zonemap=None, start=None, stop=None):
+    """
+        getWhereList that runs terms with bound condvars when it can and skips 
+        the blocks a zone map rules out. Callers refresh the IndexPolicy once
+        per query, see IndexPolicy.refresh
+    """
+    if not runnable(terms):
+        return table.getWhereList(where, sort=True, start=start, stop=stop)
+
+    ranges = None
+    if zonemap is not None and start is None and stop is None:
+        ranges = zonemap.row_ranges(terms)
+    if ranges is None:
+        return query_coords(table, terms, start=start, stop=stop)
+
+    parts = [query_coords(table, terms, start=rows.start, stop=rows.stop) for rows in ranges]
+    if not parts:
+        return np.array([], dtype=np.int64)
+    return np.concatenate(parts)
+
+INDEX_KINDS = ['ultralight', 'light', 'medium', 'full']
+INDEX_MODES = ['incremental', 'lazy']
+# lazy indexes are brought up to date once this many rows are unindexed
+INDEX_THRESHOLD = 100000
+
+def _unindexed_rows(column):
+    return int(column.table.nrows - column.index.nelements)
+
+def _index_status(column):
+    index = column.index
+    return (bool(index.dirty), int(index.nelements))
+
+def add_index(table, col, kind='full', optlevel=9, verbose=False):
+    """
+        Create an index on col. Returns the number of rows indexed, 0 if col
+        was already indexed. The defaults make a CSI index.
+    """
+    column = getattr(table.cols, col)
+    if column.is_indexed:
+        if verbose:
+            print(("Index already exists {0}. Reindex?".format(col)))
+        return 0
+    if verbose:
+        print(("Creating Index on {0}".format(col)))
+    num = column.createIndex(optlevel=optlevel, kind=kind)
+    if verbose:
+        print(("Index created with {0} vals".format(num)))
+    return num
+
+def update_index(table, col, force=False, verbose=False):
+    """
+        Bring the index of col up to date. Dirty indexes are rebuilt, otherwise
+        only the rows appended since the last update are added. force rebuilds
+        from scratch. Returns True if anything was done.
+    """
+    column = getattr(table.cols, col)
+    if not column.is_indexed:
+        if verbose:
+            print(("{0} is not indexed".format(col)))
+        return False
+    if force:
+        action = column.reIndex
+    elif column.index.dirty:
+        action = column.reIndexDirty
+    elif _unindexed_rows(column):
+        action = table.flushRowsToIndex
+    else:
+        return False
+    if verbose:
+        print(("Re-indexing on {0}".format(col)))
+    action()
+    return True
+
+class IndexPolicy(object):
+    """
+        Which columns of a table are indexed and when their indexes are brought
+        up to date. Stored in the table attrs as pd_index_policy.
+
+        incremental : appended rows are indexed as part of the append
+        lazy : appended rows are indexed before the next query once threshold 
+            rows are unindexed. Until then pytables scans the unindexed tail.
+
+        Dirty indexes, e.g. after rows are modified, are rebuilt before the 
+        next query in either mode.
+    """
+    def __init__(self, table):
+        self.table = table
+
+    @property
+    def settings(self):
+        try:
+            return dict(self.table._v_attrs.pd_index_policy)
+        except AttributeError:
+            return None
+
+    def set(self, columns, kind='medium', optlevel=6, mode='lazy', threshold=None):
+        if kind not in INDEX_KINDS:
+            raise ValueError("Index kind must be one of {0}".format(INDEX_KINDS))
+        if mode not in INDEX_MODES:
+            raise ValueError("Index mode must be one of {0}".format(INDEX_MODES))
+        table = self.table
+        columns = [str(col) for col in columns]
+        for col in columns:
+            column = getattr(table.cols, col)
+            if column.is_indexed:
+                index = column.index
+                if index.kind == kind and index.optlevel == optlevel:
+                    continue
+                column.removeIndex()
+            column.createIndex(optlevel=optlevel, kind=kind)
+
+        table.autoIndex = mode == 'incremental'
+        settings = {'columns': columns, 'kind': kind, 'optlevel': optlevel, 
+                    'mode': mode, 'threshold': threshold or INDEX_THRESHOLD}
+        table._v_attrs.pd_index_policy = settings
+
+    def drop(self, remove_indexes=False):
+        settings = self.settings
+        if settings is None:
+            return
+        if remove_indexes:
+            for col in settings['columns']:
+                column = getattr(self.table.cols, col)
+                if column.is_indexed:
+                    column.removeIndex()
+        self.table.autoIndex = True
+        del self.table._v_attrs.pd_index_policy
+
+    def after_append(self):
+        settings = self.settings
+        if settings is not None and settings['mode'] == 'incremental':
+            self.refresh(force=True)
+
+    def refresh(self, force=False):
+        """
+            Update the indexes that are dirty or past the unindexed threshold.
+            force updates any stale index. Returns the columns whose index 
+            changed. One flushRowsToIndex catches up every index of the table,
+            so later columns usually have nothing left to do.
+
+            Call once per query, before running it.
+        """
+        settings = self.settings
+        table = self.table
+        if settings is None or table._v_file.mode == 'r':
+            return []
+        threshold = 1 if force else settings['threshold']
+        columns = [col for col in settings['columns'] 
+                   if getattr(table.cols, col).is_indexed]
+        before = dict((col, _index_status(getattr(table.cols, col))) for col in columns)
+        for col in columns:
+            column = getattr(table.cols, col)
+            if column.index.dirty or _unindexed_rows(column) >= threshold:
+                update_index(table, col)
+        return [col for col in columns 
+                if _index_status(getattr(table.cols, col)) != before[col]]
+
+    def state(self):
+        """
+            dict of column -> index state for indexed and policy columns
+        """
+        table = self.table
+        settings = self.settings or {}
+        columns = [col for col in table.colnames if table.colindexed[col]]
+        columns.extend(col for col in settings.get('columns', []) if col not in columns)
+
+        nrows = int(table.nrows)
+        state = {}
+        for col in columns:
+            column = getattr(table.cols, col)
+            if not column.is_indexed:
+                state[col] = {'indexed': False}
+                continue
+            index = column.index
+            indexed = int(index.nelements)
+            state[col] = {
+                'indexed': True,
+                'kind': index.kind,
+                'optlevel': index.optlevel,
+                'dirty': bool(index.dirty),
+                'indexed_rows': indexed,
+                'unindexed_rows': nrows - indexed,
+                'coverage': float(indexed) / nrows if nrows else 1.0,
+            }
+        return state
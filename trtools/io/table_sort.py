@@ -0,0 +1,178 @@
+"""
+    Out-of-core sorting of pytables Tables.
+
+    Sorted runs that fit the memory budget are spilled to temporary tables next to
+    the destination and then k-way merged a block at a time.
+"""
+import time
+
+import numpy as np
+
+# default memory budget in bytes
+SORT_MEMORY = 256 * 1024 ** 2
+
+def _sort_order(data, by):
+    return np.lexsort([data[col] for col in reversed(by)])
+
+def _last_key(data, by):
+    return tuple(data[col][-1] for col in by)
+
+def _count_le(data, by, key):
+    """
+        Number of rows in lexsorted data that are <= key
+    """
+    lo, hi = 0, len(data)
+    last = len(by) - 1
+    for i, (col, val) in enumerate(zip(by, key)):
+        values = data[col][lo:hi]
+        if i == last:
+            return lo + np.searchsorted(values, val, side='right')
+        left = np.searchsorted(values, val, side='left')
+        right = np.searchsorted(values, val, side='right')
+        lo, hi = lo + left, lo + right
+
+def print_progress(phase, done, total, elapsed):
+    rate = done / elapsed if elapsed else 0
+    print(("sort {0}: {1}/{2} rows ({3:.0f} rows/s)".format(phase, done, total, rate)))
+
+class _RunReader(object):
+    """
+        Buffered reader over a sorted run
+    """
+    def __init__(self, run, buffer_rows):
+        self.run = run
+        self.buffer_rows = buffer_rows
+        self.pos = 0
+        self.data = None
+        self._fill()
+
+    def _fill(self):
+        stop = min(self.pos + self.buffer_rows, self.run.nrows)
+        self.data = self.run.read(self.pos, stop)
+        self.pos = stop
+
+    def take(self, n):
+        part = self.data[:n]
+        self.data = self.data[n:]
+        if len(self.data) == 0:
+            self._fill()
+        return part
+
+class ExternalSort(object):
+    """
+        Sort a table into dest, an empty table with the same description.
+
+        Parameters
+        ----------
+        table : pytables Table
+        dest : pytables Table
+        by : list of column names. Sorted lexicographically in that order.
+        memory : int
+            Memory budget in bytes. Roughly the size of the largest block held
+            in memory at once.
+        progress : callable(phase, done, total, elapsed)
+            Called after every run and merged block. See print_progress
+        on_write : callable(block, start)
+            Called with every block written to dest and its starting row
+    """
+    def __init__(self, table, dest, by, memory=None, progress=None, on_write=None):
+        self.table = table
+        self.dest = dest
+        self.by = list(by)
+        self.memory = memory or SORT_MEMORY
+        self.progress = progress
+        self.on_write = on_write
+        self.run_rows = max(int(self.memory // table.rowsize), 1)
+        self._start = None
+
+    def _report(self, phase, done):
+        if self.progress:
+            self.progress(phase, done, self.table.nrows, time.time() - self._start)
+
+    def _write(self, block):
+        start = self.dest.nrows
+        self.dest.append(block)
+        if self.on_write:
+            self.on_write(block, start)
+
+    def sort(self):
+        """
+            Returns stats dict of rows, runs, seconds, rows_per_sec
+        """
+        self._start = time.time()
+        nrows = self.table.nrows
+
+        if nrows <= self.run_rows:
+            data = self.table.read()
+            self._write(data[_sort_order(data, self.by)])
+            runs = 1
+        else:
+            group = self._create_run_group()
+            try:
+                runs = self._spill_runs(group)
+                self._merge(runs)
+                runs = len(runs)
+            finally:
+                group._f_remove(recursive=True)
+
+        self.dest.flush()
+        seconds = time.time() - self._start
+        self._report('done', nrows)
+        stats = {}
+        stats['rows'] = nrows
+        stats['runs'] = runs
+        stats['seconds'] = seconds
+        stats['rows_per_sec'] = nrows / seconds if seconds else 0
+        return stats
+
+    def _create_run_group(self):
+        handle = self.dest._v_file
+        parent = self.dest._v_parent
+        name = '_pd_sort_' + self.dest._v_name
+        if name in parent._v_children: # leftover from a failed sort
+            parent._v_children[name]._f_remove(recursive=True)
+        return handle.createGroup(parent, name)
+
+    def _spill_runs(self, group):
+        handle = group._v_file
+        nrows = self.table.nrows
+        runs = []
+        for i, start in enumerate(range(0, nrows, self.run_rows)):
+            stop = min(start + self.run_rows, nrows)
+            data = self.table.read(start, stop)
+            data = data[_sort_order(data, self.by)]
+            run = handle.createTable(group, 'run{0}'.format(i), self.table.description,
+                                     expectedrows=len(data))
+            run.append(data)
+            run.flush()
+            runs.append(run)
+            del data
+            self._report('runs', stop)
+        return runs
+
+    def _merge(self, runs):
+        by = self.by
+        # keep about half the budget for the merged block
+        buffer_rows = max(self.run_rows // (2 * len(runs)), 1)
+        readers = [_RunReader(run, buffer_rows) for run in runs]
+
+        done = 0
+        while True:
+            live = [reader for reader in readers if len(reader.data)]
+            if not live:
+                break
+            # every row <= the smallest buffered last key is safe to write
+            frontier = min(_last_key(reader.data, by) for reader in live)
+            parts = []
+            for reader in live:
+                n = _count_le(reader.data, by, frontier)
+                if n:
+                    parts.append(reader.take(n))
+            block = np.concatenate(parts)
+            self._write(block[_sort_order(block, by)])
+            done += len(block)
+            self._report('merge', done)
+
+def external_sort(table, dest, by, memory=None, progress=None, on_write=None):
+    sorter = ExternalSort(table, dest, by, memory=memory, progress=progress, on_write=on_write)
+    return sorter.sort()
@@ -0,0 +1,67 @@
+"""
+    Rough timings for the HDF5 read/write paths.
+
+    Not part of the test suite. Run directly:
+        python -m trtools.io.tests.bench_io
+"""
+import pandas as pd
+import numpy as np
+
+import trtools.io.api as tb
+import trtools.io.pytables as pytables
+from trtools.util.testing import Timer
+from trtools.util.tempdir import TemporaryDirectory
+
+def bench_frame(N=1000000, ncols=10):
+    ind = pd.date_range(start="2000-01-01", freq="S", periods=N)
+    data = dict(('col{0}'.format(i), np.random.randn(N)) for i in range(ncols))
+    df = pd.DataFrame(data, index=ind)
+    df.index.name = 'timestamp'
+    return df
+
+def bench_write(df):
+    """
+        recarray append vs streamed append_frame
+    """
+    with TemporaryDirectory() as td:
+        handle = tb.HDF5Handle(td + '/recarray.h5', 'w')
+        group = handle.create_group('data')
+        table = group.frame_to_table('data_table', df, create_only=True).table
+        with Timer('recarray append'):
+            desc, recs, types = pytables.convert_frame(df)
+            table.append(recs)
+            table.flush()
+        handle.close()
+
+        handle = tb.HDF5Handle(td + '/chunked.h5', 'w')
+        group = handle.create_group('data')
+        with Timer('append_frame'):
+            group.frame_to_table('data_table', df)
+        handle.close()
+
+def bench_layout(df, columns=None):
+    """
+        row layout vs column layout. Write, full read, reading a couple of 
+        columns and a query on one column
+    """
+    if columns is None:
+        columns = list(df.columns[:2])
+    query_col = columns[0]
+    with TemporaryDirectory() as td:
+        for layout in ['rows', 'columns']:
+            store = tb.HDFFile(td + '/' + layout, 'w', layout=layout)
+            with Timer('{0} write'.format(layout)):
+                store.save(df)
+            table = store.table
+            with Timer('{0} read all'.format(layout)):
+                table[:]
+            with Timer('{0} read {1}'.format(layout, columns)):
+                table.ix[:, columns]
+            with Timer('{0} query {1} > 1'.format(layout, query_col)):
+                table.query(getattr(table.sql, query_col) > 1)
+            store.close()
+
+if __name__ == '__main__':
+    df = bench_frame()
+    bench_write(df)
+    bench_layout(bench_frame(ncols=100))
@@ -1,8 +1,13 @@
 from unittest import TestCase
 from io import StringIO
 
+import pandas as pd
+
 from trtools.util.tempdir import TemporaryDirectory
 import trtools.io.filecache as fc
+import trtools.io.api as tb
+import trtools.util.testing as tm
+from trtools.core.column_panel import ColumnPanel
 
 class TestFileCache(TestCase):
 
@@ -61,6 +66,92 @@ class TestMetaFileCache(TestCase):
             for a,b in zip( list(mfc2.keys()), list(mfc.keys())):
                 assert a.key == b.key
 
+class TestOBTFileCache(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        TestCase.__init__(self, *args, **kwargs)
+
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        pass
+
+    def test_buffered(self):
+        df = tm.fake_ohlc(N=100)
+        with TemporaryDirectory() as td:
+            with tb.OBTFileCache(td + '/obt.h5', frame_key='symbol', buffer_rows=250) as cache:
+                cache['AAPL'] = df
+                cache['MSFT'] = df
+                obt = cache.obt_context.obt
+                assert len(obt._buffer) == 200
+                assert not hasattr(obt.group, 'obt') # nothing written yet
+
+                # crosses the threshold
+                cache['IBM'] = df
+                assert len(obt._buffer) == 0
+                assert obt.table.nrows == 300
+
+                # reads flush first
+                cache['GOOG'] = df
+                assert cache.keys() == ['AAPL', 'MSFT', 'IBM', 'GOOG']
+
+            cache = tb.OBTFileCache(td + '/obt.h5', frame_key='symbol')
+            tm.assert_frame_equal(cache['GOOG'], df, check_names=False)
+            cache.close()
+
+class TestHDF5Dataset(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        TestCase.__init__(self, *args, **kwargs)
+
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        pass
+
+    def test_dataset(self):
+        df = tm.fake_ohlc(N=100)
+        df.index = pd.DatetimeIndex(start='2000-01-01', freq='D', periods=100)
+        late = df.copy()
+        late.index = df.index.shift(200)
+        with TemporaryDirectory() as td:
+            cache = tb.HDF5FileCache(td)
+            cache['AAPL'] = df
+            cache['MSFT'] = df
+            cache['IBM'] = late
+            ds = cache.dataset()
+            manifest = ds.manifest()
+            assert ds.keys() == ['AAPL', 'IBM', 'MSFT']
+            assert manifest['IBM']['nrows'] == 100
+            assert manifest['IBM']['start'] == late.index[0].value
+
+            # the manifest isn't a key
+            assert sorted(cache.keys()) == ['AAPL', 'IBM', 'MSFT']
+
+            # IBM is pruned by date
+            assert ds.prune(start='2000-02-01', end='2000-03-01') == ['AAPL', 'MSFT']
+            result = ds.read(start='2000-02-01', end='2000-03-01', processes=2)
+            expected = df.ix['2000-02-01':'2000-03-01']
+            tm.assert_frame_equal(result.ix['MSFT'], expected, check_names=False)
+
+            # nothing survives, same shape as a read that found rows
+            empty = ds.read(end='1999-01-01')
+            assert len(empty) == 0
+            assert empty.index.nlevels == 2
+            assert list(empty.columns) == list(df.columns)
+
+            result = ds.read(keys=['IBM', 'MSFT'], columns=['close'], processes=1)
+            tm.assert_frame_equal(result.ix['IBM'], late[['close']], check_names=False)
+
+            panel = ds.read(keys=['AAPL', 'MSFT'], panel=True)
+            assert isinstance(panel, ColumnPanel)
+
+            # rewritten files are picked up
+            cache['MSFT'] = late
+            assert ds.prune(end='2000-03-01') == ['AAPL']
+
 if __name__ == '__main__':                                                                                          
     import nose                                                                      
     nose.runmodule(argv=[__file__,'-vvs','-x','--pdb', '--pdb-failure'],exit=False)   
@@ -0,0 +1,49 @@
+from unittest import TestCase
+
+import pandas as pd
+import numpy as np
+
+import trtools.io.api as tb
+import trtools.util.testing as tm
+from trtools.util.tempdir import TemporaryDirectory
+
+df = tm.fake_ohlc(N=100)
+
+class TestHandlePool(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        TestCase.__init__(self, *args, **kwargs)
+
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        pass
+
+    def test_filecache_pool(self):
+        with TemporaryDirectory() as td:
+            pool = tb.HandlePool(maxsize=2)
+            cache = tb.HDF5FileCache(td, pool=pool)
+            cache.put('AAPL', df)
+            cache.put('MSFT', df)
+
+            # reuses the handle left open by put
+            tm.assert_frame_equal(cache.get('AAPL'), df, check_names=False)
+            assert pool.stats()['hits'] == 1
+
+            # evicts MSFT, the least recently used
+            cache.put('IBM', df)
+            assert len(pool) == 2
+            assert pool.stats()['evictions'] == 1
+
+            # evicted handle was flushed before closing
+            tm.assert_frame_equal(cache.get('MSFT'), df, check_names=False)
+            stats = pool.stats()
+            assert stats['hits'] == 1
+            assert stats['misses'] == 4
+            pool.close_all()
+            assert len(pool) == 0
+
+if __name__ == '__main__':                                                                                          
+    import nose                                                                      
+    nose.runmodule(argv=[__file__,'-vvs','-x','--pdb', '--pdb-failure'],exit=False)   
@@ -6,6 +6,11 @@ import numpy as np
 import trtools.io.api as tb
 import trtools.util.testing as tm
 from trtools.util.tempdir import TemporaryDirectory
+from trtools.core.timeseries import cython_ohlc
+from trtools.io.result_cache import ResultCache, frame_nbytes
+from trtools.io.rollups import Rollup
+from trtools.io.panda_hdf import OneBigTable
+from trtools.io.pytables import MAX_TABLE_COLUMNS
 
 ind = pd.DatetimeIndex(start="2000-01-01", freq="30min", periods=300)
 df = pd.DataFrame({
@@ -45,6 +50,330 @@ class TestHDFFile(TestCase):
             assert store.handle.meta('testtest') == 123
             assert store.table.meta('testtest') == 456
 
+    def test_zonemap(self):
+        with TemporaryDirectory() as td:
+            store = tb.HDFFile(td + '/test', 'w')
+            store.append(df)
+            table = store.table
+            table.add_zonemap(['timestamp', 'open'], blocksize=32)
+            zonemap = table.zonemap
+            assert zonemap.covered == len(df)
+
+            ind = df.index
+            query = table.sql.index > ind[250]
+            # row 250 is in the block starting at 224
+            assert zonemap.row_ranges(query.terms) == [slice(224, len(df))]
+            tm.assert_frame_equal(table[query], df[df.index > ind[250]], check_names=False)
+
+            # between doesn't need to load the whole index
+            rows = table.index.between(ind[10], ind[20])
+            assert (rows.start, rows.end) == (10, 21)
+            assert table.index._values is None
+
+            # appends keep the stats current
+            df2 = df.copy()
+            df2.index = df.index.shift(len(df))
+            store.append(df2)
+            assert zonemap.covered == len(df) * 2
+            rows = table.index.between(df2.index[0], df2.index[5])
+            assert (rows.start, rows.end) == (len(df), len(df) + 6)
+            store.close()
+
+    def test_zonemap_append(self):
+        """
+            A warm zone map picks up the stats of appended rows
+        """
+        with TemporaryDirectory() as td:
+            store = tb.HDFFile(td + '/test', 'w')
+            store.append(df)
+            table = store.table
+            table.add_zonemap(['timestamp', 'open'], blocksize=32)
+            query = table.sql.index > ind[250]
+            assert len(table[query]) == len(df) - 251
+            assert table.zonemap.stats
+
+            df2 = df.copy()
+            df2.index = df.index.shift(len(df))
+            store.append(df2)
+            both = pd.concat([df, df2])
+            tm.assert_frame_equal(table[query], both[both.index > ind[250]], check_names=False)
+
+            query = (table.sql.index > ind[250]) & (table.sql.open > 0)
+            expected = both[(both.index > ind[250]) & (both.open > 0)]
+            tm.assert_frame_equal(table[query], expected, check_names=False)
+
+            rows = table.index.between(df2.index[0], df2.index[5])
+            assert (rows.start, rows.end) == (len(df), len(df) + 6)
+            store.close()
+
+    def test_result_cache(self):
+        with TemporaryDirectory() as td:
+            cache = ResultCache()
+            store = tb.HDFFile(td + '/test', 'w', result_cache=cache)
+            store.append(df)
+            table = store.table
+            query = table.sql.open > 0
+            expected = df[df.open > 0]
+
+            first = table.query(query)
+            tm.assert_frame_equal(table.query(query), first)
+            tm.assert_frame_equal(table.ix[10:20, ['vol']], df.ix[10:20, ['vol']], check_names=False)
+            table.ix[10:20, ['vol']]
+            stats = cache.stats()
+            assert (stats['hits'], stats['misses']) == (2, 2)
+            assert stats['nbytes'] > 0
+
+            # callers get copies
+            result = table.query(query)
+            result['open'] = 0
+            tm.assert_frame_equal(table.query(query), expected, check_names=False)
+
+            # appends drop the table's entries
+            store.append(df)
+            assert len(cache) == 0
+            assert len(table.query(query)) == len(expected) * 2
+
+            # bounded by bytes, room for one half of the table
+            small = ResultCache(maxbytes=frame_nbytes(df))
+            table.result_cache = small
+            table[:len(df)]
+            table[len(df):]
+            table[:] # too big to cache
+            assert len(small) == 1
+            assert small.stats()['evictions'] == 1
+            store.close()
+
+    def test_rollups(self):
+        expected = df.groupby(df.index.normalize()).agg(cython_ohlc)
+        expected = expected.reindex(columns=['open', 'high', 'low', 'close', 'vol'])
+        with TemporaryDirectory() as td:
+            store = tb.HDFFile(td + '/test', 'w')
+            # split mid day so the trailing bar has to be merged
+            store.append(df[:110])
+            store.add_rollup('D')
+            assert len(store.rollup('D')) == 3
+            store.append(df[110:200])
+            store.append(df[200:])
+            tm.assert_frame_equal(store.rollup('D'), expected, check_names=False)
+            bars = store.rollup('D', start='2000-01-03', end='2000-01-04')
+            tm.assert_frame_equal(bars, expected.ix['2000-01-03':'2000-01-04'], check_names=False)
+
+            # rollups are hidden and survive a reopen
+            store.close()
+            store = tb.HDFFile(td + '/test')
+            assert list(store.handle.data.keys()) == ['data_table']
+            tm.assert_frame_equal(store.rollup('D'), expected, check_names=False)
+
+            # appends below the store keep them current too
+            more = df.copy()
+            more.index = df.index.shift(len(df))
+            store.table.append(more[:10])
+            assert Rollup(store.table.table, 'D').settings['source_rows'] == len(df) + 10
+
+            # rows written straight to pytables are caught up on read
+            recs = store.table.table.read(10, 20)
+            recs['timestamp'] = more.index[10:20].asi8
+            store.table.table.append(recs)
+            both = pd.concat([df, more[:20]])
+            expected = both.groupby(both.index.normalize()).agg(cython_ohlc)
+            expected = expected.reindex(columns=['open', 'high', 'low', 'close', 'vol'])
+            tm.assert_frame_equal(store.rollup('D'), expected, check_names=False)
+            store.close()
+
+    def test_rollup_string_keys(self):
+        data = df[['open', 'high', 'low', 'close', 'vol']].copy()
+        data['venue'] = np.array([b'X'] * 100 + [b'LONG_VENUE_NAME'] * 200, dtype=object)
+        with TemporaryDirectory() as td:
+            handle = tb.HDF5Handle(td + '/test.h5', 'w')
+            group = handle.create_group('data')
+            table = group.frame_to_table('data_table', data[:100], dtypes={'venue': 'S20'})
+            rollup = Rollup(table.table, 'D', by='venue')
+            rollup.create()
+
+            # keys longer than the ones seen at create still fit
+            table.append(data[100:])
+            assert rollup.node.coldtypes['venue'] == np.dtype('S20')
+            assert rollup.trailing_node.coldtypes['venue'] == np.dtype('S20')
+            bars = rollup.read()
+            assert set(bars.venue) == set(table[:].venue)
+            assert len(bars) == len(data.groupby([data.index.normalize(), data.venue]))
+            handle.close()
+
+class TestSplitTable(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        TestCase.__init__(self, *args, **kwargs)
+
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        pass
+
+    def test_wide_frame(self):
+        wide = pd.DataFrame(np.random.randn(len(ind), 10), index=ind, 
+                            columns=['c{0}'.format(i) for i in range(10)])
+        wide.index.name = 'timestamp'
+        with TemporaryDirectory() as td:
+            store = tb.HDFFile(td + '/test', 'w', max_columns=4)
+            store.save(wide)
+            table = store.table
+            assert table.column_groups == [['c0', 'c1', 'c2', 'c3'], ['c4', 'c5', 'c6', 'c7'], 
+                                           ['c8', 'c9']]
+            assert len(table.tables[0].colnames) == 5 # index plus columns
+            tm.assert_frame_equal(table[:], wide, check_names=False)
+
+            # projection only touches the groups it needs
+            result = table.ix[10:20, ['c9', 'c1']]
+            tm.assert_frame_equal(result, wide.ix[10:20, ['c9', 'c1']], check_names=False)
+            assert table._tables_for(['c9', 'c1'])[0][1] == ['c1']
+
+            rows = table.index.between(ind[10], ind[20])
+            assert (rows.start, rows.end) == (10, 21)
+
+            # query on a column in the second group
+            result = table.query(table.sql.c5 > 0, columns=['c0'])
+            tm.assert_frame_equal(result, wide.ix[wide.c5 > 0, ['c0']], check_names=False)
+
+            store.append(wide)
+            assert table.nrows == len(wide) * 2
+            tm.assert_frame_equal(table[len(wide):], wide, check_names=False)
+
+            # a group that fails to convert takes the other groups with it
+            bad = wide.copy()
+            bad['c9'] = np.array(['x'] * len(wide), dtype=object)
+            self.assertRaises(Exception, table.append, bad)
+            assert [t.nrows for t in table.tables] == [len(wide) * 2] * 3
+            tm.assert_frame_equal(table[len(wide):], wide, check_names=False)
+            store.close()
+
+            # only HDFFile splits, OBTs stay one table
+            wider = pd.DataFrame(np.random.randn(20, MAX_TABLE_COLUMNS + 1), index=ind[:20],
+                                 columns=['c{0}'.format(i) for i in range(MAX_TABLE_COLUMNS + 1)])
+            wider.index.name = 'timestamp'
+            obt = tb.OBTFile(td + '/obt', 'w', 'symbol', type='directory')
+            obt['AAPL'] = wider
+            assert obt.obt.table.table.nrows == len(wider)
+            tm.assert_frame_equal(obt.ix['AAPL'], wider, check_names=False)
+            obt.close()
+
+class TestColumnTable(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        TestCase.__init__(self, *args, **kwargs)
+
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        pass
+
+    def test_column_layout(self):
+        with TemporaryDirectory() as td:
+            store = tb.HDFFile(td + '/test', 'w', layout='columns')
+            store.append(df)
+            table = store.table
+            assert table.nrows == len(df)
+            assert table.obj.c0.atom.dtype == np.float64 # one array per column
+            tm.assert_frame_equal(table[:], df, check_names=False)
+            tm.assert_frame_equal(table[10:20], df[10:20], check_names=False)
+
+            cols = ['vol', 'open']
+            tm.assert_frame_equal(table.ix[10:20, cols], df.ix[10:20, cols], check_names=False)
+            mask = (df.open > 0).values
+            tm.assert_frame_equal(table[mask], df[mask], check_names=False)
+
+            query = (table.sql.open > 0) & (table.sql.index > df.index[100])
+            expected = df[(df.open > 0) & (df.index > df.index[100])]
+            tm.assert_frame_equal(table.query(query), expected, check_names=False)
+            tm.assert_frame_equal(table.ix[query, cols], expected[cols], check_names=False)
+
+            rows = table.index.between(df.index[10], df.index[20])
+            assert (rows.start, rows.end) == (10, 21)
+
+            store.append(df)
+            assert table.nrows == len(df) * 2
+            tm.assert_frame_equal(table[len(df):], df, check_names=False)
+
+            # a failed append leaves every column the same length
+            bad = df.copy()
+            bad['vol'] = ['a', 1.5] * (len(df) // 2)
+            self.assertRaises(Exception, store.append, bad)
+            lengths = set(array.nrows for name, array in table.obj._v_children.items()
+                          if not name.startswith('_pd_'))
+            assert lengths == set([len(df) * 2])
+            store.close()
+
+    def test_column_layout_strings(self):
+        syms = df[['open']].copy()
+        syms['sym'] = ['AAPL', 'MSFT', 'IBM'] * (len(df) // 3)
+        with TemporaryDirectory() as td:
+            store = tb.HDFFile(td + '/test', 'w', layout='columns')
+            store.append(syms)
+            table = store.table
+            query = table.sql.sym == 'AAPL'
+            tm.assert_frame_equal(table.query(query), syms[syms.sym == 'AAPL'], check_names=False)
+            query = (table.sql.sym != 'AAPL') & (table.sql.open > 0)
+            expected = syms[(syms.sym != 'AAPL') & (syms.open > 0)]
+            tm.assert_frame_equal(table.query(query), expected, check_names=False)
+            store.close()
+
+class TestPartitionedTable(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        TestCase.__init__(self, *args, **kwargs)
+
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        pass
+
+    def test_partitions(self):
+        with TemporaryDirectory() as td:
+            store = tb.HDFFile(td + '/test', 'w', partition='D')
+            store.append(df)
+            table = store.table
+            # 300 half hours starting 2000-01-01 is 7 days
+            assert table.keys() == ['p2000010{0}'.format(i) for i in range(1, 8)]
+            assert table.nrows == len(df)
+            tm.assert_frame_equal(table[:], df, check_names=False)
+
+            ind = df.index
+            tm.assert_frame_equal(table.read(ind[50], ind[150]), df.ix[50:151], check_names=False)
+            rows = table.index.between(ind[50], ind[150])
+            assert (rows.start, rows.end) == (50, 151)
+            cols = ['vol', 'open']
+            tm.assert_frame_equal(table.ix[rows, cols], df.ix[50:151, cols], check_names=False)
+
+            # only the partitions past the bound are queried
+            query = (table.sql.index > ind[250]) & (table.sql.open > 0)
+            expected = df[(df.index > ind[250]) & (df.open > 0)]
+            tm.assert_frame_equal(table.query(query), expected, check_names=False)
+
+            dropped = table.drop_before('2000-01-03')
+            assert dropped == ['p20000101', 'p20000102']
+            tm.assert_frame_equal(table[:], df[df.index >= '2000-01-03'], check_names=False)
+            store.close()
+
+    def test_partition_categories(self):
+        data = df[['open', 'vol']].copy()
+        # the first day only has MSFT, later days see AAPL first
+        odd = np.arange(len(data)) % 2 == 1
+        data['sym'] = np.where((data.index.day == 1) | odd, 'MSFT', 'AAPL')
+        with TemporaryDirectory() as td:
+            store = tb.HDFFile(td + '/test', 'w', partition='D', categories=['sym'])
+            store.append(data)
+            table = store.table
+            tm.assert_frame_equal(table[:], data, check_names=False)
+
+            # every partition shares one vocabulary
+            sql = table.sql
+            for sym in ['MSFT', 'AAPL']:
+                result = table.query(sql.sym == sym)
+                tm.assert_frame_equal(result, data[data.sym == sym], check_names=False)
+            store.close()
+
 class TestOBTFile(TestCase):
 
     def __init__(self, *args, **kwargs):
@@ -72,6 +401,173 @@ class TestOBTFile(TestCase):
             assert store.handle.meta('testtest') == 123
             assert store.obt.meta('testtest') == 456
 
+    def test_frame_key_directory(self):
+        with TemporaryDirectory() as td:
+            store = tb.OBTFile(td + '/test', 'w', 'symbol', type='directory')
+            store['AAPL'] = df
+            store['MSFT'] = df
+            obt = store.obt
+            assert obt.directory.get('MSFT') == slice(len(df), len(df) * 2)
+            assert obt.keys() == ['AAPL', 'MSFT']
+            tm.assert_frame_equal(store.ix['MSFT'], df, check_names=False)
+
+            # AAPL is now in two blocks, fall back to where queries
+            store['AAPL'] = df
+            assert obt.directory.ranges is None
+            assert len(store.ix['AAPL']) == len(df) * 2
+
+            # sorting by frame_key makes every key contiguous again
+            obt.sort_index(by=['symbol', 'timestamp'])
+            assert obt.directory.get('AAPL') == slice(0, len(df) * 2)
+            assert obt.keys() == ['AAPL', 'MSFT']
+            store.close()
+
+    def test_frame_key_directory_stale(self):
+        with TemporaryDirectory() as td:
+            store = tb.OBTFile(td + '/test', 'w', 'symbol', type='directory')
+            store['AAPL'] = df
+            store['MSFT'] = df
+            obt = store.obt
+            other = OneBigTable(obt.group)
+            assert other.directory.get('MSFT') == slice(len(df), len(df) * 2)
+
+            # appended without going through the directory
+            new = df.copy()
+            new['symbol'] = 'AAPL'
+            obt.table.append(new)
+            assert obt.directory.ranges is None
+            assert len(store.ix['AAPL']) == len(df) * 2
+            assert obt.keys() == ['AAPL', 'MSFT']
+
+            # the other instance sees the node is gone
+            assert other.directory.ranges is None
+            assert len(other.get_many(['AAPL'])['AAPL']) == len(df) * 2
+            store.close()
+
+    def test_get_many(self):
+        with TemporaryDirectory() as td:
+            store = tb.OBTFile(td + '/test', 'w', 'symbol', type='directory')
+            for sym in ['AAPL', 'MSFT', 'IBM']:
+                store[sym] = df
+            obt = store.obt
+            assert obt.keys() == ['AAPL', 'IBM', 'MSFT']
+
+            # directory ranges
+            frames = store.get_many(['IBM', 'AAPL', 'BOB'])
+            assert set(frames.keys()) == set(['IBM', 'AAPL', 'BOB'])
+            tm.assert_frame_equal(frames['IBM'], df, check_names=False)
+            tm.assert_frame_equal(frames['AAPL'], df, check_names=False)
+            assert len(frames['BOB']) == 0
+
+            # no directory, one scan of the frame_key column
+            store['AAPL'] = df
+            assert obt.directory.ranges is None
+            assert obt.keys() == ['AAPL', 'IBM', 'MSFT']
+            frames = store.ix[['AAPL', 'IBM']]
+            assert len(frames['AAPL']) == len(df) * 2
+            tm.assert_frame_equal(frames['IBM'], df, check_names=False)
+            store.close()
+
+    def test_category_frame_key(self):
+        with TemporaryDirectory() as td:
+            store = tb.OBTFile(td + '/test', 'w', 'symbol', type='directory',
+                               categories=['symbol'])
+            store['AAPL'] = df
+            store['MSFT'] = df
+            obt = store.obt
+            table = obt.table.table
+            assert table.coldtypes['symbol'] == np.int32
+            assert obt.keys() == ['AAPL', 'MSFT']
+            tm.assert_frame_equal(store.ix['MSFT'], df, check_names=False)
+
+            # queries compare codes
+            sql = obt.table.sql
+            result = obt.table.query(sql.symbol == 'MSFT')
+            assert len(result) == len(df)
+            assert list(set(result.symbol)) == ['MSFT']
+            assert len(obt.table.query(sql.symbol == 'BOB')) == 0
+            assert len(obt.table.query(sql.symbol.isin(['AAPL', 'MSFT']))) == len(df) * 2
+
+            # no directory, codes found by scanning
+            store['AAPL'] = df
+            assert obt.directory.ranges is None
+            assert len(store.ix['AAPL']) == len(df) * 2
+            assert obt.keys() == ['AAPL', 'MSFT']
+            frames = store.get_many(['MSFT', 'BOB'])
+            tm.assert_frame_equal(frames['MSFT'], df, check_names=False)
+            store.close()
+
+    def test_aggregate(self):
+        with TemporaryDirectory() as td:
+            store = tb.OBTFile(td + '/test', 'w', 'symbol', type='directory')
+            for sym in ['AAPL', 'MSFT', 'IBM']:
+                store[sym] = df
+            obt = store.obt
+
+            # small chunks so groups span chunks and partials get merged
+            bars = obt.ohlc('D', chunksize=50)
+            assert bars.index.names == ['symbol', 'timestamp']
+            expected = df.groupby(df.index.normalize()).agg(cython_ohlc)
+            expected = expected.reindex(columns=['open', 'high', 'low', 'close', 'vol'])
+            for sym in ['AAPL', 'MSFT', 'IBM']:
+                tm.assert_frame_equal(bars.xs(sym), expected, check_names=False)
+
+            stats = obt.table.aggregate({'vol': ['sum', 'mean', 'count']}, by='symbol',
+                                        chunksize=70)
+            assert list(stats[('vol', 'count')]) == [len(df)] * 3
+            tm.assert_almost_equal(stats[('vol', 'sum')]['MSFT'], df.vol.sum())
+            tm.assert_almost_equal(stats[('vol', 'mean')]['IBM'], df.vol.mean())
+            store.close()
+
+    def test_rollups(self):
+        with TemporaryDirectory() as td:
+            store = tb.OBTFile(td + '/test', 'w', 'symbol', type='directory')
+            store['AAPL'] = df[:100]
+            store['MSFT'] = df[:50]
+            obt = store.obt
+            obt.add_rollup('H')
+            # MSFT's trailing bar is merged, IBM is a new key
+            store['AAPL'] = df[100:]
+            store['MSFT'] = df[50:]
+            store['IBM'] = df
+
+            expected = obt.ohlc('H')
+            bars = obt.rollup('H').swaplevel(0, 1).sortlevel()
+            tm.assert_frame_equal(bars, expected, check_names=False)
+
+            # one trailing bar per key, kept in its own table
+            rollup = Rollup(obt.table.table, 'H')
+            assert rollup.trailing_node.nrows == 3
+            assert 'trailing' not in rollup.settings
+            store.close()
+
+    def test_external_sort(self):
+        """
+            A memory budget smaller than the table forces spilled runs and a merge
+        """
+        with TemporaryDirectory() as td:
+            store = tb.OBTFile(td + '/test', 'w', 'symbol', type='directory')
+            store['MSFT'] = df
+            store['AAPL'] = df
+            store['IBM'] = df
+            obt = store.obt
+            rowsize = obt.table.table.rowsize
+            stats = obt.sort_index(by=['symbol', 'timestamp'], memory=rowsize * 100)
+            assert stats['runs'] == 9
+            assert stats['rows'] == len(df) * 3
+
+            symbols = obt.table.table.col('symbol')
+            assert list(symbols) == sorted(symbols)
+            assert obt.keys() == ['AAPL', 'IBM', 'MSFT']
+            tm.assert_frame_equal(store.ix['IBM'], df, check_names=False)
+
+            # the default index order interleaves keys, no directory
+            obt.sort_index()
+            assert obt.directory.ranges is None
+            assert obt.keys() == ['AAPL', 'IBM', 'MSFT']
+            tm.assert_frame_equal(store.ix['IBM'], df, check_names=False)
+            store.close()
+
     def test_tuple_frame_key(self):
         """
             Moved OBT to default to directory format. Test the the meta is working
@@ -4,6 +4,9 @@ import pandas as pd
 import numpy as np
 
 import trtools.io.api as tb
+import trtools.io.pytables as pytables
+import trtools.io.table_indexing as table_indexing
+import trtools.io.prefetch as prefetch
 import trtools.util.testing as tm
 from trtools.util.tempdir import TemporaryDirectory
 
@@ -72,6 +75,401 @@ class TestPyTables(TestCase):
                 # if properly throwing erros, we should never reach here
                 tm.assert_frame_equal(temp, df, "dataframe returned from HDF is different")
 
+    def test_append_frame_chunked(self):
+        """
+            Writing in chunks smaller than the frame should not change the data
+        """
+        with TemporaryDirectory() as td:
+            handle = tb.HDF5Handle(td + '/test.h5', 'w')
+            group = handle.create_group('data')
+            table = group.frame_to_table('data_table', df, chunksize=7)
+            assert table.table.nrows == len(df)
+            tm.assert_frame_equal(table[:], df, check_names=False)
+
+            # appending goes through the same path
+            table.append(df, chunksize=11)
+            assert table.table.nrows == len(df) * 2
+            tm.assert_frame_equal(table[len(df):], df, check_names=False)
+
+            # a chunk that fails to convert takes the earlier chunks with it
+            bad = df.copy()
+            bad['vol'] = np.array(list(df.vol[:200]) + ['x'] * 100, dtype=object)
+            self.assertRaises(Exception, table.append, bad, chunksize=50)
+            assert table.table.nrows == len(df) * 2
+            handle.close()
+
+    def test_chunked_reads(self):
+        with TemporaryDirectory() as td:
+            store = tb.OBTFile(td+'/test.h5', 'w', 'symbol')
+            store['AAPL'] = df
+            store['MSFT'] = df
+            table = store.obt.table
+
+            chunks = list(table.iter_frames(chunksize=100))
+            assert len(chunks) == 6
+            assert all(len(chunk) == 100 for chunk in chunks)
+
+            query = table.sql.symbol == 'MSFT'
+            chunks = list(table.query(query, chunksize=100))
+            assert all(len(chunk) <= 100 for chunk in chunks)
+            result = pd.concat(chunks)
+            del result['symbol']
+            tm.assert_frame_equal(result, df, check_names=False)
+            store.close()
+
+    def test_column_projection(self):
+        with TemporaryDirectory() as td:
+            store = tb.OBTFile(td+'/test.h5', 'w', 'symbol')
+            store['AAPL'] = df
+            store['MSFT'] = df
+            table = store.obt.table
+            cols = ['open', 'close']
+
+            result = table.ix[10:20, cols]
+            tm.assert_frame_equal(result, df.ix[10:20, cols], check_names=False)
+
+            # single column only returns the rows asked for
+            result = table.ix[10:20, 'vol']
+            tm.assert_frame_equal(result, df.ix[10:20, ['vol']], check_names=False)
+
+            # int and list rows
+            tm.assert_frame_equal(table.ix[5, ['vol']], df.ix[[5], ['vol']], check_names=False)
+            result = table.ix[[1, 3], cols]
+            tm.assert_frame_equal(result, df.ix[[1, 3], cols], check_names=False)
+
+            query = table.sql.symbol == 'MSFT'
+            result = table.query(query, columns=cols)
+            assert list(result.columns) == cols
+            tm.assert_frame_equal(result, df[cols], check_names=False)
+            store.close()
+
+    def test_coordinate_cache(self):
+        with TemporaryDirectory() as td:
+            store = tb.OBTFile(td+'/test.h5', 'w', 'symbol')
+            store['AAPL'] = df
+            store['MSFT'] = df
+            table = store.obt.table
+
+            query = table.sql.symbol == 'MSFT'
+            first = table.query(query)
+            # persisted next to the table
+            cache = table.coords.group
+            assert cache is not None
+            key = table_indexing.coord_key(str(query), query.terms)
+            assert key in cache._v_attrs.entries
+            assert '_pd_coords_obt' not in store.obt.group.keys()
+
+            # served from cache
+            slices = table.coords.slices(str(query), terms=query.terms)
+            assert slices == [slice(len(df), len(df) * 2)]
+            tm.assert_frame_equal(table.query(query), first)
+
+            # keys don't grow with the values, and differ with them
+            big = table.sql.symbol.isin(['S{0}'.format(i) for i in range(1000)])
+            big_key = table_indexing.coord_key(str(big), big.terms)
+            assert len(big_key) < 100
+            other = table.sql.symbol == 'AAPL'
+            assert table_indexing.coord_key(str(other), other.terms) != key
+
+            # capped
+            coords = table_indexing.CoordinateCache(table.table, max_entries=2)
+            for value in [-1, 0, 1]:
+                where = table.sql.open > value
+                coords.slices(str(where), terms=where.terms)
+            assert len(coords._memory) == 2
+            assert len(coords.group._v_attrs.entries) == 2
+
+            # appends invalidate
+            store['MSFT'] = df
+            assert table.coords.group is None
+            result = table.query(query)
+            assert len(result) == len(df) * 2
+            store.close()
+
+    def test_meta_cache(self):
+        with TemporaryDirectory() as td:
+            handle = tb.HDF5Handle(td + '/test.h5', 'w')
+            group = handle.create_group('data')
+            table = group.frame_to_table('data_table', df)
+            meta = table.meta()
+            assert meta['index_name'] == 'timestamp'
+
+            # changed behind our back, still cached
+            table.table._v_attrs.pd_meta = dict(meta, index_name='bob')
+            assert table.meta('index_name') == 'timestamp'
+            pytables.clear_meta_cache(handle)
+            assert table.meta('index_name') == 'bob'
+
+            # writes go through the cache
+            table.meta('index_name', 'timestamp')
+            assert table.meta('index_name') == 'timestamp'
+
+            # reads share the cached dict, .meta() hands out copies
+            assert pytables._meta(table) is pytables._meta(table)
+            meta = table.meta()
+            meta['columns'] = []
+            meta = table.meta()
+            meta['columns'].append('bob')
+            meta['value_types'].clear()
+            table.columns.append('bob')
+            assert table.meta('columns') == list(df.columns)
+            assert pytables._meta(table)['value_types']
+            assert group.data_table.columns == list(df.columns)
+            handle.close()
+
+    def test_bound_query(self):
+        with TemporaryDirectory() as td:
+            store = tb.OBTFile(td+'/test.h5', 'w', 'symbol')
+            for sym in ['AAPL', 'MSFT', 'IBM']:
+                store[sym] = df
+            table = store.obt.table
+            sql = table.sql
+
+            # same shape, different values share a condition
+            q1 = (sql.symbol == 'AAPL') & (sql.open > 0)
+            q2 = (sql.symbol == 'IBM') & (sql.open > 1)
+            cond1, vars1 = table_indexing.compile_terms(q1.terms)
+            cond2, vars2 = table_indexing.compile_terms(q2.terms)
+            assert cond1 == cond2
+            assert vars1 != vars2
+
+            result = table.query(q2, chunksize=100)
+            result = pd.concat(list(result))
+            assert len(result) == (df.open > 1).sum()
+
+            # isin, scan and index lookup
+            query = sql.symbol.isin(['AAPL', 'IBM'])
+            result = table.query(query)
+            assert len(result) == len(df) * 2
+            assert set(result.symbol) == set(['AAPL', 'IBM'])
+            store.obt.add_index('symbol')
+            tm.assert_frame_equal(pytables.table_to_frame(table.table, where=query), result)
+
+            # between is inclusive
+            lo, hi = df.index[10], df.index[20]
+            result = table.query(sql.index.between(lo, hi))
+            assert len(result) == 11 * 3
+            store.close()
+
+    def test_read_planner(self):
+        slices = [slice(0, 2), slice(4, 6), slice(6, 7), slice(100, 101)]
+        plan = table_indexing.plan_reads(slices, 8, gap=2)
+        assert plan == [(slice(0, 7), [slice(0, 2), slice(4, 7)]), 
+                        (slice(100, 101), [slice(0, 1)])]
+        plan = table_indexing.plan_reads(slices, 8, gap=0)
+        assert len(plan) == 3
+
+        with TemporaryDirectory() as td:
+            handle = tb.HDF5Handle(td + '/test.h5', 'w')
+            group = handle.create_group('data')
+            table = group.frame_to_table('data_table', df)
+
+            # scattered rows, merged reads give the same data
+            mask = np.zeros(len(df), dtype=bool)
+            mask[::3] = True
+            mask[50:60] = True
+            slices = table_indexing.create_slices(mask)
+            for gap in [0, 5, None]:
+                result = pytables.table_slices_to_frame(table.table, slices, gap=gap)
+                tm.assert_frame_equal(result, df[mask], check_names=False)
+                result = pytables.table_slices_to_frame(table.table, slices, columns=['vol'], gap=gap)
+                tm.assert_frame_equal(result, df[mask][['vol']], check_names=False)
+            handle.close()
+
+    def test_zonemap_not_equal(self):
+        val = np.zeros(64)
+        val[40] = np.nan
+        data = pd.DataFrame({'flag': np.zeros(64, dtype=int), 'val': val}, index=ind[:64])
+        data.index.name = 'timestamp'
+        with TemporaryDirectory() as td:
+            handle = tb.HDF5Handle(td + '/test.h5', 'w')
+            group = handle.create_group('data')
+            table = group.frame_to_table('data_table', data)
+            table.add_zonemap(['flag', 'val'], blocksize=32)
+
+            # blocks of one int value can be skipped
+            query = table.sql.flag != 0
+            assert table.zonemap.row_ranges(query.terms) == []
+            assert len(table[query]) == 0
+
+            # the NaN block still has to be read
+            query = table.sql.val != 0
+            assert table.zonemap.row_ranges(query.terms) == [slice(0, 64)]
+            assert len(table[query]) == 1
+            handle.close()
+
+    def test_native_dtypes(self):
+        narrow = pd.DataFrame({
+            'int8': np.arange(len(ind)).astype(np.int8),
+            'int16': np.arange(len(ind)).astype(np.int16),
+            'int32': np.arange(len(ind)).astype(np.int32),
+            'uint16': np.arange(len(ind)).astype(np.uint16),
+            'float32': np.random.randn(len(ind)).astype(np.float32),
+            'flag': np.arange(len(ind)) % 2 == 0,
+        }, index=ind)
+        narrow.index.name = 'timestamp'
+
+        desc, recs, types = tb.convert_frame(narrow)
+        for col in narrow.columns:
+            assert desc[col].dtype == narrow[col].dtype
+        assert types['flag'] == 'boolean'
+
+        with TemporaryDirectory() as td:
+            handle = tb.HDF5Handle(td + '/test.h5', 'w')
+            group = handle.create_group('data')
+            table = group.frame_to_table('data_table', narrow)
+            result = table[:]
+            for col in narrow.columns:
+                assert result[col].dtype == narrow[col].dtype
+            tm.assert_frame_equal(result, narrow, check_names=False)
+
+            result = table.query(table.sql.flag == True)
+            assert len(result) == narrow.flag.sum()
+
+            # int64 values that fit are narrowed, others raise instead of wrapping
+            wide = narrow.copy()
+            wide['int8'] = np.arange(len(ind)) % 100
+            table.append(wide)
+            assert table.nrows == len(narrow) * 2
+            wide['int8'] = np.arange(len(ind)) + 100
+            self.assertRaises(ValueError, table.append, wide)
+            wide = narrow.copy()
+            wide['flag'] = 1.5
+            self.assertRaises(ValueError, table.append, wide)
+            assert table.nrows == len(narrow) * 2
+            handle.close()
+
+    def test_datetime_tz(self):
+        eastern = ind.tz_localize('US/Eastern')
+        dates = pd.DataFrame({
+            'vol': np.random.randn(len(ind)),
+            'local': eastern,
+            'py_dates': np.array(list(ind.to_pydatetime()), dtype=object),
+        }, index=eastern, columns=['vol', 'local', 'py_dates'])
+        dates.index.name = 'timestamp'
+
+        desc, types = pytables.frame_description(dates)
+        assert types['py_dates'] == 'datetime64'
+        assert pytables.frame_tz(dates, types) == {'timestamp': 'US/Eastern', 'local': 'US/Eastern'}
+
+        with TemporaryDirectory() as td:
+            handle = tb.HDF5Handle(td + '/test.h5', 'w')
+            group = handle.create_group('data')
+            table = group.frame_to_table('data_table', dates)
+            # stored as UTC
+            assert table.table.col('timestamp')[0] == eastern[0].value
+
+            result = table[:]
+            assert str(result.index.tz) == 'US/Eastern'
+            assert (result.index == eastern).all()
+            assert (pd.DatetimeIndex(result.local) == eastern).all()
+            assert (pd.DatetimeIndex(result.py_dates) == ind).all()
+            handle.close()
+
+    def test_legacy_datetime(self):
+        """
+            Appends to old Time64 'datetime' columns use the old local time
+            mktime encoding
+        """
+        import time
+        from collections import OrderedDict
+        import tables
+
+        when = ind + pd.DateOffset(microseconds=250)
+        dates = pd.DataFrame({'when': np.array(list(when.to_pydatetime()), dtype=object)},
+                             index=ind)
+        dates.index.name = 'timestamp'
+        old = np.array([time.mktime(v.timetuple()) + v.microsecond / 1E6 
+                        for v in when.to_pydatetime()], dtype=np.float64)
+
+        with TemporaryDirectory() as td:
+            handle = tb.HDF5Handle(td + '/test.h5', 'w')
+            group = handle.create_group('data')
+            desc = OrderedDict([('timestamp', tables.Int64Col(pos=0)), 
+                                ('when', tables.Time64Col(pos=1))])
+            types = {'timestamp': 'datetime64', 'when': 'datetime'}
+            table = group.create_table('data_table', desc, types, columns=['when'],
+                                       index_name='timestamp')
+            table.append(dates)
+            assert (table.table.col('when') == old).all()
+
+            result = table[:]
+            assert (pd.DatetimeIndex(result.when) == when).all()
+            handle.close()
+
+    def test_index_policy(self):
+        with TemporaryDirectory() as td:
+            handle = tb.HDF5Handle(td + '/test.h5', 'w')
+            group = handle.create_group('data')
+            table = group.frame_to_table('data_table', df)
+            table.set_index_policy(['timestamp', 'open'], kind='light', mode='lazy',
+                                   threshold=len(df))
+            state = table.index_state()
+            assert state['open']['kind'] == 'light'
+            assert state['open']['coverage'] == 1.0
+            assert not table.table.autoIndex
+
+            # below the threshold the new rows stay unindexed
+            table.append(df)
+            assert table.index_state()['open']['unindexed_rows'] == len(df)
+            table.append(df)
+            query = table.sql.open > 0
+            result = table.query(query)
+            assert len(result) == (df.open > 0).sum() * 3
+            # past the threshold the query updated the index first
+            state = table.index_state()
+            assert state['open']['indexed_rows'] == len(df) * 3
+            assert not state['open']['dirty']
+            # nothing left to do, nothing reported
+            assert table_indexing.IndexPolicy(table.table).refresh(force=True) == []
+
+            table.set_index_policy(['open'], mode='incremental')
+            assert table.index_state()['open']['kind'] == 'medium'
+            table.append(df)
+            assert table.index_state()['open']['coverage'] == 1.0
+            handle.close()
+
+    def test_prefetch(self):
+        with TemporaryDirectory() as td:
+            handle = tb.HDF5Handle(td + '/test.h5', 'w')
+            group = handle.create_group('data')
+            table = group.frame_to_table('data_table', df)
+
+            with table.prefetch(chunksize=70, depth=2) as reader:
+                frames = list(reader)
+            assert len(frames) == 5
+            tm.assert_frame_equal(pd.concat(frames), df, check_names=False)
+
+            # stopping early shuts the thread down
+            reader = table.prefetch(chunksize=10, depth=1, columns=['vol'])
+            for chunk in reader:
+                break
+            reader.close()
+            assert not reader._thread.is_alive()
+            tm.assert_frame_equal(chunk, df[:10][['vol']], check_names=False)
+            handle.close()
+
+        # errors in the reader thread surface in the consumer
+        def frames():
+            yield 1
+            raise ValueError('bad chunk')
+        reader = prefetch.PrefetchReader(frames())
+        self.assertRaises(ValueError, list, reader)
+
+        def interrupted():
+            yield 1
+            raise KeyboardInterrupt()
+        reader = prefetch.PrefetchReader(interrupted())
+        self.assertRaises(KeyboardInterrupt, list, reader)
+
+        # no second pass, it would wait forever
+        reader = prefetch.PrefetchReader(iter([1, 2]))
+        assert list(reader) == [1, 2]
+        self.assertRaises(ValueError, iter, reader)
+        reader = prefetch.PrefetchReader(iter([1, 2]))
+        reader.close()
+        self.assertRaises(ValueError, iter, reader)
+
 if __name__ == '__main__':                                                                                          
     import nose                                                                      
     nose.runmodule(argv=[__file__,'-vvs','-x','--pdb', '--pdb-failure'],exit=False)   